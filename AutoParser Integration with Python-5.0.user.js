@@ -19,6 +19,18 @@
     const CHECK_INTERVAL = 2000; // 2 секунды
     const PARSING_STATUS_URL = 'http://127.0.0.1:5000/parsing_status';
     const SEND_WORDS_URL = 'http://127.0.0.1:5000/words';
+    // Push-канал: WebSocket (если на сервере есть flask_sock), иначе SSE.
+    // HTTP-опрос выше остаётся запасным вариантом, пока канал не поднят.
+    const WS_URL = 'ws://127.0.0.1:5000/ws';
+    const EVENTS_URL = 'http://127.0.0.1:5000/events';
+    // На сайтах, где каждое слово — отдельный узел (blindtyping, gonki, fastfingers),
+    // следим за новыми словами через MutationObserver вместо полного перескана раз в 2 с
+    const USE_MUTATION_OBSERVER = true;
+
+    // Идентификатор вкладки: по нему сервер ведёт свою эпоху force и поток снимков
+    const CLIENT_ID = sessionStorage.getItem('tmClientId') ||
+        (location.hostname + '-' + Math.random().toString(36).slice(2, 10));
+    sessionStorage.setItem('tmClientId', CLIENT_ID);
 
     // Флаг «принудительного парсинга» и «запоминания» — будем получать от сервера
     let memoryEnabled = true;
@@ -27,47 +39,144 @@
         return 'lastSentIndex_' + window.location.hostname;
     }
 
+    // Последнее состояние, пришедшее по push-каналу (null — канала нет, опрашиваем)
+    let pushControl = null;
+    let ws = null;
+    let wsSeq = 0;
+    const wsPending = new Map();
+
+    function applyControl(data) {
+        memoryEnabled = data.memory_enabled !== false;
+        // Если force=true, сбросим lastSentIndex, чтобы точно отправить всё заново
+        if (data.force === true) {
+            console.log("[TM] FORCE parse triggered, сбрасываем индекс");
+            localStorage.removeItem(getStorageKey());
+            if (wordObserver) wordObserver.reset();
+        }
+    }
+
+    function connectPush(onChange) {
+        const q = '?client=' + encodeURIComponent(CLIENT_ID);
+        let sock;
+        try {
+            sock = new WebSocket(WS_URL + q);
+        } catch {
+            return connectEvents(onChange);
+        }
+        let opened = false;
+        sock.onopen = () => { opened = true; ws = sock; };
+        sock.onmessage = e => {
+            const m = JSON.parse(e.data);
+            if (m.type === 'control') {
+                applyControl(m);
+                pushControl = m;
+                onChange();
+            } else if (m.type === 'ack' && wsPending.has(m.id)) {
+                wsPending.get(m.id)(m);
+                wsPending.delete(m.id);
+            }
+        };
+        sock.onclose = () => {
+            ws = null;
+            pushControl = null;
+            wsPending.forEach(resolve => resolve(null));
+            wsPending.clear();
+            // /ws не поднялся вовсе (нет flask_sock) — уходим на SSE, иначе переподключаемся
+            if (!opened) connectEvents(onChange);
+            else setTimeout(() => connectPush(onChange), CHECK_INTERVAL);
+        };
+    }
+
+    function connectEvents(onChange) {
+        const es = new EventSource(EVENTS_URL + '?client=' + encodeURIComponent(CLIENT_ID));
+        es.onmessage = e => {
+            const m = JSON.parse(e.data);
+            applyControl(m);
+            pushControl = m;
+            onChange();
+        };
+        // EventSource переподключается сам, пока что — обратно на опрос
+        es.onerror = () => { pushControl = null; };
+    }
+
     async function checkParsingStatus() {
+        // Есть push-канал — состояние уже у нас, без лишнего запроса
+        if (pushControl) return pushControl.enabled === true;
         try {
-            const r = await fetch(PARSING_STATUS_URL);
+            const r = await fetch(PARSING_STATUS_URL + '?client=' + encodeURIComponent(CLIENT_ID));
             const data = await r.json();
-            const canParse = data.enabled === true;
-            memoryEnabled = data.memory_enabled !== false;
-            // Если force=true, сбросим lastSentIndex, чтобы точно отправить всё заново
-            if (data.force === true) {
-                console.log("[TM] FORCE parse triggered, сбрасываем индекс");
-                localStorage.removeItem(getStorageKey());
-            }
-            return canParse;
+            applyControl(data);
+            return data.enabled === true;
         } catch {
             return false;
         }
     }
 
-    async function sendWordsToServer(words) {
-        if (!words.length) return;
+    function sendWordsOverSocket(words, snapshot) {
+        return new Promise(resolve => {
+            const id = ++wsSeq;
+            wsPending.set(id, resolve);
+            ws.send(JSON.stringify({ type: 'words', id, words, snapshot: !!snapshot, site: location.hostname }));
+            setTimeout(() => {
+                if (wsPending.delete(id)) resolve(null);
+            }, 5000);
+        });
+    }
+
+    // Вернёт, сколько из отправленных слов сервер учёл: принятые + отброшенные
+    // как повтор снимка (при переполнении буфера — 429 и только часть).
+    // snapshot=true — отправляем весь текст, сервер сам отбросит уже принятое
+    async function sendWordsToServer(words, snapshot) {
+        if (!words.length) return 0;
+        if (ws && ws.readyState === WebSocket.OPEN) {
+            const ack = await sendWordsOverSocket(words, snapshot);
+            if (ack) {
+                if (ack.code === 429) {
+                    console.warn('[TM] Буфер сервера заполнен, принято:', ack.accepted);
+                }
+                return (ack.accepted || 0) + (ack.skipped || 0);
+            }
+        }
         try {
-            await fetch(SEND_WORDS_URL, {
+            const r = await fetch(SEND_WORDS_URL, {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ words })
+                body: JSON.stringify({ words, client: CLIENT_ID, snapshot: !!snapshot, site: location.hostname })
             });
+            const data = await r.json();
+            if (r.status === 429) {
+                console.warn('[TM] Буфер сервера заполнен, принято:', data.accepted);
+            }
+            if (typeof data.accepted !== 'number') return r.ok ? words.length : 0;
+            return data.accepted + (data.skipped || 0);
         } catch (e) {
             console.error('[TM] Ошибка отправки слов на сервер:', e);
+            return 0;
         }
     }
 
     // ---- Парсеры ----
+    // Текст одного узла-слова (общий для полного парсера и MutationObserver)
+    function blindTypingWordText(d) {
+        let w = '';
+        d.querySelectorAll('span').forEach(s => w += s.textContent);
+        return w;
+    }
+    function gonkiWordText(s) {
+        return s.textContent.replace(/˽/g,'');
+    }
+    function fastfingersWordText(d) {
+        let txt='';
+        d.querySelectorAll('letter').forEach(l=> txt+=l.textContent);
+        return txt;
+    }
+
     function extractFromBlindTyping() {
         const c = document.getElementById('words');
         if (!c) return [];
         const divs = c.querySelectorAll('div.TestWrapper_word__TI39_');
         let out = [];
-        divs.forEach(d => {
-            let w = '';
-            d.querySelectorAll('span').forEach(s => w += s.textContent);
-            out.push(w);
-        });
+        divs.forEach(d => out.push(blindTypingWordText(d)));
         return out;
     }
     function extractFromTyperacer() {
@@ -91,7 +200,7 @@
         if(!c) return [];
         let out = [];
         c.querySelectorAll('span.word').forEach(s=>{
-            out.push(s.textContent.replace(/˽/g,''));
+            out.push(gonkiWordText(s));
         });
         return out;
     }
@@ -126,9 +235,7 @@
         if(!w) return [];
         let out=[];
         w.querySelectorAll('div.word').forEach(d=>{
-            let txt='';
-            d.querySelectorAll('letter').forEach(l=> txt+=l.textContent);
-            out.push(txt);
+            out.push(fastfingersWordText(d));
         });
         return out;
     }
@@ -170,31 +277,167 @@
         return [];
     }
 
+    // ---- Инкрементальный режим (MutationObserver) ----
+    // Контейнер и узел-слово для сайтов, где каждое слово — отдельный элемент.
+    // Остальные сайты (typeracer, speedcoder, speedtypingonline) — как раньше, опросом.
+    const OBSERVED_SITES = [
+        {
+            host: 'blindtyping.com',
+            container: () => document.getElementById('words'),
+            word: 'div.TestWrapper_word__TI39_',
+            text: blindTypingWordText
+        },
+        {
+            host: 'gonki.nabiraem.ru',
+            container: () => document.querySelector('div.editor-text'),
+            word: 'span.word',
+            text: gonkiWordText
+        },
+        {
+            host: 'fastfingers.net',
+            container: () => document.getElementById('wordWrapper'),
+            word: 'div.word',
+            text: fastfingersWordText
+        }
+    ];
+
+    let parsingAllowed = false;   // Последний ответ сервера: можно ли парсить
+
+    // Следит за контейнером сайта: полный проход — один раз при подключении
+    // (уходит снимком, сервер отбросит уже принятое), дальше — только новые узлы-слова,
+    // которые отправляются дельтой сразу после появления.
+    function createWordObserver(site) {
+        let container = null;
+        let observer = null;
+        let seen = new WeakSet();
+        let pending = [];
+        let snapshot = true;
+        let timer = null;
+        let sending = false;
+
+        function collect(root) {
+            if (root.nodeType !== 1) return;
+            if (root.matches(site.word)) {
+                if (!seen.has(root)) {
+                    seen.add(root);
+                    pending.push(root);
+                }
+                return;
+            }
+            root.querySelectorAll(site.word).forEach(n => {
+                if (!seen.has(n)) {
+                    seen.add(n);
+                    pending.push(n);
+                }
+            });
+        }
+
+        function flushSoon() {
+            if (!timer) timer = setTimeout(flush, 30);
+        }
+
+        async function flush() {
+            timer = null;
+            if (!parsingAllowed || sending || !pending.length) return;
+            // Слово может появиться пустым и дорисоваться следом — ждём его текст
+            let n = 0;
+            const words = [];
+            while (n < pending.length) {
+                const t = site.text(pending[n]);
+                if (!t) break;
+                words.push(t);
+                n++;
+            }
+            if (!n) return;
+            const nodes = pending.splice(0, n);
+            sending = true;
+            try {
+                const done = await sendWordsToServer(words, snapshot);
+                if (done > 0) snapshot = false;
+                if (done < nodes.length) pending.unshift(...nodes.slice(done));
+            } finally {
+                sending = false;
+            }
+            if (pending.length) flushSoon();
+        }
+
+        // true — контейнер есть и за ним следим
+        function attach() {
+            const c = site.container();
+            if (c && c === container) return true;
+            if (observer) observer.disconnect();
+            observer = null;
+            container = c;
+            seen = new WeakSet();
+            pending = [];
+            snapshot = true;
+            if (!c) return false;
+            collect(c);
+            observer = new MutationObserver(muts => {
+                muts.forEach(m => m.addedNodes.forEach(collect));
+                flushSoon();
+            });
+            observer.observe(c, { childList: true, subtree: true, characterData: true });
+            flushSoon();
+            return true;
+        }
+
+        function reset() {
+            container = null;
+            attach();
+        }
+
+        return { attach, reset, flushSoon };
+    }
+
+    const observedSite = OBSERVED_SITES.find(site => location.href.includes(site.host));
+    const wordObserver = (USE_MUTATION_OBSERVER && observedSite) ? createWordObserver(observedSite) : null;
+
     function startAutoSend() {
         let lastSentIndex = parseInt(localStorage.getItem(getStorageKey()))||0;
+        let busy = false;
 
-        setInterval(async ()=>{
-            const canParse = await checkParsingStatus();
-            if(!canParse) return;
+        async function tick() {
+            if (busy) return;
+            busy = true;
+            try {
+                const canParse = await checkParsingStatus();
+                parsingAllowed = canParse;
+                // Контейнер под наблюдением — слова уходят сами по мере появления
+                if (wordObserver && wordObserver.attach()) {
+                    if (canParse) wordObserver.flushSoon();
+                    return;
+                }
+                if(!canParse) return;
 
-            const words = extractText();
-            if(!words.length) return;
+                const words = extractText();
+                if(!words.length) return;
 
-            // Если текста стало меньше, сброс
-            if(words.length<lastSentIndex){
-                lastSentIndex=0;
-            }
-            // Если память выключена, будем всегда отправлять всё
-            let newWords = memoryEnabled ? words.slice(lastSentIndex) : words;
-
-            if(newWords.length){
-                await sendWordsToServer(newWords);
-                if(memoryEnabled){
-                    lastSentIndex += newWords.length;
-                    localStorage.setItem(getStorageKey(), String(lastSentIndex));
+                // force мог сбросить индекс в localStorage
+                lastSentIndex = parseInt(localStorage.getItem(getStorageKey()))||0;
+                // Если текста стало меньше, сброс
+                if(words.length<lastSentIndex){
+                    lastSentIndex=0;
                 }
+                // Если память выключена, будем всегда отправлять всё
+                let newWords = memoryEnabled ? words.slice(lastSentIndex) : words;
+
+                if(newWords.length){
+                    const done = await sendWordsToServer(newWords, !memoryEnabled);
+                    if(memoryEnabled){
+                        // Сдвигаемся только на принятое — остальное дошлём на следующем тике
+                        lastSentIndex += done;
+                        localStorage.setItem(getStorageKey(), String(lastSentIndex));
+                    }
+                }
+            } finally {
+                busy = false;
             }
-        }, CHECK_INTERVAL);
+        }
+
+        // Изменение настроек по push-каналу — сразу внеочередной тик, не ждём 2 с
+        connectPush(tick);
+        setInterval(tick, CHECK_INTERVAL);
     }
 
     startAutoSend();
@@ -1,41 +1,135 @@
 import ctypes
+import os
+import sys
 import time
 import random
 import threading
+import asyncio
 import queue
-from flask import Flask, request, jsonify
-from flask_cors import CORS
-import telebot
-import requests
-from telebot import types
-from pynput.keyboard import Controller, Key
-
-# ----------------- Flask-сервер -----------------
+import functools
+import bisect
+import math
+import json
+import mmap
+import atexit
+import logging
+import logging.handlers
+from array import array
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+# Flask, telebot и aiohttp импортируются лениво — только в режиме, где они нужны
+# (см. create_app / create_bot / run_async и CLI в разделе «Запуск»).
+
+class Deferred:
+    """
+    Записывает вызовы-декораторы (routes.route(...), handlers.message_handler(...))
+    при импорте модуля и проигрывает их на настоящем объекте в apply().
+    Так маршруты и хендлеры объявлены как обычно, а Flask/telebot не грузятся,
+    пока режим их не попросит.
+    """
 
-app = Flask(__name__)
-CORS(app)
+    def __init__(self):
+        self._calls = []
 
-words_queue = queue.Queue()
-stop_event = threading.Event()
-typing_thread = None
+    def __getattr__(self, name):
+        def decorator(*args, **kwargs):
+            def register(f):
+                self._calls.append((name, args, kwargs, f))
+                return f
+            return register
+        return decorator
 
-keyboard = Controller()
+    def apply(self, target):
+        for name, args, kwargs, f in self._calls:
+            getattr(target, name)(*args, **kwargs)(f)
+        return target
 
-# ----------------- ГЛОБАЛЬНЫЕ ПЕРЕМЕННЫЕ -----------------
+# ----------------- Flask-сервер -----------------
 
-parsing_enabled = True   # Разрешён ли автопарсинг из Tampermonkey
-force_parse = False      # Принудительный парсинг (Tampermonkey сбросит индекс)
+routes = Deferred()      # Маршруты Flask (app.route / app.errorhandler)
+push_routes = Deferred() # Долгие push-соединения (SSE), только если сервер их тянет
+ws_routes = Deferred()   # WebSocket-маршруты flask_sock (тоже push)
+app = None               # Flask-приложение, см. create_app()
+request = jsonify = Response = None   # Заполняет create_app() из flask
 
-# CHANGED: память по дефолту = False
-memory_enabled = False   # Если False, Tampermonkey не ведёт lastSentIndex
+plans_queue = queue.Queue()   # Скомпилированные планы слов (см. plan_producer_func)
+stop_event = threading.Event()
+pause_event = threading.Event()   # Пауза: движок замирает на текущем символе
+paused_ack = threading.Event()    # Движок встал на паузу (для замера задержки)
+wake_event = threading.Event()    # «Звонок» движку: стоп/пауза/продолжение прерывают любое ожидание
+engine_idle = threading.Event()   # Движок ждёт слов: только тогда продюсер будит его звонком
 
-errors_enabled = False   # Включить ли "ошибки" при печати
-error_chance = 1         # Шанс ошибки (в %)
-custom_delay = 0.0       # Доп. задержка к каждому символу (секунды)
+# ----------------- ГЛОБАЛЬНЫЕ ПЕРЕМЕННЫЕ -----------------
 
-continue_mode = False    # Если False, бот останавливается после окончания очереди
+# Настройки (парсинг, память, ошибки, задержка, скорость, continue_mode)
+# живут в одном месте — в BotController (см. ниже controller).
+
+# Лог напечатанных слов — кольцевой буфер на TYPED_HISTORY_CAPACITY последних слов
+# (см. TypedHistory). /typed отдаёт не больше TYPED_PAGE_MAX слов за запрос.
+TYPED_HISTORY_CAPACITY = 1000
+TYPED_PAGE_MAX = 200
+
+# Ёмкость буфера входящих слов. Если буфер полон, /words отвечает 429
+# и сообщает, сколько слов реально принято.
+WORD_BUFFER_CAPACITY = 50000
+
+# Сколько последних принятых слов на источник помнить для поиска перекрытия снимков
+SNAPSHOT_WINDOW = 5000
+
+# Планировщик нажатий (KeyPacer): последние PACER_SPIN секунд паузы добираются
+# активным ожиданием, случайные паузы генерируются пачками по PACER_BATCH,
+# при отставании больше PACER_MAX_LAG расписание начинается заново
+PACER_SPIN = 0.002
+PACER_BATCH = 1024
+PACER_MAX_LAG = 0.25
+
+# Режим целевой скорости (target_cpm > 0): скорость меряется по окну из RATE_WINDOW
+# последних нажатий, раз в RATE_UPDATE_EVERY нажатий пауза подстраивается под цель
+RATE_WINDOW = 60
+RATE_UPDATE_EVERY = 10
+RATE_GAIN = 0.5
+CHARS_PER_WORD = 5   # Стандарт WPM: 1 слово = 5 символов
+
+# Без continue_mode движок, опустошив очередь, ждёт новых слов ещё TYPING_LINGER секунд
+# (слова часто приходят сразу после /start). 0 — выходить сразу.
+TYPING_LINGER = 0.3
+
+# Сколько скомпилированных планов слов держать в LRU-кэше
+PLAN_CACHE_SIZE = 4096
+
+# Как запускать сервер: 'threads' — Flask + поток бота + поток печати (как раньше),
+# 'asyncio' — один цикл asyncio (aiohttp) для приёма слов, управления, Telegram и печати
+SERVER_MODE = 'threads'
+
+# HTTP-сервер для режима 'threads': 'threaded' — dev-сервер Flask, поток на запрос (как раньше),
+# 'single' — dev-сервер в один поток, 'waitress' — WSGI-сервер waitress (pip install waitress)
+# с пулом из WAITRESS_THREADS потоков. Push-каналы (/ws, /events) держат рабочий поток
+# всё время, пока открыта вкладка, поэтому их отдаёт только 'threaded' (и режим asyncio):
+# под 'single' и 'waitress' их нет (404), и userscript остаётся на опросе /parsing_status.
+# Сравнить варианты под нагрузкой: loadtest_http.py.
+HTTP_SERVER = 'threaded'
+HTTP_SERVERS = ('single', 'threaded', 'waitress')
+PUSH_HTTP_SERVERS = ('threaded',)
+HTTP_PORT = 5000
+WAITRESS_THREADS = 8
+
+# Бэкенд нажатий: 'auto' | 'pynput' | 'winapi' | 'unicode' | 'recording' (см. KEYBOARD_BACKENDS)
+KEY_BACKEND = 'auto'
+
+# Бэкенд по сайту (подстрока hostname из userscript -> имя бэкенда), остальные — KEY_BACKEND.
+# 'unicode' вводит символы кодами Unicode целым словом, без переключения раскладки;
+# годится, если сайт смотрит на введённый текст, а не на коды клавиш.
+# Включайте только для сайтов, где это проверено вживую, например:
+#     'speedcoder.net': 'unicode',
+SITE_BACKENDS = {
+}
 
-typed_words = []         # Лог уже напечатанных слов/символов
+# Журнал сессии (см. SessionJournal): принятые слова и позиция печати на диске,
+# после перезапуска бот продолжает с того же слова. '' — журнал выключен.
+JOURNAL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'typing_journal.log')
+JOURNAL_FLUSH_INTERVAL = 0.05      # Как часто писатель сбрасывает пачку записей на диск, сек
+JOURNAL_COMPACT_BYTES = 1 << 20    # Больше этого — журнал переписывается без напечатанных слов
 
 speed_settings = {
     'slow': (0.21, 0.30),
@@ -43,71 +137,1377 @@ speed_settings = {
     'fast': (0.08, 0.12),
     '0.01': (0.00, 0.01)
 }
-current_speed = 'medium'
-min_delay, max_delay = speed_settings[current_speed]
-speed_lock = threading.Lock()
-
-# CHANGED: карта для «ручного» ввода точки, запятой и т. д. в RU-раскладке
-# Здесь для простоты показываем только точку и запятую.
-# Идея: если текущая раскладка — RUS, и символ = '.' -> нажать Shift+ю.
-#       если символ = ',' -> нажать Shift+б.
-# При желании можно добавить ещё символы.
-ru_punct_map = {
-    '.': 'ю',  # Shift + ю = точка
-    ',': 'б',  # Shift + б = запятая
-}
+
+# CHANGED: «ручной» ввод точки, запятой и прочих знаков в RU-раскладке.
+# Раньше тут была карта только для точки и запятой (ru_punct_map),
+# теперь для каждой раскладки есть полная таблица символ -> клавиша + Shift
+# (см. KEYBOARD_LAYOUTS / KEYMAPS в разделе «Таблица раскладок»).
+
+# Уровень логов при старте (меняется на ходу: /set_log_level, кнопка «Логи» в Telegram).
+# Сообщения на каждое слово и нажатие — DEBUG, так что на INFO они ничего не стоят.
+LOG_LEVEL = 'INFO'
+LOG_LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR')
+
+# ----------------- Логирование -----------------
+
+log = logging.getLogger('typingbot')
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler без форматирования в вызывающем потоке: запись уходит в очередь
+    как есть, а строку собирает (и пишет в консоль) поток QueueListener.
+    Аргументы сообщений — строки и числа, их можно не копировать.
+    """
+
+    def prepare(self, record):
+        return record
+
+def setup_logging(level=LOG_LEVEL, stream=None):
+    """
+    Логи пишет фоновый поток: поток печати только кладёт запись в очередь.
+    На Windows-консоли один print стоит миллисекунды и сбивал паузы между нажатиями.
+    """
+    log_queue = queue.SimpleQueue()
+    handler = logging.StreamHandler(stream or sys.stdout)
+    handler.setFormatter(logging.Formatter('%(asctime)s %(message)s', '%H:%M:%S'))
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    log.addHandler(LogQueueHandler(log_queue))
+    log.propagate = False
+    log.setLevel(level)
+    listener.start()
+    atexit.register(listener.stop)   # Дописать хвост очереди при выходе
+    return listener
+
+log_listener = setup_logging()
+
+# ----------------- Журнал сессии -----------------
+
+class SessionJournal:
+    """
+    Append-only журнал сессии на диске, по строке на запись:
+        S<json-источник> — следующие W/H пришли от этого клиента (null — неизвестно)
+        W<json-слово>  — слово принято в буфер
+        H<json-слово>  — уже напечатанное слово, хранится только для дедупликации снимков
+        T<n>           — напечатано n слов (считая от последней B)
+        B<n>           — база: следующая W имеет номер n (после сжатия; B0 — новый текст)
+    Пишет отдельный поток-писатель: движок и маршруты только кладут записи в очередь,
+    писатель раз в JOURNAL_FLUSH_INTERVAL пишет их одной пачкой через буфер файла
+    (подряд идущие T схлопываются в последнюю). При старте журнал читается через
+    mmap, недопечатанный хвост возвращается в буфер, а файл сжимается —
+    так же, как и при превышении JOURNAL_COMPACT_BYTES. При сжатии у каждого
+    источника остаются последние window принятых слов (H), чтобы после рестарта
+    снимок страницы не лёг в очередь повторно.
+    Пока open() не вызван (бенчмарк, импорт), все методы — no-op.
+    """
+
+    def __init__(self, path, flush_interval=JOURNAL_FLUSH_INTERVAL, compact_bytes=JOURNAL_COMPACT_BYTES,
+                 window=SNAPSHOT_WINDOW):
+        self.path = path
+        self.window = window
+        self.flush_interval = flush_interval
+        self.compact_bytes = compact_bytes
+        self._queue = queue.SimpleQueue()
+        self._file = None
+        self._thread = None
+        self._typed = 0    # Номер следующего печатаемого слова (для записей T)
+
+    def open(self):
+        """
+        Читает журнал, сжимает его и запускает писателя.
+        Вернёт (недопечатанные слова, {источник: последние принятые им слова}).
+        """
+        entries, typed, history = self._load()
+        self._rewrite(entries, typed, history)
+        self._typed = typed
+        self._file = open(self.path, 'a', encoding='utf-8', buffering=1 << 16)
+        self._thread = threading.Thread(target=self._writer, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+        streams = {src: list(words) for src, words in history.items() if src is not None}
+        for src, w in entries:
+            if src is not None:
+                streams.setdefault(src, []).append(w)
+        return [w for _, w in entries], streams
+
+    def close(self):
+        """Дописать всё, что в очереди, и закрыть файл."""
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join(timeout=2)
+        self._thread = None
+
+    # --- Запись (зовут движок и маршруты) ---
+
+    def ingested(self, words, source=None):
+        if self._thread is not None and words:
+            self._queue.put(self._source_line(source)
+                            + ''.join('W' + json.dumps(w, ensure_ascii=False) + '\n' for w in words))
+
+    def typed(self):
+        self._typed += 1
+        if self._thread is not None:
+            self._queue.put(self._typed)
+
+    def reset(self):
+        """Новый текст (force_parse): старые слова больше не нужны."""
+        self._typed = 0
+        if self._thread is not None:
+            self._queue.put('B0\n')
+
+    # --- Писатель ---
+
+    def _writer(self):
+        closing = False
+        while not closing:
+            items = [self._queue.get()]
+            while True:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            out, typed = [], None
+            for item in items:
+                if item is None:
+                    closing = True
+                elif isinstance(item, int):
+                    typed = item
+                else:
+                    if typed is not None:
+                        out.append(f"T{typed}\n")
+                        typed = None
+                    out.append(item)
+            if typed is not None:
+                out.append(f"T{typed}\n")
+            try:
+                self._file.write(''.join(out))
+                self._file.flush()
+                if self._file.tell() > self.compact_bytes:
+                    self._compact()
+            except OSError as e:
+                log.error("[JOURNAL] Ошибка записи: %s", e)
+            if not closing:
+                time.sleep(self.flush_interval)
+        self._file.close()
+
+    def _compact(self):
+        """Переписывает журнал: база + только недопечатанные слова."""
+        self._file.close()
+        entries, typed, history = self._load()
+        self._rewrite(entries, typed, history)
+        self._file = open(self.path, 'a', encoding='utf-8', buffering=1 << 16)
+        log.info("[JOURNAL] Журнал сжат, осталось слов: %s", len(entries))
+
+    # --- Чтение и сжатие ---
+
+    @staticmethod
+    def _source_line(source):
+        return 'S' + json.dumps(source, ensure_ascii=False) + '\n'
+
+    def _remember(self, history, src, words):
+        kept = history.setdefault(src, [])
+        kept.extend(words)
+        if len(kept) > 2 * self.window:
+            del kept[:-self.window]
+
+    def _load(self):
+        """
+        По содержимому журнала: ([(источник, слово)] недопечатанных, сколько напечатано,
+        {источник: последние напечатанные слова}). Журнал старого формата (без S) —
+        источник None.
+        """
+        try:
+            f = open(self.path, 'rb')
+        except FileNotFoundError:
+            return [], 0, {}
+        with f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return [], 0, {}
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                base, typed, entries, history, src = 0, 0, [], {}, None
+                for line in iter(mm.readline, b''):
+                    if not line.endswith(b'\n'):
+                        break   # Запись оборвана падением процесса
+                    tag, body = line[:1], line[1:-1]
+                    if tag == b'W':
+                        entries.append((src, json.loads(body)))
+                    elif tag == b'S':
+                        src = json.loads(body)
+                    elif tag == b'H':
+                        self._remember(history, src, [json.loads(body)])
+                    elif tag == b'T':
+                        typed = int(body)
+                    elif tag == b'B':
+                        base = typed = int(body)
+                        entries, history, src = [], {}, None
+        done = typed - base
+        for src, w in entries[:done]:
+            self._remember(history, src, [w])
+        for kept in history.values():
+            del kept[:-self.window]
+        return entries[done:], typed, history
+
+    def _rewrite(self, entries, base, history):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(f"B{base}\n")
+            for src, words in history.items():
+                if src is not None and words:
+                    f.write(self._source_line(src))
+                    f.write(''.join('H' + json.dumps(w, ensure_ascii=False) + '\n' for w in words))
+            out, last = [], object()
+            for src, w in entries:
+                if src != last:
+                    out.append(self._source_line(src))
+                    last = src
+                out.append('W' + json.dumps(w, ensure_ascii=False) + '\n')
+            f.write(''.join(out))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+journal = SessionJournal(JOURNAL_PATH)
+
+# ----------------- Буфер входящих слов -----------------
+
+class WordBuffer:
+    """
+    Компактная ограниченная очередь слов для /words.
+    Весь текст лежит одной строкой, а границы слов — в array('I') смещений,
+    поэтому пачка слов добавляется одной операцией под одним захватом лока,
+    а не отдельным объектом и put() на каждое слово.
+    Прочитанная голова периодически отрезается (компактизация).
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._text = ''
+        self._ends = array('I')   # Конец i-го слова в self._text
+        self._times = array('d')  # Когда i-е слово попало в буфер (perf_counter) — для метрик
+        self._head = 0            # Индекс следующего непрочитанного слова
+        self._unfinished = 0      # Добавлено, но ещё не подтверждено task_done()
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        with self._cond:
+            return len(self._ends) - self._head
+
+    def put_many(self, words):
+        """Добавляет пачку слов, сколько влезет. Вернёт число принятых."""
+        with self._cond:
+            free = self.capacity - (len(self._ends) - self._head)
+            batch = words[:max(free, 0)]
+            if not batch:
+                return 0
+            end = len(self._text)
+            ends = []
+            for w in batch:
+                end += len(w)
+                ends.append(end)
+            self._text += ''.join(batch)
+            self._ends.extend(ends)
+            self._times.extend(array('d', [time.perf_counter()]) * len(batch))
+            self._unfinished += len(batch)
+            self._cond.notify_all()
+            return len(batch)
+
+    def get_batch(self, max_count, timeout=None):
+        """
+        Забирает до max_count слов; если пусто — ждёт не дольше timeout.
+        Вернёт (слова, времена попадания в буфер).
+        """
+        with self._cond:
+            if self._head >= len(self._ends):
+                self._cond.wait(timeout)
+            head, stop = self._head, min(self._head + max_count, len(self._ends))
+            start = self._ends[head - 1] if head else 0
+            out = []
+            for i in range(head, stop):
+                end = self._ends[i]
+                out.append(self._text[start:end])
+                start = end
+            times = self._times[head:stop]
+            self._head = stop
+            self._compact()
+            return out, times
+
+    def wake(self):
+        """Будит get_batch(), чтобы продюсер не досиживал свой timeout при остановке."""
+        with self._cond:
+            self._cond.notify_all()
+
+    def task_done(self, count=1):
+        """Подтверждает, что count выданных слов обработаны (доехали до планов)."""
+        with self._cond:
+            self._unfinished = max(self._unfinished - count, 0)
+
+    def is_drained(self):
+        """Нет ни непрочитанных слов, ни выданных, но не подтверждённых."""
+        return self._unfinished == 0
+
+    def clear(self):
+        with self._cond:
+            self._text = ''
+            self._ends = array('I')
+            self._times = array('d')
+            self._head = 0
+            self._unfinished = 0
+
+    def _compact(self):
+        # Отрезаем прочитанное, когда его набралось больше половины
+        if self._head == len(self._ends):
+            self._text = ''
+            self._ends = array('I')
+            self._times = array('d')
+            self._head = 0
+        elif self._head > 1024 and self._head * 2 > len(self._ends):
+            base = self._ends[self._head - 1]
+            self._text = self._text[base:]
+            self._ends = array('I', (e - base for e in self._ends[self._head:]))
+            self._times = self._times[self._head:]
+            self._head = 0
+
+class SourceStream:
+    """
+    Полиномиальный скользящий хэш уже принятого потока слов одного источника.
+    prefix[i] — хэш первых i слов (от отрезанной головы, это не мешает:
+    хэш отрезка считается по разности префиксов). Хранится не больше window слов.
+    """
+    MOD = (1 << 61) - 1
+    BASE = random.randrange(1 << 20, 1 << 40)
+    _pows = [1]
+
+    def __init__(self, window):
+        self.window = window
+        self.prefix = [0]
+
+    def __len__(self):
+        return len(self.prefix) - 1
+
+    @classmethod
+    def _pow(cls, k):
+        pows = cls._pows
+        while len(pows) <= k:
+            pows.append(pows[-1] * cls.BASE % cls.MOD)
+        return pows[k]
+
+    @classmethod
+    def prefix_hashes(cls, words):
+        out = [0]
+        h = 0
+        for w in words:
+            h = (h * cls.BASE + (hash(w) & 0xFFFFFFFFFFFF)) % cls.MOD
+            out.append(h)
+        return out
+
+    def extend(self, words):
+        h = self.prefix[-1]
+        for w in words:
+            h = (h * self.BASE + (hash(w) & 0xFFFFFFFFFFFF)) % self.MOD
+            self.prefix.append(h)
+        if len(self.prefix) > 2 * self.window + 1:
+            self.prefix = self.prefix[-(self.window + 1):]
+
+    def overlap(self, snapshot_prefix):
+        """Самое длинное k: последние k принятых слов == первые k слов снимка."""
+        n = len(self)
+        top = self.prefix[n]
+        for k in range(min(n, len(snapshot_prefix) - 1), 0, -1):
+            if (top - self.prefix[n - k] * self._pow(k)) % self.MOD == snapshot_prefix[k]:
+                return k
+        return 0
+
+class WordIngestor:
+    """
+    Идемпотентный приём слов в words_buffer.
+    Если клиент присылает снимок (snapshot=true: весь текст страницы, память выключена),
+    ищем самое длинное перекрытие снимка с уже принятым потоком этого источника
+    и кладём в буфер только новый хвост. Обычные дельты просто дописываются.
+    Тут же живут эпохи принудительного парсинга: у каждого клиента своя
+    «последняя увиденная эпоха», поэтому force не съедается первым опросившим.
+    """
+
+    def __init__(self, buffer, window, journal):
+        self.buffer = buffer
+        self.window = window
+        self.journal = journal
+        self.epoch = 0
+        self._client_epochs = {}
+        self._streams = {}
+        self._lock = threading.Lock()
+
+    def ingest(self, source, words, snapshot=False):
+        """Вернёт (skipped, accepted, new): сколько отброшено как повтор, принято и было новых."""
+        with self._lock:
+            stream = self._streams.get(source)
+            if stream is None:
+                stream = self._streams[source] = SourceStream(self.window)
+            skipped = stream.overlap(SourceStream.prefix_hashes(words)) if snapshot else 0
+            new_words = words[skipped:]
+            accepted = self.buffer.put_many(new_words)
+            stream.extend(new_words[:accepted])
+            self.journal.ingested(new_words[:accepted], source)
+            return skipped, accepted, len(new_words)
+
+    def seed(self, streams):
+        """Восстанавливает потоки источников из журнала (после рестарта)."""
+        with self._lock:
+            for source, words in streams.items():
+                stream = self._streams[source] = SourceStream(self.window)
+                stream.extend(words[-self.window:])
+
+    def poll_force(self, client):
+        """True, если клиент ещё не видел текущую эпоху принудительного парсинга."""
+        with self._lock:
+            seen = self._client_epochs.get(client)
+            self._client_epochs[client] = self.epoch
+            # Новый клиент и так шлёт всё с нуля — force ему не нужен
+            return seen is not None and seen < self.epoch
+
+    def bump_epoch(self):
+        """Новая эпоха: все клиенты получат force, история потоков забыта."""
+        with self._lock:
+            self.epoch += 1
+            self._streams.clear()
+            return self.epoch
+
+words_buffer = WordBuffer(WORD_BUFFER_CAPACITY)
+ingestor = WordIngestor(words_buffer, SNAPSHOT_WINDOW, journal)
+
+# ----------------- История набранного -----------------
+
+class TypedHistory:
+    """
+    Кольцевой буфер последних напечатанных слов фиксированной ёмкости.
+    У каждого слова свой номер (seq), номера только растут — даже clear()
+    их не сбрасывает. Клиент держит курсор «следующий seq» и забирает
+    только новое: since(cursor, limit). Память и размер ответа /typed
+    не зависят от того, сколько бот уже работает.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._items = [None] * capacity
+        self._next = 0      # seq следующего слова
+        self._first = 0     # seq самого старого слова, которое ещё считается живым
+        self._lock = threading.Lock()
+
+    def append(self, word):
+        with self._lock:
+            self._items[self._next % self.capacity] = word
+            self._next += 1
+
+    def clear(self):
+        """Забыть всё набранное (номера продолжаются с того же места)."""
+        with self._lock:
+            self._first = self._next
+
+    @property
+    def next_seq(self):
+        return self._next
+
+    def _oldest(self):
+        return max(self._first, self._next - self.capacity)
+
+    def __len__(self):
+        with self._lock:
+            return self._next - self._oldest()
+
+    def since(self, seq, limit):
+        """
+        Слова с номерами >= seq, не больше limit.
+        Вернёт (слова, seq первого из них, следующий курсор, сколько слов уже вытеснено).
+        """
+        seq = max(seq, 0)   # Номеров меньше нуля не бывает — иначе dropped считал бы несуществующие слова
+        with self._lock:
+            oldest = self._oldest()
+            start = min(max(seq, oldest), self._next)
+            stop = min(start + max(limit, 0), self._next)
+            words = [self._items[i % self.capacity] for i in range(start, stop)]
+            return words, start, stop, max(oldest - seq, 0)
+
+    def tail(self, count):
+        """Последние count слов."""
+        with self._lock:
+            start = max(self._oldest(), self._next - count)
+            return [self._items[i % self.capacity] for i in range(start, self._next)]
+
+typed_words = TypedHistory(TYPED_HISTORY_CAPACITY)
+
+# ----------------- Метрики -----------------
+
+class Counter:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+class Histogram:
+    """
+    Гистограмма с фиксированными границами корзин (как в Prometheus).
+    Счётчики корзин выделены заранее, observe() только ищет корзину и
+    увеличивает её — без аллокаций на каждое нажатие.
+    """
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+        self.counts = array('Q', [0]) * (len(self.bounds) + 1)   # Последняя — +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Оценка квантиля по корзинам (верхняя граница корзины, где набралось q)."""
+        if not self.count:
+            return 0.0
+        need = q * self.count
+        acc = 0
+        for i, c in enumerate(self.counts):
+            acc += c
+            if acc >= need:
+                return self.bounds[i] if i < len(self.bounds) else float('inf')
+        return float('inf')
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+FAST_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1)
+
+class Metrics:
+    """Все метрики конвейера: счётчики и гистограммы создаются один раз при старте."""
+
+    def __init__(self):
+        self.enqueue_to_key = Histogram(LATENCY_BUCKETS)   # Слово попало в буфер -> первое нажатие
+        self.key_inject = Histogram(FAST_BUCKETS)          # Стоимость одного нажатия в бэкенде
+        self.layout_switch = Histogram(FAST_BUCKETS)       # Стоимость переключения раскладки
+        self.sleep_overshoot = Histogram(FAST_BUCKETS)     # Насколько проснулись позже дедлайна
+        self.wakeup = Histogram(FAST_BUCKETS)              # Простаивающий движок: слово в буфере -> движок взял его
+        self.stop_latency = Histogram(LATENCY_BUCKETS)     # Команда стоп -> поток печати завершён
+        self.pause_latency = Histogram(LATENCY_BUCKETS)    # Команда пауза -> движок встал
+        self.words_typed = Counter()
+        self.chars_typed = Counter()
+        self.errors_injected = Counter()
+        self.layout_switches = Counter()
+        self.session_started = 0.0                         # perf_counter начала печати
+        self.session_ended = 0.0                           # perf_counter конца (0 — печать идёт)
+        self.session_chars = 0
+        self.session_words = 0
+
+    def start_session(self):
+        self.session_started = time.perf_counter()
+        self.session_ended = 0.0
+        self.session_chars = self.chars_typed.value
+        self.session_words = self.words_typed.value
+
+    def end_session(self):
+        self.session_ended = time.perf_counter()
+
+    def session_elapsed(self):
+        """Секунд с начала текущей (или до конца последней) печати."""
+        if not self.session_started:
+            return 0.0
+        return (self.session_ended or time.perf_counter()) - self.session_started
+
+    def session_rates(self):
+        """(слов/с, символов/с) с начала текущей печати."""
+        if not self.session_started:
+            return 0.0, 0.0
+        el = self.session_elapsed()
+        if el <= 0:
+            return 0.0, 0.0
+        return ((self.words_typed.value - self.session_words) / el,
+                (self.chars_typed.value - self.session_chars) / el)
+
+    def render_prometheus(self):
+        """Текстовый формат Prometheus (exposition format 0.0.4)."""
+        out = []
+
+        def counter(name, help_text, value):
+            out.append(f"# HELP {name} {help_text}")
+            out.append(f"# TYPE {name} counter")
+            out.append(f"{name} {value}")
+
+        def gauge(name, help_text, value):
+            out.append(f"# HELP {name} {help_text}")
+            out.append(f"# TYPE {name} gauge")
+            out.append(f"{name} {value}")
+
+        def histogram(name, help_text, h):
+            out.append(f"# HELP {name} {help_text}")
+            out.append(f"# TYPE {name} histogram")
+            acc = 0
+            for bound, c in zip(h.bounds, h.counts):
+                acc += c
+                out.append(f'{name}_bucket{{le="{bound}"}} {acc}')
+            out.append(f'{name}_bucket{{le="+Inf"}} {h.count}')
+            out.append(f"{name}_sum {h.sum}")
+            out.append(f"{name}_count {h.count}")
+
+        wps, cps = self.session_rates()
+        histogram("typingbot_enqueue_to_key_seconds", "Time from word ingestion to its first keystroke", self.enqueue_to_key)
+        histogram("typingbot_key_inject_seconds", "Backend cost of one keystroke", self.key_inject)
+        histogram("typingbot_layout_switch_seconds", "Cost of one keyboard layout switch", self.layout_switch)
+        histogram("typingbot_sleep_overshoot_seconds", "How late the engine woke up after a pause deadline", self.sleep_overshoot)
+        histogram("typingbot_wakeup_seconds", "Time from word ingestion until an idle engine picks it up", self.wakeup)
+        histogram("typingbot_stop_latency_seconds", "Time from a stop command until typing has halted", self.stop_latency)
+        histogram("typingbot_pause_latency_seconds", "Time from a pause command until the engine is frozen", self.pause_latency)
+        counter("typingbot_layout_switches_total", "Keyboard layout switches", self.layout_switches.value)
+        counter("typingbot_words_typed_total", "Words typed", self.words_typed.value)
+        counter("typingbot_chars_typed_total", "Text characters typed", self.chars_typed.value)
+        counter("typingbot_errors_injected_total", "Deliberate typos injected", self.errors_injected.value)
+        gauge("typingbot_queue_depth", "Words waiting in the buffer and plan queue", len(words_buffer) + plans_queue.qsize())
+        gauge("typingbot_words_per_second", "Words per second since typing started", round(wps, 3))
+        gauge("typingbot_chars_per_second", "Characters per second since typing started", round(cps, 3))
+        gauge("typingbot_achieved_cpm", "Achieved characters per minute over the rate window", round(rate_control.achieved_cpm(), 1))
+        return "\n".join(out) + "\n"
+
+    def summary_text(self):
+        """Короткая сводка для Telegram."""
+        wps, cps = self.session_rates()
+        ms = lambda v: f"{v * 1000:.2f}"
+        return "\n".join([
+            f"Слов: {self.words_typed.value}, символов: {self.chars_typed.value}, ошибок: {self.errors_injected.value}",
+            f"Скорость: {wps:.2f} слов/с, {cps:.1f} симв/с",
+            f"Очередь: {len(words_buffer) + plans_queue.qsize()}",
+            f"Буфер->нажатие p50/p99: {ms(self.enqueue_to_key.quantile(0.5))}/{ms(self.enqueue_to_key.quantile(0.99))} мс",
+            f"Нажатие p50/p99: {ms(self.key_inject.quantile(0.5))}/{ms(self.key_inject.quantile(0.99))} мс",
+            f"Пересып p50/p99: {ms(self.sleep_overshoot.quantile(0.5))}/{ms(self.sleep_overshoot.quantile(0.99))} мс",
+            f"Пробуждение p50/p99: {ms(self.wakeup.quantile(0.5))}/{ms(self.wakeup.quantile(0.99))} мс",
+            f"Стоп/пауза p99: {ms(self.stop_latency.quantile(0.99))}/{ms(self.pause_latency.quantile(0.99))} мс",
+            f"Переключений раскладки: {self.layout_switches.value} "
+            f"(p99 {ms(self.layout_switch.quantile(0.99))} мс)",
+        ])
+
+metrics = Metrics()
 
 # ----------------- Работа с раскладкой (WinAPI) -----------------
 
 LANG_ENGLISH = '0409'
 LANG_RUSSIAN = '0419'
 
-user32 = ctypes.WinDLL('user32', use_last_error=True)
+# user32 есть только на Windows. На других ОС модуль всё равно грузится,
+# а печать идёт через бэкенд без WinAPI (см. ниже RecordingBackend).
+user32 = ctypes.WinDLL('user32', use_last_error=True) if sys.platform == 'win32' else None
+if user32 is not None:
+    # HKL — указатель: без restype ctypes обрезал бы его до int, а символ без argtypes
+    # ушёл бы в VkKeyScanExW указателем на строку, а не WCHAR
+    user32.GetKeyboardLayout.argtypes = [ctypes.c_uint32]
+    user32.GetKeyboardLayout.restype = ctypes.c_void_p
+    user32.LoadKeyboardLayoutW.argtypes = [ctypes.c_wchar_p, ctypes.c_uint]
+    user32.LoadKeyboardLayoutW.restype = ctypes.c_void_p
+    user32.ActivateKeyboardLayout.argtypes = [ctypes.c_void_p, ctypes.c_uint]
+    user32.ActivateKeyboardLayout.restype = ctypes.c_void_p
+    user32.VkKeyScanExW.argtypes = [ctypes.c_wchar, ctypes.c_void_p]
+    user32.VkKeyScanExW.restype = ctypes.c_short
+
+_hkl_cache = {}   # '0409' -> HKL, LoadKeyboardLayoutW зовём один раз на раскладку
 
 def get_current_layout():
     """Вернёт код раскладки (строка '0409' или '0419' и т.п.)."""
-    hkl = user32.GetKeyboardLayout(0)
+    hkl = user32.GetKeyboardLayout(0) or 0
     lang_id = hkl & 0xFFFF
     return f"{lang_id:04X}"
 
-def switch_to_layout(target_layout):
+def activate_layout(target_layout):
     """
-    Переключает раскладку на target_layout (пример: '0409' = EN, '0419' = RU).
-    Именно через WinAPI: LoadKeyboardLayoutW + ActivateKeyboardLayout.
+    Активирует раскладку через WinAPI: LoadKeyboardLayoutW (с кэшем HKL)
+    + ActivateKeyboardLayout. Ничего не знает о текущем состоянии — это забота LayoutManager.
     """
-    try:
+    hkl = _hkl_cache.get(target_layout)
+    if not hkl:
         hkl = user32.LoadKeyboardLayoutW(target_layout, 1)
         if not hkl:
-            print(f"[ERR] Не смогли загрузить раскладку {target_layout}")
+            log.error("[ERR] Не смогли загрузить раскладку %s", target_layout)
             return False
-        result = user32.ActivateKeyboardLayout(hkl, 0)
-        if result == 0:
-            print(f"[ERR] Не смогли активировать раскладку {target_layout}")
+        _hkl_cache[target_layout] = hkl
+    result = user32.ActivateKeyboardLayout(hkl, 0)
+    if not result:
+        log.error("[ERR] Не смогли активировать раскладку %s", target_layout)
+        return False
+    return True
+
+def switch_to_layout(target_layout):
+    """
+    Переключает раскладку на target_layout (пример: '0409' = EN, '0419' = RU).
+    Оставлено для совместимости — теперь всё идёт через LayoutManager,
+    который не трогает ОС, если раскладка уже нужная.
+    """
+    return layouts.ensure(target_layout)
+
+class LayoutManager:
+    """
+    «Конечный автомат» активной раскладки поверх бэкенда клавиатуры.
+    Активную раскладку менеджер помнит сам, поэтому повторное переключение
+    на ту же раскладку — no-op без обращения к ОС.
+    С ОС сверяемся только через sync() — когда раскладку мог поменять
+    кто-то снаружи (старт печати, простой в ожидании слов).
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.active = None     # Последняя известная активная раскладка
+        self.switches = 0      # Сколько реальных переключений сделали
+
+    def sync(self):
+        """Перечитывает активную раскладку из бэкенда (на Windows — GetKeyboardLayout)."""
+        self.active = self.backend.current_layout()
+        return self.active
+
+    def invalidate(self):
+        """Забываем активную раскладку — следующий ensure() точно пойдёт в бэкенд."""
+        self.active = None
+
+    def ensure(self, target_layout):
+        """Делает target_layout активной. Если она уже активна — ничего не делает."""
+        if target_layout == self.active:
+            return True
+        try:
+            t0 = time.perf_counter()
+            ok = self.backend.switch_layout(target_layout)
+            metrics.layout_switch.observe(time.perf_counter() - t0)
+            if not ok:
+                self.active = None
+                return False
+            self.active = target_layout
+            self.switches += 1
+            metrics.layout_switches.inc()
+            log.debug("[OK] Раскладка переключена на %s", target_layout)
+            return True
+        except Exception as e:
+            log.error("[EXCEPT] LayoutManager.ensure: %s", e)
+            self.active = None
             return False
-        else:
-            print(f"[OK] Раскладка переключена на {target_layout}")
+
+# ----------------- Таблица раскладок (keymap) -----------------
+
+# Физические клавиши основного блока по рядам (виртуальные коды Windows).
+# Раскладка описывается строками символов для этих рядов: без Shift и с Shift.
+KEY_ROWS = (
+    (0xC0, 0x31, 0x32, 0x33, 0x34, 0x35, 0x36, 0x37, 0x38, 0x39, 0x30, 0xBD, 0xBB),
+    (0x51, 0x57, 0x45, 0x52, 0x54, 0x59, 0x55, 0x49, 0x4F, 0x50, 0xDB, 0xDD, 0xDC),
+    (0x41, 0x53, 0x44, 0x46, 0x47, 0x48, 0x4A, 0x4B, 0x4C, 0xBA, 0xDE),
+    (0x5A, 0x58, 0x43, 0x56, 0x42, 0x4E, 0x4D, 0xBC, 0xBE, 0xBF),
+)
+VK_SHIFT = 0x10
+VK_BACKSPACE = 0x08
+VK_TAB = 0x09
+VK_ENTER = 0x0D
+VK_SPACE = 0x20
+
+# Чтобы добавить раскладку — допишите её сюда (и язык в LAYOUT_LANGS).
+KEYBOARD_LAYOUTS = {
+    LANG_ENGLISH: (
+        ("`1234567890-=", "~!@#$%^&*()_+"),
+        ("qwertyuiop[]\\", "QWERTYUIOP{}|"),
+        ("asdfghjkl;'", 'ASDFGHJKL:"'),
+        ("zxcvbnm,./", "ZXCVBNM<>?"),
+    ),
+    LANG_RUSSIAN: (
+        ("ё1234567890-=", 'Ё!"№;%:?*()_+'),
+        ("йцукенгшщзхъ\\", "ЙЦУКЕНГШЩЗХЪ/"),
+        ("фывапролджэ", "ФЫВАПРОЛДЖЭ"),
+        ("ячсмитьбю.", "ЯЧСМИТЬБЮ,"),
+    ),
+}
+LAYOUT_LANGS = {LANG_ENGLISH: 'english', LANG_RUSSIAN: 'russian'}
+
+# Одно нажатие: какой символ получится, клавиша (None — клавиши нет, вводим символ как есть),
+# нужен ли Shift, в какой раскладке.
+KeyStroke = namedtuple('KeyStroke', 'char vk shift layout')
+
+def build_keymap(layout, rows):
+    """Таблица символ -> KeyStroke для одной раскладки (+ пробел, Tab, Enter)."""
+    keymap = {}
+    for vks, (plain, shifted) in zip(KEY_ROWS, rows):
+        for vk, ch in zip(vks, plain):
+            keymap[ch] = KeyStroke(ch, vk, False, layout)
+        for vk, ch in zip(vks, shifted):
+            keymap[ch] = KeyStroke(ch, vk, True, layout)
+    keymap[' '] = KeyStroke(' ', VK_SPACE, False, layout)
+    keymap['\t'] = KeyStroke('\t', VK_TAB, False, layout)
+    keymap['\n'] = KeyStroke('\n', VK_ENTER, False, layout)
+    return keymap
+
+# Строятся один раз при старте; дальше ни бэкенд, ни движок символы не «разрешают»
+KEYMAPS = {layout: build_keymap(layout, rows) for layout, rows in KEYBOARD_LAYOUTS.items()}
+# Обратная таблица (раскладка, vk, shift) -> символ: что реально напечатает нажатие
+KEYMAP_CHARS = {(ks.layout, ks.vk, ks.shift): ch for km in KEYMAPS.values() for ch, ks in km.items()}
+# Буква -> язык (по той же таблице определяется язык символа)
+LETTER_LANGS = {ch: LAYOUT_LANGS[layout] for layout, km in KEYMAPS.items() for ch in km if ch.isalpha()}
+
+def keystroke(ch, layout):
+    """Нажатие для ch в layout; символа нет в раскладке — KeyStroke без клавиши."""
+    return KEYMAPS[layout].get(ch) or KeyStroke(ch, None, False, layout)
+
+SPACE_KEY = KEYMAPS[LANG_ENGLISH][' ']     # Пробел и Enter одинаковы во всех раскладках
+ENTER_KEY = KEYMAPS[LANG_ENGLISH]['\n']
+
+# ----------------- Бэкенды клавиатуры -----------------
+
+class KeyboardBackend:
+    """
+    Интерфейс бэкенда нажатий. Движок печати работает только через него.
+    Спец-клавиши передаются строками: 'shift', 'backspace', 'enter', 'space', 'tab',
+    обычные символы — самим символом.
+    """
+    name = 'base'
+
+    def press(self, key):
+        raise NotImplementedError
+
+    def release(self, key):
+        raise NotImplementedError
+
+    def type(self, text):
+        raise NotImplementedError
+
+    def tap(self, stroke):
+        """
+        Одно нажатие из таблицы раскладок (KeyStroke): клавиша stroke.vk,
+        с Shift если stroke.shift. Символ заново не ищется.
+        """
+        raise NotImplementedError
+
+    def switch_layout(self, layout):
+        """Активирует раскладку, вернёт True/False."""
+        raise NotImplementedError
+
+    def current_layout(self):
+        """Вернёт код активной раскладки ('0409', '0419', ...)."""
+        raise NotImplementedError
+
+class PynputBackend(KeyboardBackend):
+    """Нажатия через pynput, раскладка через WinAPI (если мы на Windows)."""
+    name = 'pynput'
+
+    def __init__(self):
+        from pynput.keyboard import Controller, Key, KeyCode
+        self._ctl = Controller()
+        self._key_codes = {}   # vk -> KeyCode, создаются один раз
+        self._key_code = KeyCode.from_vk
+        self._keys = {
+            'shift': Key.shift,
+            'backspace': Key.backspace,
+            'enter': Key.enter,
+            'space': Key.space,
+            'tab': Key.tab,
+        }
+        self._layout = LANG_ENGLISH   # Без user32 раскладку только «помним»
+
+    def press(self, key):
+        self._ctl.press(self._keys.get(key, key))
+
+    def release(self, key):
+        self._ctl.release(self._keys.get(key, key))
+
+    def type(self, text):
+        self._ctl.type(text)
+
+    def tap(self, stroke):
+        # Виртуальные коды из таблицы — виндовые; на других ОС pynput вводит символ сам
+        if stroke.vk is None or user32 is None:
+            self._ctl.type(stroke.char)
+            return
+        key = self._key_codes.get(stroke.vk)
+        if key is None:
+            key = self._key_codes[stroke.vk] = self._key_code(stroke.vk)
+        if stroke.shift:
+            self._ctl.press(self._keys['shift'])
+        self._ctl.press(key)
+        self._ctl.release(key)
+        if stroke.shift:
+            self._ctl.release(self._keys['shift'])
+
+    def switch_layout(self, layout):
+        if user32 is None:
+            self._layout = layout
             return True
+        return activate_layout(layout)
+
+    def current_layout(self):
+        if user32 is None:
+            return self._layout
+        return get_current_layout()
+
+class WinApiBackend(KeyboardBackend):
+    """
+    Нажатия и раскладка напрямую через user32 (keybd_event + VkKeyScanExW),
+    без pynput. Символ превращается в виртуальную клавишу в текущей раскладке.
+    """
+    name = 'winapi'
+
+    KEYEVENTF_KEYUP = 0x0002
+    VK = {
+        'shift': VK_SHIFT,
+        'backspace': VK_BACKSPACE,
+        'enter': VK_ENTER,
+        'space': VK_SPACE,
+        'tab': VK_TAB,
+    }
+
+    def __init__(self):
+        if user32 is None:
+            raise RuntimeError("WinApiBackend работает только на Windows")
+
+    def _tap(self, vk):
+        user32.keybd_event(vk, 0, 0, 0)
+        user32.keybd_event(vk, 0, self.KEYEVENTF_KEYUP, 0)
+
+    def _vk(self, key):
+        if key in self.VK:
+            return self.VK[key]
+        return user32.VkKeyScanExW(key, user32.GetKeyboardLayout(0)) & 0xFF
+
+    def press(self, key):
+        user32.keybd_event(self._vk(key), 0, 0, 0)
+
+    def release(self, key):
+        user32.keybd_event(self._vk(key), 0, self.KEYEVENTF_KEYUP, 0)
+
+    def type(self, text):
+        hkl = user32.GetKeyboardLayout(0)
+        for ch in text:
+            if ch == '\n':
+                self._tap(self.VK['enter'])
+                continue
+            # Символ вне BMP в один WCHAR не влезает — клавиши для него всё равно нет
+            res = user32.VkKeyScanExW(ch, hkl) if ord(ch) <= 0xFFFF else -1
+            if res == -1:
+                log.error("[ERR] В текущей раскладке нет символа '%s'", ch)
+                continue
+            vk = res & 0xFF
+            shift = res & 0x100
+            if shift:
+                user32.keybd_event(self.VK['shift'], 0, 0, 0)
+            self._tap(vk)
+            if shift:
+                user32.keybd_event(self.VK['shift'], 0, self.KEYEVENTF_KEYUP, 0)
+
+    def tap(self, stroke):
+        if stroke.vk is None:
+            self.type(stroke.char)
+            return
+        if stroke.shift:
+            user32.keybd_event(VK_SHIFT, 0, 0, 0)
+        self._tap(stroke.vk)
+        if stroke.shift:
+            user32.keybd_event(VK_SHIFT, 0, self.KEYEVENTF_KEYUP, 0)
+
+    def switch_layout(self, layout):
+        return activate_layout(layout)
+
+    def current_layout(self):
+        return get_current_layout()
+
+class UnicodeBackend(KeyboardBackend):
+    """
+    Ввод символов прямо кодами Unicode: раскладка ОС не нужна и не переключается,
+    Shift и прочие модификаторы не жмутся. type() получает целое слово и отправляет
+    его одним вызовом (движок так и делает, см. unicode_input).
+    Конкретный способ ввода — в наследниках: SendInput (Windows) и XTest (Linux).
+    """
+    name = 'unicode'
+    unicode_input = True   # Движок печатает словами, без планов раскладок
+
+    def __init__(self):
+        self._layout = LANG_ENGLISH   # Раскладку только «помним», ОС не трогаем
+
+    def tap(self, stroke):
+        self.type(stroke.char)
+
+    def switch_layout(self, layout):
+        self._layout = layout
+        return True
+
+    def current_layout(self):
+        return self._layout
+
+class _KEYBDINPUT(ctypes.Structure):
+    _fields_ = [('wVk', ctypes.c_ushort), ('wScan', ctypes.c_ushort), ('dwFlags', ctypes.c_ulong),
+                ('time', ctypes.c_ulong), ('dwExtraInfo', ctypes.c_size_t)]
+
+class _MOUSEINPUT(ctypes.Structure):
+    _fields_ = [('dx', ctypes.c_long), ('dy', ctypes.c_long), ('mouseData', ctypes.c_ulong),
+                ('dwFlags', ctypes.c_ulong), ('time', ctypes.c_ulong), ('dwExtraInfo', ctypes.c_size_t)]
+
+class _INPUTUNION(ctypes.Union):
+    _fields_ = [('ki', _KEYBDINPUT), ('mi', _MOUSEINPUT)]
+
+class _INPUT(ctypes.Structure):
+    _fields_ = [('type', ctypes.c_ulong), ('u', _INPUTUNION)]
+
+class WinUnicodeBackend(UnicodeBackend):
+    """SendInput + KEYEVENTF_UNICODE: всё слово — один массив INPUT, один вызов SendInput."""
+
+    INPUT_KEYBOARD = 1
+    KEYEVENTF_KEYUP = 0x0002
+    KEYEVENTF_UNICODE = 0x0004
+    VK = WinApiBackend.VK
+
+    def __init__(self):
+        if user32 is None:
+            raise RuntimeError("WinUnicodeBackend работает только на Windows")
+        super().__init__()
+
+    def _events(self, text):
+        for ch in text:
+            # Enter и Tab — настоящими клавишами: редакторы кода ждут именно VK, а не символ
+            if ch == '\n':
+                yield VK_ENTER, 0, 0
+                continue
+            if ch == '\t':
+                yield VK_TAB, 0, 0
+                continue
+            data = ch.encode('utf-16-le')
+            for i in range(0, len(data), 2):   # Символы вне BMP — две суррогатные половинки
+                yield 0, int.from_bytes(data[i:i + 2], 'little'), self.KEYEVENTF_UNICODE
+
+    def type(self, text):
+        events = list(self._events(text))
+        inputs = (_INPUT * (2 * len(events)))()
+        for i, (vk, scan, flags) in enumerate(events):
+            for j, up in ((2 * i, 0), (2 * i + 1, self.KEYEVENTF_KEYUP)):
+                inputs[j].type = self.INPUT_KEYBOARD
+                inputs[j].u.ki = _KEYBDINPUT(vk, scan, flags | up, 0, 0)
+        sent = user32.SendInput(len(inputs), inputs, ctypes.sizeof(_INPUT))
+        if sent != len(inputs):
+            log.error("[ERR] SendInput отправил %s из %s событий", sent, len(inputs))
+
+    def press(self, key):
+        user32.keybd_event(self.VK.get(key, 0), 0, 0, 0)
+
+    def release(self, key):
+        user32.keybd_event(self.VK.get(key, 0), 0, self.KEYEVENTF_KEYUP, 0)
+
+class XTestUnicodeBackend(UnicodeBackend):
+    """
+    Linux/X11: python-xlib + расширение XTest. У X нет «ввода кода символа»,
+    поэтому свободные keycode'ы временно назначаются на keysym'ы нужных символов
+    (для Unicode keysym = 0x01000000 + код), затем идут нажатия через fake_input.
+    Слово — одна перекарта всех его символов и одна отправка (sync) на сервер.
+    """
+
+    SPECIAL = {'\n': 'Return', '\t': 'Tab', 'backspace': 'BackSpace', 'enter': 'Return',
+               'space': 'space', 'tab': 'Tab', 'shift': 'Shift_L'}
+
+    def __init__(self):
+        from Xlib import X, XK, display
+        from Xlib.ext import xtest
+        super().__init__()
+        self._X = X
+        self._xtest = xtest
+        self._d = display.Display()
+        if not self._d.has_extension('XTEST'):
+            raise RuntimeError("у X-сервера нет расширения XTEST")
+        first = self._d.display.info.min_keycode
+        count = self._d.display.info.max_keycode - first + 1
+        mapping = self._d.get_keyboard_mapping(first, count)
+        # Свободные keycode'ы (без единого keysym) — под временные символы
+        self._spare = [first + i for i, syms in enumerate(mapping) if not any(syms)]
+        if not self._spare:
+            raise RuntimeError("нет свободных keycode для ввода Unicode")
+        self._special = {}
+        for key, name in self.SPECIAL.items():
+            self._special[key] = self._d.keysym_to_keycode(XK.string_to_keysym(name))
+        self._mapped = {}   # символ -> keycode, пока перекарта действует
+
+    @staticmethod
+    def _keysym(ch):
+        cp = ord(ch)
+        return cp if 0x20 <= cp <= 0xFF else 0x01000000 | cp   # Latin-1 keysym == код символа
+
+    def _fake(self, keycode):
+        self._xtest.fake_input(self._d, self._X.KeyPress, keycode)
+        self._xtest.fake_input(self._d, self._X.KeyRelease, keycode)
+
+    def type(self, text):
+        chars = [ch for ch in dict.fromkeys(text) if ch not in self._special and ch not in self._mapped]
+        if len(self._mapped) + len(chars) > len(self._spare):
+            self._mapped = {}
+            chars = [ch for ch in dict.fromkeys(text) if ch not in self._special]
+        if chars:
+            for ch in chars[:len(self._spare) - len(self._mapped)]:
+                kc = self._spare[len(self._mapped)]
+                self._d.change_keyboard_mapping(kc, [(self._keysym(ch),) * 2])
+                self._mapped[ch] = kc
+            self._d.sync()
+        for ch in text:
+            kc = self._special.get(ch) or self._mapped.get(ch)
+            if kc:
+                self._fake(kc)
+            else:
+                log.error("[ERR] Не хватило свободных keycode для '%s'", ch)
+        self._d.sync()
+
+    def press(self, key):
+        self._xtest.fake_input(self._d, self._X.KeyPress, self._special[key])
+        self._d.sync()
+
+    def release(self, key):
+        self._xtest.fake_input(self._d, self._X.KeyRelease, self._special[key])
+        self._d.sync()
+
+def make_unicode_backend():
+    """Unicode-бэкенд под текущую ОС."""
+    return WinUnicodeBackend() if sys.platform == 'win32' else XTestUnicodeBackend()
+
+class RecordingBackend(KeyboardBackend):
+    """
+    Ничего не нажимает, а складывает события в память: (perf_counter, вид, аргумент).
+    Нужен, чтобы гонять движок печати без клавиатуры (Linux, профилирование,
+    бенчмарки, регрессии).
+    """
+    name = 'recording'
+
+    def __init__(self, layout=LANG_ENGLISH):
+        self.events = []
+        self.layout = layout
+        self.initial_layout = layout   # С какой раскладки начинается запись
+
+    def press(self, key):
+        self.events.append((time.perf_counter(), 'press', key))
+
+    def release(self, key):
+        self.events.append((time.perf_counter(), 'release', key))
+
+    def type(self, text):
+        self.events.append((time.perf_counter(), 'type', text))
+
+    def tap(self, stroke):
+        self.events.append((time.perf_counter(), 'key', stroke))
+
+    def switch_layout(self, layout):
+        self.events.append((time.perf_counter(), 'layout', layout))
+        self.layout = layout
+        return True
+
+    def current_layout(self):
+        return self.layout
+
+    def clear(self):
+        self.events.clear()
+        self.initial_layout = self.layout
+
+    def typed_text(self):
+        """
+        Восстанавливает напечатанный текст по событиям: Backspace стирает,
+        нажатие клавиши даёт тот символ, который эта клавиша (с Shift или без)
+        выдаёт в раскладке, активной в этот момент, — так видно и нажатия
+        не в той раскладке.
+        """
+        out = []
+        layout = self.initial_layout
+        for _, kind, arg in self.events:
+            if kind == 'layout':
+                layout = arg
+            elif kind == 'press' and arg == 'backspace':
+                if out:
+                    out.pop()
+            elif kind == 'press' and arg == 'enter':
+                out.append('\n')
+            elif kind == 'key':
+                if arg.vk is None:
+                    out.append(arg.char)
+                else:
+                    out.append(KEYMAP_CHARS.get((layout, arg.vk, arg.shift), '\ufffd'))
+            elif kind == 'type':
+                out.extend(arg)
+        return ''.join(out)
+
+KEYBOARD_BACKENDS = {
+    'pynput': PynputBackend,
+    'winapi': WinApiBackend,
+    'unicode': make_unicode_backend,
+    'recording': RecordingBackend,
+}
+
+def make_backend(name):
+    """
+    Создаёт бэкенд по имени. 'auto' = pynput, а если он недоступен
+    (нет pynput / нет дисплея) — RecordingBackend, чтобы модуль всё равно работал.
+    """
+    if name != 'auto':
+        return KEYBOARD_BACKENDS[name]()
+    try:
+        return PynputBackend()
     except Exception as e:
-        print(f"[EXCEPT] switch_to_layout: {e}")
-        return False
+        log.warning("[WARN] pynput недоступен (%s), печать пишется в RecordingBackend", e)
+        return RecordingBackend()
+
+def set_backend(backend):
+    """Подменяет бэкенд на лету (например, RecordingBackend для бенчмарка)."""
+    global keyboard
+    keyboard = backend
+    layouts.backend = backend
+    layouts.invalidate()
+
+def force_backend(name):
+    """Один бэкенд для всех сайтов (ключ --backend): SITE_BACKENDS больше не действует."""
+    global keyboard_default
+    SITE_BACKENDS.clear()
+    keyboard_default = make_backend(name)
+    set_backend(keyboard_default)
+
+_site_backends = {}   # имя бэкенда -> созданный экземпляр (для SITE_BACKENDS)
+
+def backend_for_site(site):
+    """
+    Бэкенд для сайта по SITE_BACKENDS (иначе KEY_BACKEND). Экземпляры создаются
+    один раз; если нужный бэкенд не поднимается, сайт печатается бэкендом по умолчанию.
+    """
+    name = next((n for host, n in SITE_BACKENDS.items() if host in site), KEY_BACKEND)
+    if name == KEY_BACKEND:
+        return keyboard_default
+    if name not in _site_backends:
+        try:
+            _site_backends[name] = make_backend(name)
+        except Exception as e:
+            log.warning("[WARN] Бэкенд '%s' для %s недоступен (%s), печатаем через '%s'", name, site, e, keyboard_default.name)
+            _site_backends[name] = keyboard_default
+    return _site_backends[name]
+
+keyboard = make_backend(KEY_BACKEND)
+keyboard_default = keyboard
+layouts = LayoutManager(keyboard)
 
 # ----------------- Вспомогательные функции -----------------
 
-def get_random_delay():
-    with speed_lock:
-        base = random.uniform(min_delay, max_delay)
-    return base + custom_delay
+class RateController:
+    """
+    Замкнутый контур скорости. record() отмечает каждое нажатие символа текста
+    в кольцевом буфере времён (array('d'), без аллокаций), achieved_cpm() —
+    фактическая скорость по этому окну. В режиме цели target_delay() выдаёт паузу
+    вокруг 60/target, умноженную на поправку, которая раз в RATE_UPDATE_EVERY
+    нажатий сдвигается на (факт/цель)^RATE_GAIN: печатаем медленнее цели
+    (накладные расходы, лаги сайта) — паузы короче, и наоборот.
+    Шаг привязан к числу нажатий, а не к вызовам target_delay(): пауз на одно
+    нажатие бывает несколько (ошибка + Backspace, слово целиком в unicode-режиме).
+    """
+
+    def __init__(self, window=RATE_WINDOW):
+        self.window = window
+        self._times = array('d', [0.0]) * window
+        self._count = 0
+        self._updated_at = 0   # На каком _count поправка сдвигалась в последний раз
+        self.correction = 1.0
+
+    def reset(self):
+        self._count = 0
+        self._updated_at = 0
+        self.correction = 1.0
+
+    def record(self, t):
+        self._times[self._count % self.window] = t
+        self._count += 1
+
+    def achieved_cpm(self):
+        n = min(self._count, self.window)
+        if n < 2:
+            return 0.0
+        last = self._times[(self._count - 1) % self.window]
+        first = self._times[(self._count - n) % self.window]
+        span = last - first
+        return (n - 1) * 60.0 / span if span > 0 else 0.0
+
+    def target_delay(self, target_cpm, u):
+        """Пауза для цели target_cpm; u — случайное число 0..1 (разброс ±25%)."""
+        if self._count >= 2 * RATE_UPDATE_EVERY and self._count - self._updated_at >= RATE_UPDATE_EVERY:
+            self._updated_at = self._count
+            achieved = self.achieved_cpm()
+            if achieved > 0:
+                self.correction *= (achieved / target_cpm) ** RATE_GAIN
+                self.correction = min(max(self.correction, 0.05), 5.0)
+        return 60.0 / target_cpm * self.correction * (0.75 + 0.5 * u)
+
+rate_control = RateController()
+
+def speed_label(cfg):
+    """Подпись скорости для меню: пресет или цель в WPM."""
+    if cfg.target_cpm:
+        return f"цель {cfg.target_cpm / CHARS_PER_WORD:g} WPM"
+    return cfg.current_speed
+
+def parse_target_speed(text):
+    """'80' / '80wpm' -> 400 CPM, '400cpm' -> 400 CPM."""
+    t = str(text).strip().lower().replace(' ', '')
+    if t.endswith('cpm'):
+        return float(t[:-3])
+    if t.endswith('wpm'):
+        t = t[:-3]
+    return float(t) * CHARS_PER_WORD
+
+class KeyPacer:
+    """
+    Расписание нажатий по абсолютным дедлайнам на time.perf_counter().
+    Каждая пауза отсчитывается от прошлого дедлайна, а не от «сейчас»,
+    поэтому пересып одной паузы автоматически съедается следующей и
+    реальная скорость не уплывает ниже заданной.
+    schedule() отдаёт «грубую» часть паузы (её спит драйвер: time.sleep или
+    таймер asyncio), а последние spin секунд добираются spin()-ом прямо перед
+    нажатием. Случайные числа для пауз генерируются пачкой.
+    """
+
+    def __init__(self, spin=PACER_SPIN, batch=PACER_BATCH, max_lag=PACER_MAX_LAG):
+        self.spin_window = spin
+        self.batch = batch
+        self.max_lag = max_lag
+        self._rand = []
+        self._i = 0
+        self.deadline = time.perf_counter()
+
+    def reset(self):
+        """Начать расписание заново от текущего момента (после простоя)."""
+        self.deadline = time.perf_counter()
+
+    def next_delay(self, cfg):
+        """
+        Случайная пауза по снимку настроек cfg из заранее сгенерированной пачки.
+        В режиме цели (cfg.target_cpm) паузу задаёт rate_control, custom_delay не добавляется.
+        """
+        if self._i >= len(self._rand):
+            rnd = random.random
+            self._rand = [rnd() for _ in range(self.batch)]
+            self._i = 0
+        u = self._rand[self._i]
+        self._i += 1
+        if cfg.target_cpm:
+            return rate_control.target_delay(cfg.target_cpm, u)
+        return cfg.min_delay + (cfg.max_delay - cfg.min_delay) * u + cfg.custom_delay
+
+    def schedule(self, delay):
+        """Сдвигает дедлайн на delay. Вернёт, сколько драйверу спать «грубо»."""
+        now = time.perf_counter()
+        self.deadline += delay
+        # Сильно отстали (подвисание, простой) — не догоняем очередью нажатий подряд
+        if self.deadline < now - self.max_lag:
+            self.deadline = now
+        return max(self.deadline - now - self.spin_window, 0.0)
+
+    def wait(self, delay):
+        """Простой (нет слов): дедлайн = сейчас + delay, спим целиком, без spin."""
+        self.deadline = time.perf_counter() + delay
+        return delay
+
+    def spin(self):
+        """
+        Короткое активное ожидание до точного дедлайна.
+        Вернёт, насколько позже дедлайна мы оказались (пересып драйвера).
+        """
+        deadline = self.deadline
+        now = time.perf_counter()
+        while now < deadline:
+            now = time.perf_counter()
+        return now - deadline
 
 def determine_language_of_char(ch):
-    """Определим язык символа (english, russian или other)."""
-    if ch.isalpha():
-        # Английские
-        if 'a' <= ch.lower() <= 'z':
-            return 'english'
-        # Русские
-        elif 'а' <= ch.lower() <= 'я' or ch in ('ё','Ё'):
-            return 'russian'
-    return 'other'
+    """Определим язык символа (english, russian или other) — по буквам таблицы раскладок."""
+    return LETTER_LANGS.get(ch, 'other')
 
 def determine_word_language(word):
     """Определяем язык слова (english, russian, mixed, other)."""
@@ -122,297 +1522,1178 @@ def determine_word_language(word):
         return langs.pop()
     return 'other'
 
-# CHANGED: Функция печати 1 символа с учётом RU-пунктуации
-def type_one_char(ch, current_layout):
-    """Печатает один символ ch, учитывая, что если раскладка RUS и ch='.'/',' 
-    то надо нажать Shift+ю или Shift+б соответственно.
-    В остальных случаях — просто keyboard.type(ch)."""
-    if current_layout == LANG_RUSSIAN and ch in ru_punct_map:
-        # Нужен "Shift + символ"
-        try:
-            keyboard.press(Key.shift)
-            keyboard.type(ru_punct_map[ch])
-            keyboard.release(Key.shift)
-        except Exception as e:
-            print(f"[ERR] Не смогли напечатать RU-пунктуацию '{ch}': {e}")
-    else:
-        # Обычная печать
-        keyboard.type(ch)
+# ----------------- Планы нажатий -----------------
+
+# Слово компилируется один раз в неизменяемый план: сегменты с раскладкой
+# и готовые нажатия (KeyStroke из KEYMAPS). Поток печати только
+# проигрывает планы — без посимвольного определения языка и поиска клавиш.
+#
+# PlanSegment.layout = None — сегмент «нейтральный» (цифры/знаки в начале
+# слова): печатается в текущей раскладке, поэтому для него заранее собраны
+# оба варианта: keys (EN) и ru_keys (RU).
+# PlanSegment.allowed — в каких раскладках сегмент вообще можно набрать
+# (у буквенного — только его раскладка, у нейтрального — см. NEUTRAL_CHARS).
+PlanSegment = namedtuple('PlanSegment', 'layout keys ru_keys allowed')
+WordPlan = namedtuple('WordPlan', 'word lang segments')
+
+LAYOUT_BY_LANG = {lang: layout for layout, lang in LAYOUT_LANGS.items()}
+
+# Не-буквы, которые есть на клавиатуре в каждой раскладке (из KEYMAPS).
+# Например, '@', '[', '<' в RU-раскладке не набрать, а '№' — в EN.
+NEUTRAL_CHARS = {layout: frozenset(ch for ch in km if not ch.isalpha()) for layout, km in KEYMAPS.items()}
+ALL_LAYOUTS = tuple(KEYMAPS)
+KNOWN_NEUTRAL = frozenset().union(*NEUTRAL_CHARS.values())
+
+def _typeable(ch, layout):
+    """Можно ли набрать ch в layout (буквы своей раскладки, знакомые не-буквы, незнакомое — везде)."""
+    lang = determine_language_of_char(ch)
+    if lang != 'other':
+        return LAYOUT_BY_LANG.get(lang) == layout
+    return ch in NEUTRAL_CHARS[layout] or ch not in KNOWN_NEUTRAL
+
+def _compile_keys(chars, layout):
+    """Символы -> кортеж нажатий KeyStroke для раскладки layout."""
+    return tuple(keystroke(ch, layout) for ch in chars)
+
+def _neutral_layouts(chars):
+    """Раскладки, в которых набираются все символы chars (незнакомые символы — в любой)."""
+    allowed = tuple(lay for lay in ALL_LAYOUTS if all(_typeable(ch, lay) for ch in chars))
+    return allowed or ALL_LAYOUTS
+
+def _compile_segment(layout, chars):
+    if layout:
+        return PlanSegment(layout, _compile_keys(chars, layout), None, (layout,))
+    return PlanSegment(None, _compile_keys(chars, LANG_ENGLISH), _compile_keys(chars, LANG_RUSSIAN),
+                       _neutral_layouts(chars))
+
+@functools.lru_cache(maxsize=PLAN_CACHE_SIZE)
+def compile_word(word):
+    """
+    Компилирует слово в WordPlan. Результат кэшируется (LRU по слову):
+    в тестах на скорость одни и те же слова повторяются постоянно.
+    Пустое слово — это Enter (lang='enter', без сегментов).
+    """
+    if word == "":
+        return WordPlan(word, 'enter', ())
+
+    wlang = determine_word_language(word)
+    layout = LAYOUT_BY_LANG.get(wlang)
+    if layout and all(_typeable(ch, layout) for ch in word):
+        return WordPlan(word, wlang, (_compile_segment(layout, word),))
+
+    # Режем на куски по языку букв. «Прочие» символы остаются в раскладке
+    # предыдущей буквы, если их там можно набрать, иначе уходят в нейтральный
+    # сегмент — его печатают в текущей раскладке, если в ней можно, иначе движок
+    # переключается на первую из allowed. other — один нейтральный сегмент.
+    segments = []
+    run_layout, run = None, []
+    for ch in word:
+        ch_layout = LAYOUT_BY_LANG.get(determine_language_of_char(ch))
+        if ch_layout is None and run_layout and not _typeable(ch, run_layout):
+            segments.append(_compile_segment(run_layout, run))
+            run_layout, run = None, []
+        elif ch_layout and ch_layout != run_layout:
+            if run:
+                segments.append(_compile_segment(run_layout, run))
+            run_layout, run = ch_layout, []
+        run.append(ch)
+    if run:
+        segments.append(_compile_segment(run_layout, run))
+    return WordPlan(word, wlang, tuple(segments))
+
+def plan_producer_func(done):
+    """
+    Стадия-продюсер: забирает пачки слов из words_buffer, компилирует и кладёт
+    планы в plans_queue заранее, пока поток печати занят предыдущими словами.
+    task_done() зовём только после put() — так по words_buffer.is_drained()
+    видно, что слова «в пути» и очередь на самом деле не пуста.
+    Новые слова будят продюсера сразу (put_many -> notify), а он — движок, если тот простаивает.
+    """
+    while not done.is_set() and not stop_event.is_set():
+        # timeout — только страховка на остановку, слова приходят через notify
+        words, times = words_buffer.get_batch(256, timeout=1.0)
+        if not words:
+            continue
+        for word, t in zip(words, times):
+            plans_queue.put((compile_word(word), t))
+        words_buffer.task_done(len(words))
+        wake_idle_engine()
+
+def wake_idle_engine():
+    """
+    Звонок движку, только если он ждёт слов: звонок посреди паузы между
+    нажатиями оборвал бы её. Движок ставит engine_idle до повторной проверки
+    очереди, так что план, положенный между проверками, не теряется.
+    """
+    if engine_idle.is_set():
+        controller._ring()
+
+def clear_word_queues():
+    """Очищает words_buffer и plans_queue (продюсер к этому моменту должен стоять)."""
+    words_buffer.clear()
+    with plans_queue.mutex:
+        plans_queue.queue.clear()
+
+def pipeline_is_empty():
+    """Нет ни слов в буфере, ни слов «в пути» у продюсера, ни готовых планов."""
+    return words_buffer.is_drained() and plans_queue.empty()
 
 # ----------------- Основная функция ввода -----------------
 
-def type_words_func():
+def typing_steps():
     """
+    Движок печати в виде генератора: сам жмёт клавиши через бэкенд,
+    а паузы не спит, а отдаёт наружу (yield секунд; None — ждать звонка wake_event).
+    Так один и тот же движок крутят и поток (type_words_func), и asyncio-режим
+    (type_words_async: нажатия в отдельном executor, паузы — таймерами цикла).
+
     Цикл, который:
-    1. Берёт слова из очереди (words_queue).
-    2. Если слово = '', жмём Enter.
-    3. Иначе переключаем раскладку на язык слова (или посимвольно, если mixed).
-    4. Печатаем слово через keyboard.type(ch) (с обработкой RU-пунктуации).
+    1. Берёт готовые планы слов из plans_queue (их компилирует plan_producer_func
+       из words_buffer).
+    2. Если план = Enter (пустое слово), жмём Enter.
+    3. Иначе по сегментам плана переключаем раскладку (только если она другая;
+       нейтральный сегмент остаётся в текущей, если его в ней можно набрать).
+    4. Проигрываем нажатия плана (клавиша + Shift уже взяты из таблицы KEYMAPS).
     5. Вставляем пробел.
     6. При errors_enabled и выпавшем шансе ошибки печатаем неверный символ + Backspace.
-    7. Если continue_mode = False и очередь опустела, выходим.
+    7. Если continue_mode = False, очередь опустела и за TYPING_LINGER
+       новых слов не пришло, выходим.
     """
 
-    original_layout = get_current_layout()
-    print(f"[INFO] Запуск печати. Исходная раскладка: {original_layout}")
+    # Единственный запрос к ОС на старте: дальше активную раскладку помнит layouts
+    original_layout = layouts.sync()
+    log.info("[INFO] Запуск печати. Исходная раскладка: %s", original_layout)
 
-    while not stop_event.is_set():
-        # Если выключено продолжение, и очередь пуста — останавливаемся
-        if not continue_mode and words_queue.empty():
-            print("[INFO] Очередь пуста, continue_mode=FALSE => выходим.")
+    producer_done = threading.Event()
+    producer = threading.Thread(target=plan_producer_func, args=(producer_done,), daemon=True)
+    producer.start()
+
+    pacer = KeyPacer()
+    rate_control.reset()
+    metrics.start_session()
+    progress.kick()
+    overshoot = metrics.sleep_overshoot
+    try:
+        # Драйвер «грубо» спит отданную паузу, точный дедлайн добираем тут.
+        # Разбудили раньше срока (стоп/пауза) — дедлайн не добираем, а смотрим, что случилось.
+        for delay in _typing_loop(pacer):
+            yield delay
+            if wake_event.is_set():
+                yield from _hold_while_paused(pacer)
+            elif delay is not None:
+                overshoot.observe(pacer.spin())
+    finally:
+        producer_done.set()
+        words_buffer.wake()
+        producer.join()
+        metrics.end_session()
+        progress.kick()
+
+        # Восстанавливаем раскладку
+        layouts.ensure(original_layout)
+        log.info("[INFO] Завершение печати.")
+
+# Из чего выбирается случайный неверный символ при errors_enabled
+ERROR_CHARS = ("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+               "1234567890!@#$%^&*()_+-=,./;:'\"[]{}|?абвгдеёжзийклмнопрстуфхцчшщъыьэюя")
+# Опечатки по клавишам: в каждой раскладке — только те символы, что в ней есть
+ERROR_STROKES = {layout: tuple(km[ch] for ch in ERROR_CHARS if ch in km) for layout, km in KEYMAPS.items()}
+
+def _hold_while_paused(pacer):
+    """
+    Пауза: стоим на текущем символе, пока не продолжат или не остановят.
+    Отдаёт None — драйвер ждёт звонка (wake_event) без таймаута.
+    Звонок гасим до проверки флагов: если флаг поменяют после проверки,
+    следующий звонок прервёт следующее ожидание, ничего не теряется.
+    """
+    held = False
+    while True:
+        wake_event.clear()
+        if stop_event.is_set() or not pause_event.is_set():
             break
+        if not held:
+            held = True
+            paused_ack.set()
+            log.info("[INFO] Пауза.")
+        yield None
+    if held:
+        paused_ack.clear()
+        pacer.reset()   # После паузы не «догоняем» расписание
+        if not stop_event.is_set():
+            log.info("[INFO] Продолжаем.")
+
+def _typing_loop(pacer):
+    """Сам цикл печати (см. typing_steps), отдаёт паузы в секундах по расписанию pacer."""
+    settings = controller.settings
+    key_inject = metrics.key_inject
+    enqueue_to_key = metrics.enqueue_to_key
+    chars_typed = metrics.chars_typed
+    linger_until = None   # Дедлайн ожидания новых слов без continue_mode
+    idle = False
+    while not stop_event.is_set():
+        # Снимок настроек берём один раз на слово: дальше поля читаются без локов
+        cfg = settings.current
+
+        # Слова пошли с другого сайта — бэкенд меняем только на границе слова
+        if controller.wanted_backend is not None:
+            set_backend(controller.wanted_backend)
+            controller.wanted_backend = None
+            layouts.sync()
+            log.info("[INFO] Бэкенд нажатий: %s", keyboard.name)
 
         try:
-            word = words_queue.get(timeout=1)
+            plan, enqueued_at = plans_queue.get_nowait()
         except queue.Empty:
-            # Очередь пустая, ждём следующего слова
-            time.sleep(0.1)
+            # Очередь пустая — ждём слов без опроса: продюсер позвонит, как только положит план.
+            # Если выключено продолжение — ждём не дольше TYPING_LINGER, потом выходим.
+            timeout = None
+            if not cfg.continue_mode and pipeline_is_empty():
+                now = time.perf_counter()
+                if linger_until is None:
+                    linger_until = now + TYPING_LINGER
+                timeout = linger_until - now
+                if timeout <= 0:
+                    log.info("[INFO] Очередь пуста, continue_mode=FALSE => выходим.")
+                    break
+            engine_idle.set()
+            if plans_queue.empty():
+                yield None if timeout is None else pacer.wait(timeout)
+            engine_idle.clear()
+            idle = True
             continue
 
-        if word == "":
+        linger_until = None
+        if idle:
+            # Пока ждали, пользователь мог сам сменить раскладку — сверимся с ОС
+            idle = False
+            metrics.wakeup.observe(time.perf_counter() - enqueued_at)
+            layouts.sync()
+            pacer.reset()
+
+        word = plan.word
+        if plan.lang == 'enter':
             # Пустое слово => это Enter
-            keyboard.type('\n')
+            keyboard.tap(ENTER_KEY)
+            t = time.perf_counter()
+            metrics.enqueue_to_key.observe(t - enqueued_at)
+            rate_control.record(t)
             typed_words.append("<ENTER>")
-            time.sleep(get_random_delay())
+            journal.typed()
+            yield pacer.schedule(pacer.next_delay(cfg))
             continue
 
-        # Определяем язык
-        wlang = determine_word_language(word)
-        print(f"[WORD] '{word}' lang={wlang}")
-
-        # Переключаем раскладку, если english/russian
-        if wlang == 'english':
-            switch_to_layout(LANG_ENGLISH)
-        elif wlang == 'russian':
-            switch_to_layout(LANG_RUSSIAN)
+        log.debug("[WORD] '%s' lang=%s", word, plan.lang)
+
+        if getattr(keyboard, 'unicode_input', False):
+            # Unicode-бэкенд: слово вместе с пробелом — одна инъекция, раскладку не трогаем.
+            # Пауза после слова = сумма пауз его символов, так что темп тот же.
+            if cfg.errors_enabled and any(random.randint(1, 100) <= cfg.error_chance for _ in word):
+                keyboard.type(random.choice(ERROR_CHARS))
+                metrics.errors_injected.inc()
+                yield pacer.schedule(0.2 + pacer.next_delay(cfg))
+                keyboard.press('backspace')
+                keyboard.release('backspace')
+                yield pacer.schedule(0.2 + pacer.next_delay(cfg))
+            text = word + ' '
+            t0 = time.perf_counter()
+            keyboard.type(text)
+            t = time.perf_counter()
+            key_inject.observe(t - t0)
+            enqueue_to_key.observe(t - enqueued_at)
+            chars_typed.inc(len(text))
+            for _ in text:
+                rate_control.record(t)
+            metrics.words_typed.inc()
+            typed_words.append(word)
+            journal.typed()
+            yield pacer.schedule(sum(pacer.next_delay(cfg) for _ in text))
+            log.debug("[OK] Слово '%s' напечатано.", word)
+            continue
 
         typed_correctly = True
 
-        for ch in word:
+        for seg in plan.segments:
             if stop_event.is_set():
                 break
 
-            # Если слово mixed, переключаемся посимвольно
-            if wlang == 'mixed':
-                ch_lang = determine_language_of_char(ch)
-                if ch_lang == 'english':
-                    switch_to_layout(LANG_ENGLISH)
-                elif ch_lang == 'russian':
-                    switch_to_layout(LANG_RUSSIAN)
-                # else: other — остаёмся в текущей
-
-            try:
-                # CHANGED: Печатаем с учётом RU-пунктуации
-                current_layout = get_current_layout()
-                type_one_char(ch, current_layout)
-                time.sleep(get_random_delay())
-
-                # Проверяем шанс ошибки
-                if errors_enabled and random.randint(1,100) <= error_chance:
-                    # Печатаем случайный неверный символ
-                    wrong_char = random.choice(
-                        "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
-                        "1234567890!@#$%^&*()_+-=,./;:'\"[]{}|?абвгдеёжзийклмнопрстуфхцчшщъыьэюя"
-                    )
-                    keyboard.type(wrong_char)
-                    time.sleep(0.2 + get_random_delay())
-                    # Нажимаем Backspace
-                    keyboard.press(Key.backspace)
-                    keyboard.release(Key.backspace)
-                    time.sleep(0.2 + get_random_delay())
-
-            except Exception as e:
-                typed_correctly = False
-                print(f"[ERR] Не смогли напечатать символ '{ch}': {e}")
+            # Раскладка сегмента; нейтральный сегмент печатаем в текущей
+            # (если раскладку поменяли снаружи и в ней его не набрать — в первой подходящей)
+            if seg.layout:
+                layouts.ensure(seg.layout)
+                keys = seg.keys
+            elif layouts.active not in seg.allowed:
+                layouts.ensure(seg.allowed[0])
+                keys = seg.ru_keys if layouts.active == LANG_RUSSIAN else seg.keys
+            elif layouts.active == LANG_RUSSIAN:
+                keys = seg.ru_keys
+            else:
+                keys = seg.keys
+
+            for stroke in keys:
+                if stop_event.is_set():
+                    break
+
+                try:
+                    t0 = time.perf_counter()
+                    keyboard.tap(stroke)
+                    t = time.perf_counter()
+                    key_inject.observe(t - t0)
+                    chars_typed.inc()
+                    if enqueued_at:
+                        enqueue_to_key.observe(t - enqueued_at)
+                        enqueued_at = 0.0
+                    rate_control.record(t)
+                    yield pacer.schedule(pacer.next_delay(cfg))
+
+                    # Проверяем шанс ошибки
+                    if cfg.errors_enabled and random.randint(1,100) <= cfg.error_chance:
+                        # Случайная неверная клавиша из таблицы той же раскладки, что и
+                        # только что нажатая: символ, которого в ней нет, бэкенд бы выбросил,
+                        # а Backspace стёр бы верный
+                        keyboard.tap(random.choice(ERROR_STROKES[stroke.layout]))
+                        metrics.errors_injected.inc()
+                        yield pacer.schedule(0.2 + pacer.next_delay(cfg))
+                        # Нажимаем Backspace
+                        keyboard.press('backspace')
+                        keyboard.release('backspace')
+                        yield pacer.schedule(0.2 + pacer.next_delay(cfg))
+
+                except Exception as e:
+                    typed_correctly = False
+                    log.error("[ERR] Не смогли напечатать символ '%s': %s", stroke.char, e)
 
         if not stop_event.is_set():
             # Пробел в конце слова
-            keyboard.type(' ')
+            keyboard.tap(SPACE_KEY)
+            rate_control.record(time.perf_counter())
+            chars_typed.inc()
+            metrics.words_typed.inc()
             typed_words.append(word)
-            time.sleep(get_random_delay())
-            print(f"[OK] Слово '{word}' напечатано." if typed_correctly else f"[WARN] '{word}' c ошибками.")
+            journal.typed()
+            yield pacer.schedule(pacer.next_delay(cfg))
+            if typed_correctly:
+                log.debug("[OK] Слово '%s' напечатано.", word)
+            else:
+                log.debug("[WARN] '%s' c ошибками.", word)
+
+def type_words_func():
+    """
+    Поток печати: прогоняет typing_steps(). Паузы спим на wake_event, а не time.sleep:
+    стоп и пауза прерывают даже многосекундную задержку сразу. None — ждать звонка.
+    """
+    for delay in typing_steps():
+        wake_event.wait(delay)
+
+# ----------------- Контроллер -----------------
+
+class ControlError(Exception):
+    """Команда управления не выполнена; текст уходит пользователю (HTTP 400 / ответ в Telegram)."""
+
+# Неизменяемый снимок настроек. Писатели (Flask, Telegram) публикуют новый снимок
+# с новой версией, поток печати просто берёт ссылку на текущий.
+Settings = namedtuple('Settings', [
+    'version',
+    'parsing_enabled',   # Разрешён ли автопарсинг из Tampermonkey
+    'memory_enabled',    # Если False, Tampermonkey не ведёт lastSentIndex
+    'errors_enabled',    # Включить ли "ошибки" при печати
+    'error_chance',      # Шанс ошибки (в %)
+    'custom_delay',      # Доп. задержка к каждому символу (секунды)
+    'continue_mode',     # Если False, бот останавливается после окончания очереди
+    'current_speed',     # Ключ speed_settings
+    'min_delay',
+    'max_delay',
+    'target_cpm',        # > 0 — режим целевой скорости (символов в минуту), пресет не действует
+])
+
+class SettingsStore:
+    """
+    Хранилище настроек: current — всегда целый неизменяемый Settings,
+    замена ссылки атомарна, поэтому читателям лок не нужен.
+    Все изменения идут через update()/toggle(): проверка значений,
+    новая версия, публикация одним присваиванием.
+    """
+
+    def __init__(self):
+        min_delay, max_delay = speed_settings['medium']
+        self.current = Settings(
+            version=0,
+            parsing_enabled=True,
+            # CHANGED: память по дефолту = False
+            memory_enabled=False,
+            errors_enabled=False,
+            error_chance=1,
+            custom_delay=0.0,
+            continue_mode=False,
+            current_speed='medium',
+            min_delay=min_delay,
+            max_delay=max_delay,
+            target_cpm=0,
+        )
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _number(value, lo, hi, range_msg):
+        try:
+            valf = float(value)
+        except (TypeError, ValueError):
+            raise ControlError("Неверный формат")
+        # NaN не меньше и не больше ничего — без isfinite прошёл бы проверку диапазона
+        if not math.isfinite(valf) or valf < lo or valf > hi:
+            raise ControlError(range_msg)
+        return valf
+
+    def _validate(self, changes):
+        if 'error_chance' in changes:
+            changes['error_chance'] = self._number(changes['error_chance'], 0, 100, "Значение 0..100")
+        if 'custom_delay' in changes:
+            changes['custom_delay'] = self._number(changes['custom_delay'], 0, 5, "Допустимый диапазон 0..5")
+        if 'current_speed' in changes:
+            spd = changes['current_speed']
+            if not isinstance(spd, str) or spd not in speed_settings:
+                raise ControlError("Неизвестная скорость")
+            changes['min_delay'], changes['max_delay'] = speed_settings[spd]
+        if 'target_cpm' in changes:
+            changes['target_cpm'] = self._number(changes['target_cpm'], 0, 3000, "Цель 0..3000 CPM (0..600 WPM)")
+        for key in changes:
+            if key == 'version' or key not in Settings._fields:
+                raise ControlError(f"Неизвестная настройка: {key}")
+        return changes
+
+    def update(self, **changes):
+        """Проверяет и публикует изменения одним новым снимком. Вернёт его."""
+        with self._lock:
+            changes = self._validate(changes)
+            cur = self.current
+            self.current = cur._replace(version=cur.version + 1, **changes)
+            return self.current
+
+    def toggle(self, field):
+        """Переключает булеву настройку. Вернёт новое значение."""
+        with self._lock:
+            cur = self.current
+            self.current = cur._replace(version=cur.version + 1, **{field: not getattr(cur, field)})
+            return getattr(self.current, field)
+
+class BotController:
+    """
+    Управление ботом внутри процесса. И Flask-маршруты, и хендлеры Telegram
+    зовут эти методы напрямую — без HTTP-запросов к собственному серверу
+    и без второй копии настроек на стороне бота.
+    В asyncio-режиме (loop задан) запуск/остановка печати выполняются в цикле.
+    """
+
+    def __init__(self):
+        self.settings = SettingsStore()
+        # Принудительный парсинг — через эпохи WordIngestor: force_parse() поднимает эпоху,
+        # и каждый клиент Tampermonkey ровно один раз увидит force=true.
+
+        self.typing_thread = None
+        self.typing_task = None       # Задача печати в asyncio-режиме (вместо typing_thread)
+        self.async_wake = None        # asyncio.Event: звонок движку в asyncio-режиме (см. _ring)
+        self.loop = None
+        self.site = None              # С какого сайта последние слова (для SITE_BACKENDS)
+        self.wanted_backend = None    # Бэкенд, на который движок перейдёт на границе слова
+
+    # --- Печать ---
+
+    def use_site(self, site):
+        """Слова пришли с сайта site: выбираем бэкенд нажатий по SITE_BACKENDS."""
+        if not site or site == self.site:
+            return
+        self.site = site
+        backend = backend_for_site(site)
+        if backend is keyboard:
+            return
+        if self.is_typing():
+            self.wanted_backend = backend
+        else:
+            set_backend(backend)
+            log.info("[INFO] %s: бэкенд нажатий %s", site, backend.name)
+
+    def _ring(self):
+        """Будит движок: любое его ожидание (sleep, таймер asyncio, пауза) прерывается."""
+        wake_event.set()
+        if self.async_wake is not None:
+            self.loop.call_soon_threadsafe(self.async_wake.set)
+
+    def is_typing(self):
+        if self.typing_task is not None and not self.typing_task.done():
+            return True
+        return bool(self.typing_thread and self.typing_thread.is_alive())
+
+    def _in_loop(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def start(self):
+        """
+        Запуск печати. Если печать уже идёт — ControlError.
+        Если continue_mode=False, не очищаем очередь, т.к. пользователь может заранее залить слова.
+        """
+        if self.loop is not None:
+            return self._in_loop(self.start_async())
+        if self.is_typing():
+            raise ControlError("Ввод уже запущен")
+        stop_event.clear()
+        pause_event.clear()
+        wake_event.clear()
+        self.typing_thread = threading.Thread(target=type_words_func, daemon=True)
+        self.typing_thread.start()
+
+    def _halt(self):
+        if not self.is_typing():
+            return False
+        t0 = time.perf_counter()
+        stop_event.set()
+        pause_event.clear()
+        self._ring()
+        self.typing_thread.join()
+        metrics.stop_latency.observe(time.perf_counter() - t0)
+        return True
+
+    def stop(self):
+        """Останавливает печать и очищает typed_words."""
+        if self.loop is not None:
+            return self._in_loop(self.stop_async())
+        if not self._halt():
+            raise ControlError("Ввод не идёт")
+        # CHANGED: «очистить из памяти» напечатанное
+        typed_words.clear()
+
+    def _check_pause(self, want_paused):
+        if not self.is_typing():
+            raise ControlError("Ввод не идёт")
+        if pause_event.is_set() == want_paused:
+            raise ControlError("Уже на паузе" if want_paused else "Ввод не на паузе")
+
+    def pause(self):
+        """
+        Замораживает печать на текущем символе: очередь и typed_words не трогаем.
+        Ждёт, пока движок реально встанет, и вернёт задержку в секундах.
+        """
+        if self.loop is not None:
+            return self._in_loop(self.pause_async())
+        self._check_pause(True)
+        t0 = time.perf_counter()
+        pause_event.set()
+        self._ring()
+        paused_ack.wait(1.0)
+        return self._paused(t0)
+
+    def _paused(self, t0):
+        latency = time.perf_counter() - t0
+        metrics.pause_latency.observe(latency)
+        return latency
+
+    def resume(self):
+        """Продолжает печать с того же символа."""
+        self._check_pause(False)
+        pause_event.clear()
+        self._ring()
+
+    def is_paused(self):
+        return pause_event.is_set() and self.is_typing()
+
+    def force_parse(self):
+        """
+        Принудительный парсинг должен работать всегда (даже если печатаем).
+        Для гарантии — останавливаем печать, очищаем очередь, typed_words,
+        поднимаем эпоху (каждый клиент получит force=true и забудется история снимков).
+        Вернёт новую эпоху.
+        """
+        if self.loop is not None:
+            return self._in_loop(self.force_parse_async())
+        self._halt()
+        return self._reset_for_parse()
+
+    def _reset_for_parse(self):
+        clear_word_queues()
+        typed_words.clear()
+        journal.reset()
+        epoch = ingestor.bump_epoch()
+        control_hub.publish()
+        return epoch
+
+    async def start_async(self):
+        if self.is_typing():
+            raise ControlError("Ввод уже запущен")
+        stop_event.clear()
+        pause_event.clear()
+        wake_event.clear()
+        self.async_wake.clear()
+        self.typing_task = asyncio.create_task(type_words_async())
+
+    async def _halt_async(self):
+        if not self.is_typing():
+            return False
+        t0 = time.perf_counter()
+        stop_event.set()
+        pause_event.clear()
+        self._ring()
+        await self.typing_task
+        metrics.stop_latency.observe(time.perf_counter() - t0)
+        return True
+
+    async def pause_async(self):
+        self._check_pause(True)
+        t0 = time.perf_counter()
+        pause_event.set()
+        self._ring()
+        await asyncio.get_running_loop().run_in_executor(None, paused_ack.wait, 1.0)
+        return self._paused(t0)
+
+    async def stop_async(self):
+        if not await self._halt_async():
+            raise ControlError("Ввод не идёт")
+        typed_words.clear()
 
-    # Восстанавливаем раскладку
-    switch_to_layout(original_layout)
-    print("[INFO] Завершение печати.")
+    async def force_parse_async(self):
+        await self._halt_async()
+        return self._reset_for_parse()
+
+    # --- Настройки ---
+
+    def toggle_parsing(self):
+        enabled = self.settings.toggle('parsing_enabled')
+        control_hub.publish()
+        return enabled
+
+    def toggle_memory(self):
+        enabled = self.settings.toggle('memory_enabled')
+        control_hub.publish()
+        return enabled
+
+    def toggle_errors(self):
+        return self.settings.toggle('errors_enabled')
+
+    def toggle_continue(self):
+        enabled = self.settings.toggle('continue_mode')
+        wake_idle_engine()   # Выключили продолжение — простаивающий движок должен выйти
+        return enabled
+
+    def set_error_chance(self, value):
+        return self.settings.update(error_chance=value).error_chance
+
+    def set_custom_delay(self, value):
+        return self.settings.update(custom_delay=value).custom_delay
+
+    def set_speed(self, value):
+        """Пресет скорости; режим целевой скорости при этом выключается."""
+        return self.settings.update(current_speed=value, target_cpm=0).current_speed
+
+    def set_target_speed(self, cpm):
+        """Целевая скорость в CPM (0 — выключить и вернуться к пресету)."""
+        return self.settings.update(target_cpm=cpm).target_cpm
+
+    def set_log_level(self, value):
+        name = str(value or '').strip().upper()
+        if name not in LOG_LEVELS:
+            raise ControlError(f"Уровень логов: {', '.join(LOG_LEVELS)}")
+        log.setLevel(name)
+        log.info("[INFO] Уровень логов: %s", name)
+        return name
+
+    def log_level(self):
+        return logging.getLevelName(log.level)
+
+    def next_log_level(self):
+        """Следующий уровень по кругу (кнопка в Telegram)."""
+        i = LOG_LEVELS.index(self.log_level()) if self.log_level() in LOG_LEVELS else -1
+        return self.set_log_level(LOG_LEVELS[(i + 1) % len(LOG_LEVELS)])
+
+    def speed_status(self):
+        cfg = self.settings.current
+        achieved = rate_control.achieved_cpm() if self.is_typing() else 0.0
+        return {
+            "speed": cfg.current_speed,
+            "target_cpm": cfg.target_cpm,
+            "target_wpm": cfg.target_cpm / CHARS_PER_WORD,
+            "achieved_cpm": round(achieved, 1),
+            "achieved_wpm": round(achieved / CHARS_PER_WORD, 1),
+        }
+
+controller = BotController()
 
 # ----------------- Маршруты Flask -----------------
 
-app.config['JSON_AS_ASCII'] = False
+def create_app(push=True):
+    """
+    Импортирует Flask и собирает приложение со всеми маршрутами (один раз).
+    push=False — без /events и /ws (см. PUSH_HTTP_SERVERS).
+    """
+    global app, request, jsonify, Response
+    if app is not None:
+        return app
+    from flask import Flask, request, jsonify, Response
+    from flask_cors import CORS
+    app = Flask(__name__)
+    app.config['JSON_AS_ASCII'] = False
+    CORS(app)
+    routes.apply(app)
+    if not push:
+        return app
+    push_routes.apply(app)
+    try:
+        from flask_sock import Sock   # Необязательно: без него push-канал только SSE
+    except ImportError:
+        pass
+    else:
+        ws_routes.apply(Sock(app))
+    return app
 
-@app.route('/words', methods=['POST'])
-def route_words():
-    data = request.get_json()
-    if not data or 'words' not in data:
-        return jsonify({"status":"error","message":"Неверные данные, нужен {words: [...]}"}), 400
+def ingest_words(client, data):
+    """
+    Общий приём слов для POST /words и WebSocket-канала.
+    Вернёт (ответ-словарь, HTTP-код).
+    """
+    if not isinstance(data, dict) or 'words' not in data:
+        return {"status":"error","message":"Неверные данные, нужен {words: [...]}"}, 400
     if not isinstance(data['words'], list):
-        return jsonify({"status":"error","message":"words должен быть списком"}), 400
+        return {"status":"error","message":"words должен быть списком"}, 400
 
     new_words = data['words']
-    for w in new_words:
-        words_queue.put(w)
-    print("[FLASK] Получены слова:", new_words)
-    return jsonify({"status":"ok","message":"Слова добавлены в очередь"})
+    if not all(isinstance(w, str) for w in new_words):
+        return {"status":"error","message":"words должен быть списком строк"}, 400
+
+    # Снимок (весь текст страницы) — кладём только то, чего ещё не было от этого клиента.
+    # Вся пачка — одной операцией; если буфер полон, сообщаем, сколько влезло.
+    controller.use_site(str(data.get('site') or ''))
+    skipped, accepted, fresh = ingestor.ingest(client, new_words, bool(data.get('snapshot')))
+    log.debug("[FLASK] Получено слов: %s, повторов: %s, принято: %s", len(new_words), skipped, accepted)
+    if accepted < fresh:
+        return {
+            "status":"error",
+            "message":"Буфер слов заполнен, принята только часть",
+            "accepted":accepted,
+            "skipped":skipped
+        }, 429
+    return {"status":"ok","message":"Слова добавлены в очередь","accepted":accepted,"skipped":skipped}, 200
+
+@routes.route('/words', methods=['POST'])
+def route_words():
+    # Битый JSON или не объект — 400 от ingest_words, а не 500
+    data = request.get_json(silent=True)
+    client = str(data.get('client') or request.remote_addr) if isinstance(data, dict) else request.remote_addr
+    resp, code = ingest_words(client, data)
+    return jsonify(resp), code
 
-@app.route('/start', methods=['POST'])
+@routes.errorhandler(ControlError)
+def handle_control_error(e):
+    return jsonify({"status":"error","message":str(e)}),400
+
+@routes.route('/start', methods=['POST'])
 def route_start():
     """
     Запуск печати. Если поток уже идёт — ошибка.
-    Если поток не идёт и force_parse включён/выключен — это не важно, просто стартуем.
+    Если поток не идёт и force_parse был/не был — это не важно, просто стартуем.
     Если continue_mode=False, не очищаем очередь, т.к. пользователь может заранее залить слова.
     
     # CHANGED: по условию «При /start удалять раскладку в телеграмме и создавать заново» — 
     # это касается не Flask, а самого хендлера /start в боте. 
     """
-    global typing_thread
-    if typing_thread and typing_thread.is_alive():
-        return jsonify({"status":"error","message":"Ввод уже запущен"}),400
-
-    stop_event.clear()
-    typing_thread = threading.Thread(target=type_words_func, daemon=True)
-    typing_thread.start()
+    controller.start()
     return jsonify({"status":"ok","message":"Ввод запущен"})
 
-@app.route('/stop', methods=['POST'])
+@routes.route('/stop', methods=['POST'])
 def route_stop():
-    if typing_thread and typing_thread.is_alive():
-        stop_event.set()
-        typing_thread.join()
-        # CHANGED: «очистить из памяти» напечатанное
-        typed_words.clear()
-        return jsonify({"status":"ok","message":"Ввод остановлен и typed_words очищены"})
-    else:
-        return jsonify({"status":"error","message":"Ввод не идёт"}),400
+    controller.stop()
+    return jsonify({"status":"ok","message":"Ввод остановлен и typed_words очищены"})
+
+@routes.route('/pause', methods=['POST'])
+def route_pause():
+    """Пауза на текущем символе; latency_ms — через сколько движок реально встал."""
+    latency = controller.pause()
+    return jsonify({"status":"ok","message":"Ввод на паузе","latency_ms":round(latency * 1000, 1)})
 
-@app.route('/typed', methods=['GET'])
+@routes.route('/resume', methods=['POST'])
+def route_resume():
+    controller.resume()
+    return jsonify({"status":"ok","message":"Ввод продолжен"})
+
+@routes.route('/typed', methods=['GET'])
 def route_typed():
-    return jsonify({"typed_words": typed_words})
+    """
+    Набранные слова постранично: ?since=<seq>&limit=<n>.
+    Без since — последние limit слов. В ответе next — курсор для следующего запроса,
+    dropped — сколько слов после since уже вытеснено из кольцевого буфера.
+    """
+    try:
+        limit = int(request.args.get('limit', TYPED_PAGE_MAX))
+        since = request.args.get('since')
+        since = int(since) if since is not None else max(typed_words.next_seq - limit, 0)
+    except ValueError:
+        raise ControlError("Неверный формат")
+    if since < 0:
+        raise ControlError("since не может быть отрицательным")
+    limit = min(max(limit, 0), TYPED_PAGE_MAX)
+    words, first, nxt, dropped = typed_words.since(since, limit)
+    return jsonify({"typed_words": words, "first": first, "next": nxt, "dropped": dropped})
 
 # --- АВТОПАРСИНГ & FORCE PARSE ---
 
-@app.route('/toggle_parsing', methods=['POST'])
+@routes.route('/toggle_parsing', methods=['POST'])
 def route_toggle_parsing():
-    global parsing_enabled
-    parsing_enabled = not parsing_enabled
-    return jsonify({"status":"ok","parsing_enabled": parsing_enabled})
+    return jsonify({"status":"ok","parsing_enabled": controller.toggle_parsing()})
 
-@app.route('/parsing_status', methods=['GET'])
+@routes.route('/parsing_status', methods=['GET'])
 def route_parsing_status():
-    global force_parse
-    resp = {
-        "enabled": parsing_enabled,
-        "force": force_parse,
-        "memory_enabled": memory_enabled
-    }
-    # После одного запроса force_parse сбросим
-    if force_parse:
-        force_parse = False
-    return jsonify(resp)
+    # Запасной вариант для клиентов без push-канала (/ws, /events)
+    client = request.args.get('client') or request.remote_addr
+    return jsonify(control_state(client))
 
-@app.route('/force_parse', methods=['POST'])
+@routes.route('/force_parse', methods=['POST'])
 def route_force_parse():
-    """
-    Принудительный парсинг должен работать всегда (даже если печатаем).
-    Для гарантии — останавливаем печать, очищаем очередь, typed_words,
-    ставим force_parse = True.
-    """
-    global force_parse
-    # Останавливаем печать, если идёт
-    if typing_thread and typing_thread.is_alive():
-        stop_event.set()
-        typing_thread.join()
-
-    with words_queue.mutex:
-        words_queue.queue.clear()
-    typed_words.clear()
-
-    force_parse = True
-    return jsonify({"status":"ok","message":"force_parse=true. Очередь и typed_words очищены."})
+    """Принудительный парсинг: см. BotController.force_parse."""
+    epoch = controller.force_parse()
+    return jsonify({"status":"ok","message":"force_parse=true. Очередь и typed_words очищены.","epoch":epoch})
 
-@app.route('/toggle_memory', methods=['POST'])
+@routes.route('/toggle_memory', methods=['POST'])
 def route_toggle_memory():
-    global memory_enabled
-    memory_enabled = not memory_enabled
-    return jsonify({"status":"ok","memory_enabled": memory_enabled})
+    return jsonify({"status":"ok","memory_enabled": controller.toggle_memory()})
 
 # --- ПРОЧИЕ НАСТРОЙКИ (ошибки, задержка, скорость, continue_mode) ---
 
-@app.route('/set_error_chance', methods=['POST'])
+@routes.route('/set_error_chance', methods=['POST'])
 def route_set_error_chance():
-    global error_chance
-    data = request.get_json() or {}
-    val = data.get('value')
-    try:
-        valf = float(val)
-        if valf < 0 or valf > 100:
-            return jsonify({"status":"error","message":"Значение 0..100"}),400
-        error_chance = valf
-        return jsonify({"status":"ok","error_chance":error_chance})
-    except:
-        return jsonify({"status":"error","message":"Неверный формат"}),400
-
-@app.route('/set_custom_delay', methods=['POST'])
+    data = request.get_json(silent=True) or {}
+    return jsonify({"status":"ok","error_chance":controller.set_error_chance(data.get('value'))})
+
+@routes.route('/set_custom_delay', methods=['POST'])
 def route_set_custom_delay():
-    global custom_delay
-    data = request.get_json() or {}
-    val = data.get('value')
-    try:
-        valf = float(val)
-        if valf<0 or valf>5:
-            return jsonify({"status":"error","message":"Допустимый диапазон 0..5"}),400
-        custom_delay = valf
-        return jsonify({"status":"ok","custom_delay":custom_delay})
-    except:
-        return jsonify({"status":"error","message":"Неверный формат"}),400
-
-@app.route('/set_speed', methods=['POST'])
+    data = request.get_json(silent=True) or {}
+    return jsonify({"status":"ok","custom_delay":controller.set_custom_delay(data.get('value'))})
+
+@routes.route('/set_speed', methods=['POST'])
 def route_set_speed():
-    global current_speed, min_delay, max_delay
-    data = request.get_json() or {}
-    val = data.get('value')
-    if val not in speed_settings:
-        return jsonify({"status":"error","message":"Неизвестная скорость"}),400
-    with speed_lock:
-        current_speed = val
-        m1,m2 = speed_settings[val]
-        min_delay, max_delay = m1, m2
-    return jsonify({"status":"ok","speed":current_speed})
-
-@app.route('/toggle_continue', methods=['POST'])
+    """
+    {"value": "medium"} — пресет из speed_settings;
+    {"wpm": 80} или {"cpm": 400} — целевая скорость с подстройкой по факту (0 — выключить).
+    """
+    data = request.get_json(silent=True) or {}
+    if 'wpm' in data or 'cpm' in data:
+        try:
+            cpm = float(data['cpm']) if 'cpm' in data else float(data['wpm']) * CHARS_PER_WORD
+        except (TypeError, ValueError):
+            raise ControlError("Неверный формат")
+        controller.set_target_speed(cpm)
+    else:
+        controller.set_speed(data.get('value'))
+    return jsonify({"status":"ok", **controller.speed_status()})
+
+@routes.route('/metrics', methods=['GET'])
+def route_metrics():
+    """Метрики конвейера в текстовом формате Prometheus."""
+    return Response(metrics.render_prometheus(), mimetype='text/plain; version=0.0.4')
+
+@routes.route('/speed', methods=['GET'])
+def route_speed():
+    """Текущая скорость: пресет/цель и фактическая скорость по последним нажатиям."""
+    return jsonify(controller.speed_status())
+
+@routes.route('/toggle_continue', methods=['POST'])
 def route_toggle_continue():
-    global continue_mode
-    continue_mode = not continue_mode
-    return jsonify({"status":"ok","continue_mode":continue_mode})
+    return jsonify({"status":"ok","continue_mode":controller.toggle_continue()})
+
+@routes.route('/set_log_level', methods=['POST'])
+def route_set_log_level():
+    """{"value": "DEBUG"} — один из LOG_LEVELS (DEBUG пишет каждое слово и раскладку)."""
+    data = request.get_json(silent=True) or {}
+    return jsonify({"status":"ok","log_level":controller.set_log_level(data.get('value'))})
+
+# ----------------- Push-канал (WebSocket / SSE) -----------------
+
+class ControlHub:
+    """
+    Рассылка «настройки парсинга изменились» всем подключённым клиентам.
+    У каждого подписчика своя очередь; само состояние каждый канал собирает
+    для своего клиента через control_state() — у force своя эпоха на клиента.
+    Подписчик из asyncio-режима передаёт свой loop и получает asyncio.Queue.
+    """
+
+    def __init__(self):
+        self._subs = {}   # очередь -> loop (None для обычных потоков)
+        self._lock = threading.Lock()
+
+    def subscribe(self, loop=None):
+        q = asyncio.Queue() if loop else queue.Queue()
+        with self._lock:
+            self._subs[q] = loop
+        return q
+
+    def unsubscribe(self, q):
+        with self._lock:
+            self._subs.pop(q, None)
+
+    def publish(self):
+        with self._lock:
+            subs = list(self._subs.items())
+        for q, loop in subs:
+            if loop:
+                loop.call_soon_threadsafe(q.put_nowait, True)
+            else:
+                q.put_nowait(True)
+
+control_hub = ControlHub()
+
+def control_state(client):
+    """
+    Состояние парсинга для клиента Tampermonkey.
+    force = true ровно один раз для каждого клиента после /force_parse.
+    """
+    cfg = controller.settings.current
+    return {
+        "type": "control",
+        "enabled": cfg.parsing_enabled,
+        "force": ingestor.poll_force(client),
+        "epoch": ingestor.epoch,
+        "memory_enabled": cfg.memory_enabled
+    }
+
+@push_routes.route('/events', methods=['GET'])
+def route_events():
+    """SSE: сразу текущее состояние, дальше — каждое изменение (и пинг раз в 15 с)."""
+    client = request.args.get('client') or request.remote_addr
+    sub = control_hub.subscribe()
+
+    def stream():
+        try:
+            yield f"data: {json.dumps(control_state(client))}\n\n"
+            while True:
+                try:
+                    sub.get(timeout=15)
+                except queue.Empty:
+                    yield ": ping\n\n"
+                    continue
+                yield f"data: {json.dumps(control_state(client))}\n\n"
+        finally:
+            control_hub.unsubscribe(sub)
+
+    return Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+def parse_ws_frame(raw):
+    """
+    Кадр WebSocket-канала -> (сообщение, None) или (None, ack с ошибкой):
+    битый кадр не должен ронять канал — клиент получает ack с code 400.
+    """
+    try:
+        msg = json.loads(raw)
+    except (TypeError, ValueError):
+        return None, {"type": "ack", "id": None, "code": 400, "status": "error", "message": "Кадр не JSON"}
+    if not isinstance(msg, dict):
+        return None, {"type": "ack", "id": None, "code": 400, "status": "error",
+                      "message": "Кадр должен быть JSON-объектом"}
+    return msg, None
+
+# Регистрируется, только если установлен flask_sock и сервер держит push-каналы (см. create_app)
+@ws_routes.route('/ws')
+def ws_channel(ws):
+    """
+    WebSocket: сервер пушит {"type":"control",...} при каждом изменении,
+    клиент шлёт {"type":"words","id":..,"words":[..],"snapshot":..},
+    в ответ — {"type":"ack","id":..,"accepted":..,"skipped":..}.
+    """
+    client = request.args.get('client') or request.remote_addr
+    sub = control_hub.subscribe()
+    send_lock = threading.Lock()
+    closed = threading.Event()
+
+    def send(obj):
+        with send_lock:
+            ws.send(json.dumps(obj, ensure_ascii=False))
+
+    def pusher():
+        while not closed.is_set():
+            try:
+                sub.get(timeout=1)
+            except queue.Empty:
+                continue
+            try:
+                send(control_state(client))
+            except Exception:
+                break
+
+    send(control_state(client))
+    threading.Thread(target=pusher, daemon=True).start()
+    try:
+        while True:
+            msg, error = parse_ws_frame(ws.receive())
+            if error:
+                send(error)
+            elif msg.get('type') == 'words':
+                resp, code = ingest_words(client, msg)
+                send({"type": "ack", "id": msg.get('id'), "code": code, **resp})
+    finally:
+        closed.set()
+        control_hub.unsubscribe(sub)
 
 # ----------------- Telegram-бот -----------------
 
-TOKEN = ''
-bot = telebot.TeleBot(TOKEN)
+TOKEN = ''   # Или переменная окружения TYPINGBOT_TOKEN / ключ --token
 AUTHORIZED_USER_ID = 123
 
+# Адрес Bot API ('' — api.telegram.org), например http://127.0.0.1:8081 —
+# локальный Bot API-сервер или заглушка для проверки. Или ключ --api-url.
+TELEGRAM_API_URL = ''
+
+# Живой статус печати: правка сообщения не чаще раза в PROGRESS_INTERVAL секунд
+# на чат (Telegram режет частые правки — около одной в секунду на чат)
+PROGRESS_INTERVAL = 1.5
+
+handlers = Deferred()   # Хендлеры бота (bot.message_handler / bot.callback_query_handler)
+bot = None              # telebot.TeleBot, см. create_bot()
+types = None            # telebot.types, заполняет create_bot()
+
+def create_bot(token, api_url=TELEGRAM_API_URL):
+    """Импортирует telebot и создаёт бота со всеми хендлерами."""
+    global bot, types
+    import telebot
+    from telebot import types
+    if api_url:
+        telebot.apihelper.API_URL = api_url.rstrip('/') + '/bot{0}/{1}'
+    bot = handlers.apply(telebot.TeleBot(token))
+    progress.start()
+    return bot
+
+def telegram_retry_after(e):
+    """Сколько секунд Telegram просит подождать (ответ 429), иначе None."""
+    if getattr(e, 'error_code', None) != 429:
+        return None
+    params = (getattr(e, 'result_json', None) or {}).get('parameters') or {}
+    return float(params.get('retry_after', 1))
+
+def render_progress():
+    """Текст живого статуса: слова, очередь, скорость, время."""
+    running = controller.is_typing()
+    if running:
+        state = "на паузе" if controller.is_paused() else "идёт"
+        cpm = rate_control.achieved_cpm()
+    else:
+        state = "завершена"
+        cpm = metrics.session_rates()[1] * 60
+    elapsed = int(metrics.session_elapsed())
+    return "\n".join((
+        f"Печать {state}",
+        f"Слов: {metrics.words_typed.value - metrics.session_words}",
+        f"Очередь: {len(words_buffer) + plans_queue.qsize()}",
+        f"Скорость: {cpm / CHARS_PER_WORD:.0f} WPM",
+        f"Время: {elapsed // 60:02d}:{elapsed % 60:02d}",
+    ))
+
+class ProgressPublisher:
+    """
+    Живой статус печати в подписанных чатах: одно сообщение на сессию, дальше — правки.
+    Движок только «пинает» publisher (начало/конец печати), сам текст раз в
+    PROGRESS_INTERVAL собирает фоновый поток — все слова за интервал сливаются
+    в одну правку. Неизменившийся текст не отправляется, на 429 чат ждёт retry_after.
+    Без печати поток спит на событии и ничего не делает.
+    """
+
+    def __init__(self, interval=PROGRESS_INTERVAL):
+        self.interval = interval
+        self._chats = {}   # chat_id -> [message_id, последний текст, не раньше (monotonic)]
+        self._lock = threading.Lock()
+        self._kick = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def kick(self):
+        self._kick.set()
+
+    def toggle(self, chat_id):
+        """Подписывает чат на статус или отписывает. Вернёт True, если теперь подписан."""
+        with self._lock:
+            if self._chats.pop(chat_id, None) is not None:
+                return False
+            self._chats[chat_id] = [None, None, 0.0]
+        self.kick()
+        return True
+
+    def watch(self, chat_id):
+        with self._lock:
+            self._chats.setdefault(chat_id, [None, None, 0.0])
+
+    def _run(self):
+        while True:
+            self._kick.wait()
+            self._kick.clear()
+            with self._lock:
+                if not self._chats:
+                    continue
+            # Сессия идёт: раз в interval (или по пинку) раздаём текущий текст
+            while True:
+                running = controller.is_typing()
+                self._publish(render_progress(), final=not running)
+                if not running:
+                    break
+                self._kick.wait(self.interval)
+                self._kick.clear()
+            # Следующая печать — новое сообщение
+            with self._lock:
+                for state in self._chats.values():
+                    state[0] = state[1] = None
+
+    def _publish(self, text, final):
+        with self._lock:
+            chats = list(self._chats.items())
+        for chat_id, state in chats:
+            message_id, last, not_before = state
+            if text == last or (final and message_id is None):
+                continue   # Не изменилось / печать кончилась, а статуса в этом чате не было
+            wait = not_before - time.monotonic()
+            if wait > 0:
+                if not final:
+                    continue   # Правка уже была недавно — этот текст сольётся со следующим
+                time.sleep(wait)   # Итог отправляем всегда, дождавшись лимита
+            try:
+                if message_id is None:
+                    state[0] = bot.send_message(chat_id, text).message_id
+                else:
+                    bot.edit_message_text(text, chat_id=chat_id, message_id=message_id)
+                state[1] = text
+                state[2] = time.monotonic() + self.interval
+            except Exception as e:
+                retry = telegram_retry_after(e)
+                if retry is not None:
+                    state[2] = time.monotonic() + retry
+                elif 'message is not modified' in str(e):
+                    state[1] = text
+                else:
+                    log.warning("[WARN] Статус в Telegram (%s): %s", chat_id, e)
+
+progress = ProgressPublisher()
+
 def is_auth(uid):
     return uid == AUTHORIZED_USER_ID
 
 def typing_is_running():
-    return typing_thread and typing_thread.is_alive()
+    return controller.is_typing()
 
 def get_settings_text():
+    c = controller.settings.current
     lines = []
-    lines.append(f"Парсинг (авто): {'ВКЛ' if parsing_enabled else 'ВЫКЛ'}")
-    lines.append(f"Принудительный парсинг: force_parse={force_parse}")
-    lines.append(f"Запоминание (memory): {'ВКЛ' if memory_enabled else 'ВЫКЛ'}")
-    lines.append(f"Ошибки: {'ВКЛ' if errors_enabled else 'ВЫКЛ'} (шанс={error_chance}%)")
-    lines.append(f"Доп. задержка: {custom_delay} c.")
-    lines.append(f"Скорость: {current_speed}")
-    lines.append(f"Режим продолжения: {'ВКЛ' if continue_mode else 'ВЫКЛ'}")
-    lines.append(f"Ввод идёт: {'ДА' if typing_is_running() else 'НЕТ'}")
+    lines.append(f"Парсинг (авто): {'ВКЛ' if c.parsing_enabled else 'ВЫКЛ'}")
+    lines.append(f"Принудительный парсинг: эпоха={ingestor.epoch}")
+    lines.append(f"Запоминание (memory): {'ВКЛ' if c.memory_enabled else 'ВЫКЛ'}")
+    lines.append(f"Ошибки: {'ВКЛ' if c.errors_enabled else 'ВЫКЛ'} (шанс={c.error_chance}%)")
+    lines.append(f"Доп. задержка: {c.custom_delay} c.")
+    lines.append(f"Скорость: {speed_label(c)}")
+    if c.target_cpm and typing_is_running():
+        lines.append(f"Факт. скорость: {rate_control.achieved_cpm() / CHARS_PER_WORD:.0f} WPM")
+    lines.append(f"Режим продолжения: {'ВКЛ' if c.continue_mode else 'ВЫКЛ'}")
+    lines.append(f"Логи: {controller.log_level()}")
+    lines.append(f"Ввод идёт: {'ДА' if typing_is_running() else 'НЕТ'}"
+                 f"{' (пауза)' if controller.is_paused() else ''}")
     return "\n".join(lines)
 
 def build_main_menu():
+    c = controller.settings.current
     markup = types.InlineKeyboardMarkup(row_width=2)
 
     btn_toggle_parsing = types.InlineKeyboardButton(
-        text=f"Парсинг: {'ВЫКЛ' if parsing_enabled else 'ВКЛ'}",
+        text=f"Парсинг: {'ВЫКЛ' if c.parsing_enabled else 'ВКЛ'}",
         callback_data="toggle_parsing"
     )
     btn_force_parse = types.InlineKeyboardButton(
@@ -420,15 +2701,15 @@ def build_main_menu():
         callback_data="force_parse"
     )
     btn_memory = types.InlineKeyboardButton(
-        text=f"Память: {'ВЫКЛ' if memory_enabled else 'ВКЛ'}",
+        text=f"Память: {'ВЫКЛ' if c.memory_enabled else 'ВКЛ'}",
         callback_data="toggle_memory"
     )
     btn_errors = types.InlineKeyboardButton(
-        text=f"Ошибки: {'ВЫКЛ' if errors_enabled else 'ВКЛ'}",
+        text=f"Ошибки: {'ВЫКЛ' if c.errors_enabled else 'ВКЛ'}",
         callback_data="toggle_errors"
     )
     btn_continue = types.InlineKeyboardButton(
-        text=f"Продолж: {'ВЫКЛ' if continue_mode else 'ВКЛ'}",
+        text=f"Продолж: {'ВЫКЛ' if c.continue_mode else 'ВКЛ'}",
         callback_data="toggle_continue"
     )
     btn_show_typed = types.InlineKeyboardButton(
@@ -443,8 +2724,20 @@ def build_main_menu():
         text="Доп. задержка",
         callback_data="set_custom_delay"
     )
+    btn_metrics = types.InlineKeyboardButton(
+        text="Метрики",
+        callback_data="show_metrics"
+    )
+    btn_log_level = types.InlineKeyboardButton(
+        text=f"Логи: {controller.log_level()}",
+        callback_data="next_log_level"
+    )
+    btn_pause = types.InlineKeyboardButton(
+        text="Продолжить" if controller.is_paused() else "Пауза",
+        callback_data="toggle_pause"
+    )
     btn_speed = types.InlineKeyboardButton(
-        text=f"Скорость: {current_speed}",
+        text=f"Скорость: {speed_label(c)}",
         callback_data="show_speed_menu"
     )
 
@@ -453,7 +2746,8 @@ def build_main_menu():
     markup.add(btn_memory, btn_errors)
     markup.add(btn_continue, btn_show_typed)
     markup.add(btn_err_chance, btn_delay)
-    markup.add(btn_speed)
+    markup.add(btn_speed, btn_metrics)
+    markup.add(btn_pause, btn_log_level)
 
     return markup
 
@@ -466,11 +2760,24 @@ def build_speed_menu():
                 callback_data="speed_" + spd
             )
         )
+    markup.add(
+        types.InlineKeyboardButton(
+            text="Цель WPM/CPM",
+            callback_data="set_target_speed"
+        )
+    )
     return markup
 
+_menu_shown = {}   # (chat_id, message_id) -> (текст, разметка), что сейчас на экране
+
 def redraw_menu(call):
     txt = get_settings_text()
     mk = build_main_menu()
+    # Ничего не поменялось (например, повторное нажатие) — правка не нужна
+    key = (call.message.chat.id, call.message.message_id)
+    shown = (txt, mk.to_json())
+    if _menu_shown.get(key) == shown:
+        return
     bot.edit_message_text(
         text=f"<b>Текущие настройки</b>:\n{txt}",
         chat_id=call.message.chat.id,
@@ -478,10 +2785,14 @@ def redraw_menu(call):
         parse_mode='HTML',
         reply_markup=mk
     )
+    # Запоминаем только после удачной правки: иначе после 429/обрыва меню так и осталось бы старым
+    if len(_menu_shown) > 256:
+        _menu_shown.clear()
+    _menu_shown[key] = shown
 
 # ----------------- Bot commands -----------------
 
-@bot.message_handler(commands=['start'])
+@handlers.message_handler(commands=['start'])
 def cmd_start(message):
     """Команда /start: приветствие + пересоздание меню."""
     if not is_auth(message.from_user.id):
@@ -494,6 +2805,8 @@ def cmd_start(message):
             "Доступные команды:\n"
             "/starttyping — начать ввод\n"
             "/stopping — остановить\n"
+            "/pause, /resume — пауза и продолжение\n"
+            "/progress — живой статус печати в этом чате (вкл/выкл)\n"
             "/menu — показать настройки\n")
     bot.send_message(message.chat.id, text)
 
@@ -507,14 +2820,14 @@ def cmd_start(message):
         reply_markup=mk
     )
 
-@bot.message_handler(commands=['starttyping'])
+@handlers.message_handler(commands=['starttyping'])
 def cmd_starttyping(message):
     if not is_auth(message.from_user.id):
         return bot.reply_to(message, "Нет доступа.")
     try:
-        r = requests.post("http://127.0.0.1:5000/start")
-        j = r.json()
-        bot.reply_to(message, f"Сервер: {j}")
+        progress.watch(message.chat.id)
+        controller.start()
+        bot.reply_to(message, "Ввод запущен")
         # Обновляем меню
         txt = get_settings_text()
         mk = build_main_menu()
@@ -527,14 +2840,13 @@ def cmd_starttyping(message):
     except Exception as e:
         bot.reply_to(message, f"Ошибка: {e}")
 
-@bot.message_handler(commands=['stopping'])
+@handlers.message_handler(commands=['stopping'])
 def cmd_stopping(message):
     if not is_auth(message.from_user.id):
         return bot.reply_to(message, "Нет доступа.")
     try:
-        r = requests.post("http://127.0.0.1:5000/stop")
-        j = r.json()
-        bot.reply_to(message, f"Сервер: {j}")
+        controller.stop()
+        bot.reply_to(message, "Ввод остановлен и typed_words очищены")
         # Обновляем меню
         txt = get_settings_text()
         mk = build_main_menu()
@@ -547,7 +2859,30 @@ def cmd_stopping(message):
     except Exception as e:
         bot.reply_to(message, f"Ошибка: {e}")
 
-@bot.message_handler(commands=['menu'])
+@handlers.message_handler(commands=['pause', 'resume'])
+def cmd_pause_resume(message):
+    if not is_auth(message.from_user.id):
+        return bot.reply_to(message, "Нет доступа.")
+    try:
+        if message.text.lstrip('/').startswith('pause'):
+            latency = controller.pause()
+            bot.reply_to(message, f"Пауза ({latency * 1000:.0f} мс)")
+        else:
+            controller.resume()
+            bot.reply_to(message, "Продолжаем")
+    except ControlError as e:
+        bot.reply_to(message, f"Ошибка: {e}")
+
+@handlers.message_handler(commands=['progress'])
+def cmd_progress(message):
+    if not is_auth(message.from_user.id):
+        return bot.reply_to(message, "Нет доступа.")
+    if progress.toggle(message.chat.id):
+        bot.reply_to(message, "Живой статус печати включён")
+    else:
+        bot.reply_to(message, "Живой статус печати выключен")
+
+@handlers.message_handler(commands=['menu'])
 def cmd_menu(message):
     if not is_auth(message.from_user.id):
         return bot.reply_to(message, "Нет доступа.")
@@ -562,89 +2897,66 @@ def cmd_menu(message):
 
 # ----------------- Инлайн-кнопки -----------------
 
-@bot.callback_query_handler(func=lambda call: True)
+@handlers.callback_query_handler(func=lambda call: True)
 def cb_inline(call):
-    global parsing_enabled, force_parse, memory_enabled
-    global errors_enabled, error_chance, custom_delay, continue_mode
-    global current_speed, min_delay, max_delay
-
     if not is_auth(call.from_user.id):
         bot.answer_callback_query(call.id, "Нет доступа")
         return
 
     if call.data == 'toggle_parsing':
-        try:
-            rr = requests.post("http://127.0.0.1:5000/toggle_parsing")
-            if rr.status_code == 200:
-                j = rr.json()
-                parsing_enabled = j.get('parsing_enabled', True)
-                bot.answer_callback_query(call.id, f"Парсинг={parsing_enabled}")
-            else:
-                bot.answer_callback_query(call.id, "Ошибка toggle_parsing")
-        except:
-            bot.answer_callback_query(call.id, "Сетевая ошибка toggle_parsing")
+        enabled = controller.toggle_parsing()
+        bot.answer_callback_query(call.id, f"Парсинг={enabled}")
         redraw_menu(call)
 
     elif call.data == 'force_parse':
-        try:
-            rr = requests.post("http://127.0.0.1:5000/force_parse")
-            if rr.status_code == 200:
-                j = rr.json()
-                bot.answer_callback_query(call.id, f"Принудительный парсинг: {j}")
-            else:
-                bot.answer_callback_query(call.id, "Ошибка force_parse")
-        except:
-            bot.answer_callback_query(call.id, "Сетевая ошибка force_parse")
+        epoch = controller.force_parse()
+        bot.answer_callback_query(call.id, f"Принудительный парсинг: очередь и typed_words очищены (эпоха {epoch})")
         redraw_menu(call)
 
     elif call.data == 'toggle_memory':
-        try:
-            rr = requests.post("http://127.0.0.1:5000/toggle_memory")
-            if rr.status_code == 200:
-                j = rr.json()
-                memory_enabled = j.get('memory_enabled', True)
-                bot.answer_callback_query(call.id, f"memory_enabled={memory_enabled}")
-            else:
-                bot.answer_callback_query(call.id, "Ошибка toggle_memory")
-        except:
-            bot.answer_callback_query(call.id, "Сетевая ошибка toggle_memory")
+        enabled = controller.toggle_memory()
+        bot.answer_callback_query(call.id, f"memory_enabled={enabled}")
         redraw_menu(call)
 
     elif call.data == 'toggle_errors':
-        errors_enabled = not errors_enabled
-        bot.answer_callback_query(call.id, f"Ошибки={'ВКЛ' if errors_enabled else 'ВЫКЛ'}")
+        enabled = controller.toggle_errors()
+        bot.answer_callback_query(call.id, f"Ошибки={'ВКЛ' if enabled else 'ВЫКЛ'}")
         redraw_menu(call)
 
     elif call.data == 'toggle_continue':
+        enabled = controller.toggle_continue()
+        bot.answer_callback_query(call.id, f"continue_mode={enabled}")
+        redraw_menu(call)
+
+    elif call.data == 'toggle_pause':
         try:
-            rr = requests.post("http://127.0.0.1:5000/toggle_continue")
-            if rr.status_code==200:
-                j = rr.json()
-                continue_mode = j.get('continue_mode', False)
-                bot.answer_callback_query(call.id, f"continue_mode={continue_mode}")
+            if controller.is_paused():
+                controller.resume()
+                bot.answer_callback_query(call.id, "Продолжаем")
             else:
-                bot.answer_callback_query(call.id, "Ошибка toggle_continue")
-        except:
-            bot.answer_callback_query(call.id, "Сетевая ошибка toggle_continue")
+                latency = controller.pause()
+                bot.answer_callback_query(call.id, f"Пауза ({latency * 1000:.0f} мс)")
+        except ControlError as e:
+            bot.answer_callback_query(call.id, str(e))
+        redraw_menu(call)
+
+    elif call.data == 'next_log_level':
+        level = controller.next_log_level()
+        bot.answer_callback_query(call.id, f"Логи: {level}")
         redraw_menu(call)
 
     elif call.data == 'show_typed':
-        try:
-            r = requests.get("http://127.0.0.1:5000/typed")
-            if r.status_code == 200:
-                d = r.json()
-                tw = d.get('typed_words', [])
-                if tw:
-                    tail = tw[-20:]
-                    joined = "\n".join(tail)
-                    bot.answer_callback_query(call.id, "Вот что набрано в последнее время:")
-                    bot.send_message(call.message.chat.id, joined)
-                else:
-                    bot.answer_callback_query(call.id, "Пока ничего не набрано.")
-            else:
-                bot.answer_callback_query(call.id, "Ошибка /typed")
-        except Exception as e:
-            bot.answer_callback_query(call.id, f"Сетевая ошибка /typed: {e}")
+        tail = typed_words.tail(20)
+        if tail:
+            joined = "\n".join(tail)
+            bot.answer_callback_query(call.id, "Вот что набрано в последнее время:")
+            bot.send_message(call.message.chat.id, joined)
+        else:
+            bot.answer_callback_query(call.id, "Пока ничего не набрано.")
+
+    elif call.data == 'show_metrics':
+        bot.answer_callback_query(call.id)
+        bot.send_message(call.message.chat.id, metrics.summary_text())
 
     elif call.data == 'set_error_chance':
         bot.answer_callback_query(call.id, "Пришлите шанс ошибки (0..100) в чат.")
@@ -664,82 +2976,414 @@ def cb_inline(call):
 
     elif call.data == 'show_speed_menu':
         sm = build_speed_menu()
+        # Сообщение больше не главное меню — следующий redraw_menu обязан его перерисовать
+        _menu_shown.pop((call.message.chat.id, call.message.message_id), None)
         bot.edit_message_text(
             chat_id=call.message.chat.id,
             message_id=call.message.message_id,
-            text=f"Выберите скорость (текущая: {current_speed}):",
+            text=f"Выберите скорость (текущая: {speed_label(controller.settings.current)}):",
             reply_markup=sm
         )
 
+    elif call.data == 'set_target_speed':
+        bot.answer_callback_query(call.id, "Пришлите целевую скорость в чат.")
+        msg = bot.send_message(
+            call.message.chat.id,
+            "Введите целевую скорость: число = WPM (например 80), "
+            "с суффиксом cpm = символов в минуту (например 400cpm), 0 — выключить:"
+        )
+        bot.register_next_step_handler(msg, process_target_speed_input)
+
     elif call.data.startswith('speed_'):
         spd = call.data.split('_',1)[1]
-        if spd in speed_settings:
-            try:
-                rr = requests.post("http://127.0.0.1:5000/set_speed", json={"value":spd})
-                if rr.status_code==200:
-                    j = rr.json()
-                    current_speed = j.get('speed','medium')
-                    with speed_lock:
-                        m1,m2 = speed_settings[current_speed]
-                        min_delay, max_delay = m1,m2
-                    bot.answer_callback_query(call.id, f"Скорость установлена: {current_speed}")
-                else:
-                    bot.answer_callback_query(call.id, "Ошибка set_speed")
-            except Exception as e:
-                bot.answer_callback_query(call.id, f"Сетевая ошибка: {e}")
-        else:
-            bot.answer_callback_query(call.id, "Неизвестная скорость")
+        try:
+            controller.set_speed(spd)
+            bot.answer_callback_query(call.id, f"Скорость установлена: {spd}")
+        except ControlError as e:
+            bot.answer_callback_query(call.id, str(e))
         redraw_menu(call)
 
 def process_error_chance_input(message):
     if not is_auth(message.from_user.id):
         return bot.reply_to(message, "Нет доступа.")
-    valstr = message.text.strip()
     try:
-        valf = float(valstr)
-    except:
-        return bot.reply_to(message, "Ошибка: введите число 0..100.")
+        val = controller.set_error_chance(message.text.strip())
+    except ControlError as e:
+        return bot.reply_to(message, f"Ошибка: {e}")
+    bot.reply_to(message, f"Шанс ошибки: {val}%")
 
+def process_target_speed_input(message):
+    if not is_auth(message.from_user.id):
+        return bot.reply_to(message, "Нет доступа.")
     try:
-        rr = requests.post("http://127.0.0.1:5000/set_error_chance", json={"value":valf})
-        if rr.status_code==200:
-            j = rr.json()
-            global error_chance
-            error_chance = j.get('error_chance', 1)
-            bot.reply_to(message, f"Шанс ошибки: {error_chance}%")
-        else:
-            bot.reply_to(message, f"Ошибка: {rr.text}")
-    except Exception as e:
-        bot.reply_to(message, f"Сетевая ошибка: {e}")
+        cpm = controller.set_target_speed(parse_target_speed(message.text))
+    except ValueError:
+        return bot.reply_to(message, "Ошибка: введите число, например 80 или 400cpm.")
+    except ControlError as e:
+        return bot.reply_to(message, f"Ошибка: {e}")
+    if cpm:
+        bot.reply_to(message, f"Целевая скорость: {cpm / CHARS_PER_WORD:g} WPM ({cpm:g} CPM)")
+    else:
+        bot.reply_to(message, "Целевая скорость выключена, работает пресет.")
 
 def process_custom_delay_input(message):
     if not is_auth(message.from_user.id):
         return bot.reply_to(message, "Нет доступа.")
-    valstr = message.text.strip()
     try:
-        valf = float(valstr)
-    except:
-        return bot.reply_to(message, "Ошибка: введите число 0..5.")
+        val = controller.set_custom_delay(message.text.strip())
+    except ControlError as e:
+        return bot.reply_to(message, f"Ошибка: {e}")
+    bot.reply_to(message, f"Доп. задержка: {val}")
+
+# ----------------- Режим asyncio -----------------
+
+# Всё на одном цикле: HTTP-приём и управление (aiohttp), push-канал, опрос
+# Telegram и планировщик печати. Нажатия уходят в отдельный однопоточный
+# executor (порядок клавиш сохраняется), паузы между ними — таймеры цикла,
+# поэтому /stop никого не блокирует: он просто ждёт задачу печати.
+# Остальные маршруты не дублируются — запрос прогоняется через Flask-вьюху.
+
+key_executor = None
+web = WSMsgType = None   # Заполняет run_async() из aiohttp
+
+AIO_HEADERS = {'Access-Control-Allow-Origin': '*'}
+
+def aio_json(data, status=200):
+    return web.json_response(
+        data, status=status, headers=AIO_HEADERS,
+        dumps=lambda o: json.dumps(o, ensure_ascii=False)
+    )
+
+async def type_words_async():
+    """Асинхронный драйвер typing_steps(): шаги — в key_executor, паузы — на таймерах."""
+    loop = asyncio.get_running_loop()
+    steps = typing_steps()
+    done = object()
+    try:
+        while True:
+            delay = await loop.run_in_executor(key_executor, next, steps, done)
+            if delay is done:
+                break
+            # Звонок мог прийти, пока шаг работал в executor — тогда не ждём вовсе
+            controller.async_wake.clear()
+            if wake_event.is_set():
+                continue
+            try:
+                await asyncio.wait_for(controller.async_wake.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        await loop.run_in_executor(key_executor, steps.close)
+
+async def aio_start(request):
+    try:
+        await controller.start_async()
+    except ControlError as e:
+        return aio_json({"status":"error","message":str(e)}, 400)
+    return aio_json({"status":"ok","message":"Ввод запущен"})
+
+async def aio_stop(request):
+    try:
+        await controller.stop_async()
+    except ControlError as e:
+        return aio_json({"status":"error","message":str(e)}, 400)
+    return aio_json({"status":"ok","message":"Ввод остановлен и typed_words очищены"})
+
+async def aio_pause(request):
+    try:
+        latency = await controller.pause_async()
+    except ControlError as e:
+        return aio_json({"status":"error","message":str(e)}, 400)
+    return aio_json({"status":"ok","message":"Ввод на паузе","latency_ms":round(latency * 1000, 1)})
+
+async def aio_resume(request):
+    try:
+        controller.resume()
+    except ControlError as e:
+        return aio_json({"status":"error","message":str(e)}, 400)
+    return aio_json({"status":"ok","message":"Ввод продолжен"})
+
+async def aio_force_parse(request):
+    epoch = await controller.force_parse_async()
+    return aio_json({"status":"ok","message":"force_parse=true. Очередь и typed_words очищены.","epoch":epoch})
+
+async def aio_events(request):
+    client = request.query.get('client') or request.remote
+    resp = web.StreamResponse(headers={'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache', **AIO_HEADERS})
+    await resp.prepare(request)
+    sub = control_hub.subscribe(asyncio.get_running_loop())
+    try:
+        await resp.write(f"data: {json.dumps(control_state(client))}\n\n".encode())
+        while True:
+            try:
+                await asyncio.wait_for(sub.get(), 15)
+            except asyncio.TimeoutError:
+                await resp.write(b": ping\n\n")
+                continue
+            await resp.write(f"data: {json.dumps(control_state(client))}\n\n".encode())
+    finally:
+        control_hub.unsubscribe(sub)
+    return resp
+
+async def aio_ws(request):
+    """Тот же протокол, что у /ws на flask_sock."""
+    client = request.query.get('client') or request.remote
+    ws = web.WebSocketResponse()
+    await ws.prepare(request)
+    sub = control_hub.subscribe(asyncio.get_running_loop())
+
+    async def pusher():
+        while True:
+            await sub.get()
+            await ws.send_str(json.dumps(control_state(client), ensure_ascii=False))
+
+    await ws.send_str(json.dumps(control_state(client), ensure_ascii=False))
+    push_task = asyncio.create_task(pusher())
+    try:
+        async for msg in ws:
+            if msg.type != WSMsgType.TEXT:
+                continue
+            data, error = parse_ws_frame(msg.data)
+            if error:
+                await ws.send_str(json.dumps(error, ensure_ascii=False))
+            elif data.get('type') == 'words':
+                resp, code = ingest_words(client, data)
+                await ws.send_str(json.dumps({"type": "ack", "id": data.get('id'), "code": code, **resp}, ensure_ascii=False))
+    finally:
+        push_task.cancel()
+        control_hub.unsubscribe(sub)
+    return ws
+
+async def aio_flask_bridge(request):
+    """Любой другой маршрут — через Flask-вьюху прямо на цикле (они короткие и не блокируют)."""
+    body = await request.read()
+    with app.test_request_context(
+        request.path_qs,
+        method=request.method,
+        data=body,
+        headers=list(request.headers.items()),
+        environ_base={'REMOTE_ADDR': request.remote or ''}
+    ):
+        resp = app.full_dispatch_request()
+    headers = {k: v for k, v in resp.headers.items() if k.lower() != 'content-length'}
+    return web.Response(body=resp.get_data(), status=resp.status_code, headers=headers)
+
+async def telegram_poller():
+    """Long polling Telegram как корутина; сами хендлеры бота работают в его пуле потоков."""
+    loop = asyncio.get_running_loop()
+    offset = None
+    while True:
+        try:
+            updates = await loop.run_in_executor(
+                None, functools.partial(bot.get_updates, offset=offset, timeout=20, long_polling_timeout=20)
+            )
+        except Exception as e:
+            log.error("[ERR] Telegram get_updates: %s", e)
+            await asyncio.sleep(3)
+            continue
+        if updates:
+            offset = updates[-1].update_id + 1
+            await loop.run_in_executor(None, bot.process_new_updates, updates)
 
+async def run_async(telegram=True, port=HTTP_PORT):
+    global key_executor, web, WSMsgType
+    try:
+        from aiohttp import web, WSMsgType
+    except ImportError:
+        raise RuntimeError("Для режима asyncio нужен aiohttp")
+    create_app()   # Остальные маршруты идут через Flask-вьюхи (aio_flask_bridge)
+    key_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='keys')
+    controller.async_wake = asyncio.Event()
+    controller.loop = asyncio.get_running_loop()
+
+    aio = web.Application()
+    aio.router.add_post('/start', aio_start)
+    aio.router.add_post('/stop', aio_stop)
+    aio.router.add_post('/pause', aio_pause)
+    aio.router.add_post('/resume', aio_resume)
+    aio.router.add_post('/force_parse', aio_force_parse)
+    aio.router.add_get('/events', aio_events)
+    aio.router.add_get('/ws', aio_ws)
+    aio.router.add_route('*', '/{tail:.*}', aio_flask_bridge)
+
+    runner = web.AppRunner(aio)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', port).start()
+    log.info("[INFO] asyncio-сервер запущен на 127.0.0.1:%s", port)
     try:
-        rr = requests.post("http://127.0.0.1:5000/set_custom_delay", json={"value":valf})
-        if rr.status_code==200:
-            j = rr.json()
-            global custom_delay
-            custom_delay = j.get('custom_delay',0.0)
-            bot.reply_to(message, f"Доп. задержка: {custom_delay}")
+        if telegram:
+            await telegram_poller()
         else:
-            bot.reply_to(message, f"Ошибка: {rr.text}")
-    except Exception as e:
-        bot.reply_to(message, f"Сетевая ошибка: {e}")
+            await asyncio.get_running_loop().create_future()   # Только сервер: ждём до Ctrl+C
+    finally:
+        await runner.cleanup()
+        key_executor.shutdown(wait=False)
 
 # ----------------- Запуск -----------------
 
-def run_flask():
-    app.run(host='127.0.0.1', port=5000, debug=False, use_reloader=False)
+def run_flask(server=HTTP_SERVER, port=HTTP_PORT):
+    """Flask-приложение на выбранном HTTP-сервере (см. HTTP_SERVER)."""
+    app = create_app(push=server in PUSH_HTTP_SERVERS)
+    if server == 'waitress':
+        from waitress import serve
+        log.info("[INFO] waitress на 127.0.0.1:%s, потоков: %s", port, WAITRESS_THREADS)
+        serve(app, host='127.0.0.1', port=port, threads=WAITRESS_THREADS)
+    else:
+        app.run(host='127.0.0.1', port=port, debug=False, use_reloader=False, threaded=server == 'threaded')
+
+def restore_session():
+    """Открывает журнал сессии и возвращает в буфер недопечатанные слова."""
+    if not journal.path:
+        return
+    try:
+        words, streams = journal.open()
+    except OSError as e:
+        log.warning("[JOURNAL] Журнал недоступен (%s), работаем без него", e)
+        return
+    # Повторный снимок той же страницы после рестарта не должен лечь в очередь ещё раз
+    ingestor.seed(streams)
+    if words:
+        accepted = words_buffer.put_many(words)
+        log.info("[JOURNAL] Восстановлено недопечатанных слов: %s. Продолжить — /start", accepted)
+
+def run_server(mode, telegram, server=HTTP_SERVER, port=HTTP_PORT):
+    """Сервер для userscript'а; telegram — плюс опрос Telegram-бота (create_bot уже вызван)."""
+    restore_session()
+    if mode == 'asyncio':
+        asyncio.run(run_async(telegram, port))
+    elif telegram:
+        flask_thread = threading.Thread(target=run_flask, args=(server, port), daemon=True)
+        flask_thread.start()
+        time.sleep(1)
+        bot.infinity_polling()
+    else:
+        run_flask(server, port)
+
+def read_words(lines, enter=False):
+    """Слова из потока строк по одной строке (файл целиком не читается). enter — Enter в конце строки."""
+    for line in lines:
+        yield from line.split()
+        if enter:
+            yield ''
+
+def batched(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def type_stream(words, batch=256):
+    """
+    Режим type: слова из генератора идут в words_buffer пачками, печать идёт
+    параллельно в continue_mode. Вход кончился — выключаем continue_mode,
+    движок допечатывает очередь и выходит. Буфер полон — ждём, пока разгребёт.
+    """
+    controller.settings.update(continue_mode=True)
+    controller.start()
+    thread = controller.typing_thread
+    try:
+        for chunk in batched(words, batch):
+            while chunk and thread.is_alive():
+                chunk = chunk[words_buffer.put_many(chunk):]
+                if chunk:
+                    stop_event.wait(0.05)
+            if not thread.is_alive():
+                break
+        controller.settings.update(continue_mode=False)
+        wake_idle_engine()
+        while thread.is_alive():
+            thread.join(0.5)   # join с таймаутом, чтобы Ctrl+C доходил и на Windows
+    except KeyboardInterrupt:
+        controller.stop()
+    log.info("[INFO] %s", metrics.summary_text().replace("\n", "; "))
+
+def build_cli():
+    import argparse
+    ap = argparse.ArgumentParser(description="Бот автопечати: сервер для userscript'а, Telegram-бот, печать из файла")
+    ap.add_argument('--log-level', type=str.upper, choices=LOG_LEVELS, default=LOG_LEVEL)
+    ap.add_argument('--check', action='store_true',
+                    help="только подготовить режим (импорты, бот, бэкенд) и выйти")
+    ap.add_argument('--journal', default=JOURNAL_PATH, help="файл журнала сессии; '' — без журнала")
+    sub = ap.add_subparsers(dest='command')
+
+    def server_args(p):
+        p.add_argument('--mode', choices=('threads', 'asyncio'), default=SERVER_MODE)
+        p.add_argument('--http', choices=HTTP_SERVERS, default=HTTP_SERVER, help="HTTP-сервер для --mode threads")
+        p.add_argument('--port', type=int, default=HTTP_PORT)
+        p.add_argument('--backend', choices=['auto', *KEYBOARD_BACKENDS],
+                       help="бэкенд нажатий для всех сайтов (например, recording — ничего не нажимать)")
+
+    p = sub.add_parser('server', help="HTTP-сервер для userscript'а без Telegram")
+    server_args(p)
+
+    p = sub.add_parser('bot', help="HTTP-сервер + Telegram-бот (по умолчанию)")
+    server_args(p)
+    p.add_argument('--token', help="токен Telegram (иначе TYPINGBOT_TOKEN или TOKEN в файле)")
+    p.add_argument('--api-url', default=TELEGRAM_API_URL, help="адрес Bot API (локальный сервер, заглушка)")
+
+    p = sub.add_parser('type', help="напечатать слова из файла, канала или stdin")
+    p.add_argument('file', nargs='?', default='-', help="файл со словами; '-' — stdin")
+    p.add_argument('--encoding', default='utf-8')
+    p.add_argument('--enter', action='store_true', help="Enter в конце каждой строки")
+    p.add_argument('--speed', choices=list(speed_settings), help="пресет скорости")
+    p.add_argument('--wpm', type=float, help="целевая скорость, WPM")
+    p.add_argument('--backend', choices=['auto', *KEYBOARD_BACKENDS], default=KEY_BACKEND)
+    p.add_argument('--start-delay', type=float, default=3.0,
+                   help="секунд до начала печати (успеть переключиться в нужное окно)")
+    return ap
+
+def main(argv=None):
+    args = build_cli().parse_args(argv)
+    log.setLevel(args.log_level)
+    journal.path = args.journal
+    command = args.command or 'bot'
+
+    if command == 'type':
+        if args.backend != KEY_BACKEND:
+            force_backend(args.backend)
+        if args.speed:
+            controller.set_speed(args.speed)
+        if args.wpm:
+            controller.set_target_speed(args.wpm * CHARS_PER_WORD)
+        if args.check:
+            return 0
+        import io
+        if args.file == '-':
+            stream = io.TextIOWrapper(sys.stdin.buffer, encoding=args.encoding)
+        else:
+            stream = open(args.file, encoding=args.encoding)
+        with stream:
+            time.sleep(args.start_delay)
+            type_stream(read_words(stream, args.enter))
+        return 0
+
+    mode = getattr(args, 'mode', SERVER_MODE)
+    server = getattr(args, 'http', HTTP_SERVER)
+    telegram = command == 'bot'
+    if getattr(args, 'backend', None):
+        force_backend(args.backend)
+    needs = 'aiohttp' if mode == 'asyncio' else 'waitress' if server == 'waitress' else None
+    if needs:
+        import importlib
+        try:
+            importlib.import_module(needs)   # Проверяем заранее, до старта сервера
+        except ImportError:
+            sys.exit(f"Для этого режима нужен {needs} (pip install {needs})")
+    create_app(push=mode == 'asyncio' or server in PUSH_HTTP_SERVERS)
+    if telegram:
+        token = getattr(args, 'token', None) or os.environ.get('TYPINGBOT_TOKEN') or TOKEN
+        if not token:
+            sys.exit("Не задан токен Telegram: TOKEN в файле, TYPINGBOT_TOKEN или --token "
+                     "(без Telegram: команда server)")
+        create_bot(token, getattr(args, 'api_url', TELEGRAM_API_URL))   # Без команды ключей bot нет
+    if args.check:
+        return 0
+    run_server(mode, telegram, server, getattr(args, 'port', HTTP_PORT))
+    return 0
 
 if __name__ == '__main__':
-    flask_thread = threading.Thread(target=run_flask, daemon=True)
-    flask_thread.start()
-    time.sleep(1)
-    bot.infinity_polling()
+    sys.exit(main())
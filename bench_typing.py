@@ -0,0 +1,446 @@
+"""
+Оффлайн-бенчмарк движка печати.
+
+Гоняет через type_words_func() корпуса в том виде, в каком их отдают парсеры
+userscript'а (blindtyping, speedcoder с '\\t' и '', смешанный RU/EN typeracer,
+поток fastfingers), с подменённой клавиатурой и раскладкой — ничего реально
+не нажимается, Windows и pynput не нужны.
+
+Меряем:
+  * накладные расходы движка на символ (паузы = 0);
+  * переключения раскладки на 1000 слов;
+  * достигнутая скорость против заданной для каждого пресета и режима цели;
+  * рост памяти за длинную сессию;
+  * задержка слово -> нажатие у простаивающего движка (continue_mode), p50/p99;
+  * время старта и пик памяти каждого режима CLI (server / bot / type).
+Перед замерами проверяются таблицы раскладок (check_keymap) и то, что
+напечатанный текст совпадает с корпусом.
+
+Результаты сравниваются с bench_baseline.json; регрессия => код выхода 1.
+
+    python bench_typing.py                    # прогон + сравнение с базой
+    python bench_typing.py --update-baseline  # записать новую базу
+    python bench_typing.py --quick            # короткий прогон (без замеров скорости)
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BOT_PATH = os.path.join(HERE, 'Bot Auto Typing.py')
+BASELINE_PATH = os.path.join(HERE, 'bench_baseline.json')
+
+# Допуски сравнения с базой
+OVERHEAD_TOLERANCE = 2.0      # Накладные расходы: не больше чем в 2 раза хуже базы (шум машины)
+RATE_TOLERANCE = 0.10         # Достигнутая/заданная скорость: ±10% от базы
+MEMORY_TOLERANCE = 1.5        # Рост памяти: не больше чем в 1.5 раза + MEMORY_SLACK_KB
+MEMORY_SLACK_KB = 64
+WAKEUP_TOLERANCE = 3.0        # Пробуждение: p99 не больше чем в 3 раза хуже базы + WAKEUP_SLACK_MS
+WAKEUP_SLACK_MS = 2.0
+STARTUP_TOLERANCE = 1.5       # Старт режима: не больше чем в 1.5 раза медленнее базы + STARTUP_SLACK_MS
+STARTUP_SLACK_MS = 100.0
+
+# ----------------- Загрузка бота -----------------
+
+def load_bot():
+    """
+    Загружает 'Bot Auto Typing.py' как модуль (в имени пробелы, обычный import не подойдёт).
+    Flask и telebot при этом не импортируются — движку они не нужны.
+    """
+    import types
+    with open(BOT_PATH, encoding='utf-8') as f:
+        src = f.read()
+    mod = types.ModuleType('typing_bot')
+    mod.__file__ = BOT_PATH
+    sys.modules['typing_bot'] = mod
+    with contextlib.redirect_stdout(io.StringIO()):
+        exec(compile(src, BOT_PATH, 'exec'), mod.__dict__)
+    return mod
+
+# ----------------- Корпуса -----------------
+
+EN_WORDS = (
+    "the of and to in is you that it he was for on are as with his they at be this "
+    "have from or one had by word but not what all were we when your can said there "
+    "use an each which she do how their if will up other about out many then them "
+    "these so some her would make like him into time has look two more write go see "
+    "number no way could people my than first water been call who oil its now find"
+).split()
+
+RU_WORDS = (
+    "и в не на я быть он с что а по это она этот к но они мы как из у который то за "
+    "свой что весь год от так о для ты же все тот мочь вы человек такой его сказать "
+    "только или ещё бы себя один как уже до время если сам когда другой вот говорить "
+    "наш мой знать стать при чтобы дело жизнь кто первый очень два день её новый рука"
+).split()
+
+CODE_LINES = [
+    "def main(args):",
+    "\tfor i in range(len(args)):",
+    "\t\tif args[i] == '--help':",
+    "\t\t\tprint(usage)",
+    "\t\t\treturn 0",
+    "\treturn run(args)",
+    "class Parser(object):",
+    "\tdef __init__(self, text):",
+    "\t\tself.text = text",
+    "\t\tself.pos = 0",
+]
+
+def corpus_blindtyping(rng, n):
+    """Blindtyping: плоский список английских слов."""
+    return [rng.choice(EN_WORDS) for _ in range(n)]
+
+def corpus_speedcoder(rng, n):
+    """Speedcoder: код, '\\t' на каждый отступ и '' на перевод строки."""
+    out = []
+    while len(out) < n:
+        line = rng.choice(CODE_LINES)
+        body = line.lstrip('\t')
+        out.extend(['\t'] * (len(line) - len(body)))
+        out.extend(body.split(' '))
+        out.append('')
+    return out[:n]
+
+def corpus_typeracer(rng, n):
+    """Typeracer: связный текст, фразы на RU и EN вперемешку, с пунктуацией."""
+    out = []
+    while len(out) < n:
+        words = RU_WORDS if rng.random() < 0.5 else EN_WORDS
+        phrase = [rng.choice(words) for _ in range(rng.randint(3, 9))]
+        phrase[0] = phrase[0].capitalize()
+        phrase[-1] += rng.choice('.,')
+        out.extend(phrase)
+    return out[:n]
+
+def corpus_fastfingers(rng, n):
+    """Fastfingers: бесконечный поток коротких слов (русский тест)."""
+    return [rng.choice(RU_WORDS) for _ in range(n)]
+
+CORPORA = {
+    'blindtyping': corpus_blindtyping,
+    'speedcoder': corpus_speedcoder,
+    'typeracer': corpus_typeracer,
+    'fastfingers': corpus_fastfingers,
+}
+
+def expected_text(words):
+    """Что должно получиться на экране: слово + пробел, '' — Enter."""
+    return ''.join('\n' if w == '' else w + ' ' for w in words)
+
+# ----------------- Прогон -----------------
+
+def make_counting_backend(bot):
+    """
+    Бэкенд-заглушка для длинных прогонов: только считает нажатия и помнит время
+    первого/последнего, без списка событий (он бы исказил замер памяти).
+    """
+    class CountingBackend(bot.KeyboardBackend):
+        name = 'counting'
+
+        def __init__(self):
+            self.layout = bot.LANG_ENGLISH
+            self.keys = 0
+            self.first = self.last = 0.0
+
+        def press(self, key):
+            pass
+
+        def release(self, key):
+            pass
+
+        def type(self, text):
+            t = time.perf_counter()
+            if not self.keys:
+                self.first = t
+            self.last = t
+            self.keys += 1
+
+        def tap(self, stroke):
+            self.type(stroke.char)
+
+        def switch_layout(self, layout):
+            self.layout = layout
+            return True
+
+        def current_layout(self):
+            return self.layout
+
+    return CountingBackend()
+
+def run_words(bot, words, backend, **settings):
+    """Печатает words через type_words_func() на бэкенде backend (без continue_mode). Вернёт число переключений раскладки."""
+    bot.set_backend(backend)
+    bot.stop_event.clear()
+    bot.clear_word_queues()
+    bot.typed_words.clear()
+    base = dict(target_cpm=0, custom_delay=0.0, errors_enabled=False, continue_mode=False)
+    if 'min_delay' not in settings:
+        # Пресет переписывает min/max_delay, поэтому — только если их не задали явно
+        base['current_speed'] = 'medium'
+    base.update(settings)
+    bot.controller.settings.update(**base)
+    bot.words_buffer.put_many(words)
+    switches = bot.layouts.switches
+    with contextlib.redirect_stdout(io.StringIO()):
+        th = threading.Thread(target=bot.type_words_func)
+        th.start()
+        th.join()
+    return bot.layouts.switches - switches
+
+def check_keymap(bot):
+    """
+    Проверка таблиц раскладок на RecordingBackend: каждый символ таблицы,
+    нажатый по своему KeyStroke, печатается сам собой, а все символы
+    корпусов находятся в таблице хотя бы одной раскладки.
+    """
+    for layout, keymap in bot.KEYMAPS.items():
+        rec = bot.RecordingBackend(layout)
+        for stroke in keymap.values():
+            rec.tap(stroke)
+        if rec.typed_text() != ''.join(keymap):
+            raise SystemExit(f"[BENCH] Таблица раскладки {layout} не совпадает с тем, что печатается")
+        letters = [ch for ch in keymap if ch.isalpha()]
+        if any(bot.determine_language_of_char(ch) != bot.LAYOUT_LANGS[layout] for ch in letters):
+            raise SystemExit(f"[BENCH] Язык букв раскладки {layout} определяется неверно")
+
+def bench_overhead(bot, corpora):
+    """Паузы = 0: всё время между первым и последним нажатием — движок."""
+    out = {}
+    for name, words in corpora.items():
+        be = make_counting_backend(bot)
+        switches = run_words(bot, words, be, min_delay=0.0, max_delay=0.0)
+        rec = bot.RecordingBackend()
+        run_words(bot, words, rec, min_delay=0.0, max_delay=0.0)
+        if rec.typed_text() != expected_text(words):
+            raise SystemExit(f"[BENCH] {name}: напечатанный текст не совпал с корпусом")
+        out[name] = {
+            'us_per_char': round((be.last - be.first) / max(be.keys - 1, 1) * 1e6, 2),
+            'switches_per_1k_words': round(switches * 1000 / len(words), 1),
+        }
+    return out
+
+def bench_rates(bot, words):
+    """Достигнутая скорость против заданной: пресеты и режим цели."""
+    out = {}
+    cases = [(name, dict(current_speed=name)) for name in bot.speed_settings]
+    cases += [(f"target_{cpm}cpm", dict(target_cpm=cpm)) for cpm in (300, 600, 1200)]
+    for name, settings in cases:
+        if 'target_cpm' in settings:
+            configured = settings['target_cpm']
+        else:
+            lo, hi = bot.speed_settings[name]
+            configured = 60.0 / ((lo + hi) / 2)
+        # ~3 секунды печати на случай, но не меньше 40 символов
+        chars = max(40, int(configured / 20))
+        sample, n = [], 0
+        while n < chars:
+            w = words[len(sample) % len(words)]
+            sample.append(w)
+            n += len(w) + 1
+        be = make_counting_backend(bot)
+        run_words(bot, sample, be, **settings)
+        achieved = (be.keys - 1) * 60.0 / (be.last - be.first)
+        out[name] = {
+            'configured_cpm': round(configured, 1),
+            'achieved_cpm': round(achieved, 1),
+            'ratio': round(achieved / configured, 3),
+        }
+    return out
+
+def bench_memory(bot, words, rounds=4):
+    """Рост памяти за длинную сессию: трассируем прирост после нескольких прогонов."""
+    be = make_counting_backend(bot)
+    run_words(bot, words, be, min_delay=0.0, max_delay=0.0)   # Прогрев: кэши, пулы
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        for _ in range(rounds):
+            bot.stop_event.clear()
+            bot.controller.settings.update(min_delay=0.0, max_delay=0.0)
+            bot.words_buffer.put_many(words)
+            with contextlib.redirect_stdout(io.StringIO()):
+                bot.type_words_func()
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    grown = sum(s.size_diff for s in after.compare_to(before, 'filename'))
+    total_words = len(words) * rounds
+    return {
+        'words': total_words,
+        'growth_kb': round(grown / 1024, 1),
+        'kb_per_1k_words': round(grown / 1024 * 1000 / total_words, 2),
+    }
+
+def bench_wakeup(bot, rounds=200, gap=0.005):
+    """
+    Движок в continue_mode ждёт слов; по одному слову раз в gap секунд,
+    меряем время от put_many() до первого нажатия этого слова.
+    """
+    be = make_counting_backend(bot)
+    bot.set_backend(be)
+    bot.stop_event.clear()
+    bot.clear_word_queues()
+    bot.controller.settings.update(min_delay=0.0, max_delay=0.0, custom_delay=0.0,
+                                   target_cpm=0, errors_enabled=False, continue_mode=True)
+    lat = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        bot.controller.start()
+        try:
+            time.sleep(0.1)
+            for _ in range(rounds):
+                keys = be.keys
+                t0 = time.perf_counter()
+                bot.words_buffer.put_many(['w'])
+                while be.keys == keys and time.perf_counter() - t0 < 1.0:
+                    time.sleep(0)
+                lat.append(be.last - t0 if be.keys != keys else 1.0)
+                time.sleep(gap)
+        finally:
+            bot.controller.stop()
+    lat.sort()
+    return {
+        'rounds': rounds,
+        'p50_ms': round(lat[len(lat) // 2] * 1e3, 3),
+        'p99_ms': round(lat[min(int(len(lat) * 0.99), len(lat) - 1)] * 1e3, 3),
+    }
+
+# Режимы CLI для замера старта: аргументы после --check
+STARTUP_MODES = {
+    'type': ['type'],
+    'server': ['server'],
+    'server_asyncio': ['server', '--mode', 'asyncio'],
+    'bot': ['bot', '--token', '0:bench'],
+    'default': [],   # Без команды = bot, токен из TYPINGBOT_TOKEN (как запуск двойным щелчком)
+}
+
+def bench_startup(runs=3):
+    """
+    Старт каждого режима в отдельном процессе с --check (всё импортировано и собрано,
+    но сервер не поднимается): лучшее время из runs и пик RSS (где есть os.wait4).
+    """
+    out = {}
+    for name, args in STARTUP_MODES.items():
+        best, rss = None, None
+        for _ in range(runs):
+            t0 = time.perf_counter()
+            proc = subprocess.Popen([sys.executable, BOT_PATH, '--log-level', 'ERROR', '--check', *args],
+                                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                    env={**os.environ, 'TYPINGBOT_TOKEN': '0:bench'})
+            if hasattr(os, 'wait4'):
+                _, status, usage = os.wait4(proc.pid, 0)
+                proc.returncode = os.waitstatus_to_exitcode(status)
+                rss = usage.ru_maxrss   # КБ (Linux)
+            else:
+                proc.wait()
+            elapsed = time.perf_counter() - t0
+            if proc.returncode != 0:
+                raise SystemExit(f"[BENCH] Режим {name} не стартует (код {proc.returncode})")
+            best = elapsed if best is None else min(best, elapsed)
+        out[name] = {'ms': round(best * 1e3, 1)}
+        if rss:
+            out[name]['peak_rss_mb'] = round(rss / 1024, 1)
+    return out
+
+# ----------------- Сравнение с базой -----------------
+
+def compare(result, baseline):
+    """Список регрессий (пустой — всё в порядке)."""
+    bad = []
+    for name, cur in result['overhead'].items():
+        base = baseline.get('overhead', {}).get(name)
+        if not base:
+            continue
+        if cur['us_per_char'] > base['us_per_char'] * OVERHEAD_TOLERANCE:
+            bad.append(f"{name}: {cur['us_per_char']} мкс/символ (база {base['us_per_char']})")
+        if cur['switches_per_1k_words'] > base['switches_per_1k_words']:
+            bad.append(f"{name}: {cur['switches_per_1k_words']} переключений/1k слов "
+                       f"(база {base['switches_per_1k_words']})")
+    for name, cur in result.get('rates', {}).items():
+        base = baseline.get('rates', {}).get(name)
+        if base and abs(cur['ratio'] - base['ratio']) > RATE_TOLERANCE:
+            bad.append(f"{name}: скорость {cur['ratio']:.3f} от заданной (база {base['ratio']:.3f})")
+    cur, base = result['memory'], baseline.get('memory')
+    if base and cur['kb_per_1k_words'] > base['kb_per_1k_words'] * MEMORY_TOLERANCE + MEMORY_SLACK_KB:
+        bad.append(f"память: {cur['kb_per_1k_words']} КБ/1k слов (база {base['kb_per_1k_words']})")
+    cur, base = result.get('wakeup'), baseline.get('wakeup')
+    if cur and base and cur['p99_ms'] > base['p99_ms'] * WAKEUP_TOLERANCE + WAKEUP_SLACK_MS:
+        bad.append(f"пробуждение: p99 {cur['p99_ms']} мс (база {base['p99_ms']})")
+    for name, cur in result.get('startup', {}).items():
+        base = baseline.get('startup', {}).get(name)
+        if base and cur['ms'] > base['ms'] * STARTUP_TOLERANCE + STARTUP_SLACK_MS:
+            bad.append(f"старт {name}: {cur['ms']} мс (база {base['ms']})")
+    return bad
+
+def print_report(result):
+    print("[BENCH] Накладные расходы (паузы = 0):")
+    for name, r in result['overhead'].items():
+        print(f"  {name:12} {r['us_per_char']:8.2f} мкс/символ  "
+              f"{r['switches_per_1k_words']:7.1f} переключений/1k слов")
+    if result.get('rates'):
+        print("[BENCH] Скорость (заданная -> достигнутая CPM):")
+        for name, r in result['rates'].items():
+            print(f"  {name:16} {r['configured_cpm']:8.1f} -> {r['achieved_cpm']:8.1f}  ({r['ratio']:.3f})")
+    m = result['memory']
+    print(f"[BENCH] Память: +{m['growth_kb']} КБ за {m['words']} слов ({m['kb_per_1k_words']} КБ/1k слов)")
+    w = result.get('wakeup')
+    if w:
+        print(f"[BENCH] Пробуждение (слово -> нажатие): p50 {w['p50_ms']} мс, p99 {w['p99_ms']} мс")
+    if result.get('startup'):
+        print("[BENCH] Старт режимов CLI (--check):")
+        for name, r in result['startup'].items():
+            rss = f"  пик {r['peak_rss_mb']} МБ" if 'peak_rss_mb' in r else ''
+            print(f"  {name:16} {r['ms']:8.1f} мс{rss}")
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Оффлайн-бенчмарк движка печати")
+    ap.add_argument('--words', type=int, default=2000, help="слов в каждом корпусе")
+    ap.add_argument('--seed', type=int, default=1)
+    ap.add_argument('--quick', action='store_true', help="без замеров скорости (они идут в реальном времени)")
+    ap.add_argument('--update-baseline', action='store_true', help="записать результат как новую базу")
+    ap.add_argument('--baseline', default=BASELINE_PATH)
+    args = ap.parse_args(argv)
+
+    bot = load_bot()
+    random.seed(args.seed)
+    rng = random.Random(args.seed)
+    corpora = {name: make(rng, args.words) for name, make in CORPORA.items()}
+    check_keymap(bot)
+
+    result = {'overhead': bench_overhead(bot, corpora)}
+    if not args.quick:
+        result['rates'] = bench_rates(bot, corpora['blindtyping'])
+    result['memory'] = bench_memory(bot, corpora['fastfingers'])
+    result['wakeup'] = bench_wakeup(bot)
+    result['startup'] = bench_startup()
+    print_report(result)
+
+    if args.update_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"[BENCH] База записана в {args.baseline}")
+        return 0
+    if not os.path.exists(args.baseline):
+        print("[BENCH] Базы нет, сравнивать не с чем (запустите с --update-baseline)")
+        return 0
+    with open(args.baseline, encoding='utf-8') as f:
+        baseline = json.load(f)
+    bad = compare(result, baseline)
+    if bad:
+        print("[BENCH] РЕГРЕССИЯ:")
+        for line in bad:
+            print("  " + line)
+        return 1
+    print("[BENCH] OK, в пределах базы")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
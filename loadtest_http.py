@@ -0,0 +1,341 @@
+"""
+Нагрузочный тест HTTP-сервера бота: N вкладок с userscript'ом против одного сервера.
+
+Каждый клиент ведёт себя как вкладка с userscript'ом (CHECK_INTERVAL = 2 с):
+держит открытым push-канал /events, пока «вкладка открыта» (если сервер его не
+отдаёт — 404, как под single/waitress, — опрашивает GET /parsing_status), и шлёт
+POST /words со снимком страницы своего сайта
+(корпуса — те же, что в bench_typing.py, размеры страниц — PAGE_WORDS; страница
+«дописывается» по ходу теста и время от времени сменяется новой). Иногда клиент
+смотрит /typed и дёргает переключатель (/toggle_memory дважды — состояние не меняется).
+
+Сервер поднимается отдельным процессом (server --backend recording: ничего не нажимается,
+журнал выключен) на своём порту. Печать идёт всё время теста; по /metrics сравниваем
+темп и точность пауз движка без нагрузки и под ней.
+
+На каждый вариант HTTP-сервера (--server: single, threaded, waitress) печатаем:
+  * запросы/с, долю ошибок и коды ответов по каждому маршруту
+    (/events — одна запись на открытие push-канала);
+  * задержку p50/p95/p99;
+  * скорость печати (CPM) и пересып пауз p50/p99 без нагрузки и под нагрузкой.
+Скорость печати берётся из typingbot_chars_typed_total, пересып — из гистограммы
+typingbot_sleep_overshoot_seconds (точность — границы её корзин).
+
+    python loadtest_http.py                          # 10 клиентов, все установленные серверы
+    python loadtest_http.py --clients 30 --interval 0.5 --server threaded waitress
+"""
+import argparse
+import importlib.util
+import json
+import random
+import re
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from bench_typing import BOT_PATH, CORPORA
+
+# Слов на странице у парсера каждого сайта и сколько слов «дописывается» за тик опроса
+PAGE_WORDS = {
+    'blindtyping': 150,
+    'speedcoder': 250,
+    'typeracer': 70,
+    'fastfingers': 400,
+}
+WORDS_PER_TICK = 12
+TICKS_PER_PAGE = 15
+SITE_HOSTS = {
+    'blindtyping': 'blindtyping.com',
+    'speedcoder': 'speedcoder.net',
+    'typeracer': 'play.typeracer.com',
+    'fastfingers': '10fastfingers.com',
+}
+TYPED_CHANCE = 0.1    # Доля тиков, где клиент ещё и смотрит /typed
+TOGGLE_CHANCE = 0.05  # ... и дёргает /toggle_memory (дважды)
+FEED_WORDS = 40000    # Запас слов для печати на весь тест (чтобы очередь не кончалась)
+
+# ----------------- HTTP -----------------
+
+def call(base, method, path, body=None, timeout=10):
+    """Один запрос. Вернёт (код ответа или 0 при сетевой ошибке, секунды)."""
+    data = json.dumps(body).encode() if body is not None else None
+    req = urllib.request.Request(base + path, data=data, method=method,
+                                 headers={'Content-Type': 'application/json'} if data else {})
+    t0 = time.perf_counter()
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as resp:
+            resp.read()
+            code = resp.status
+    except urllib.error.HTTPError as e:
+        e.read()
+        code = e.code
+    except OSError:
+        code = 0
+    return code, time.perf_counter() - t0
+
+class Stats:
+    """Задержки и коды ответов по маршрутам (общие для всех клиентов)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}
+        self.codes = {}
+
+    def add(self, route, code, elapsed):
+        with self._lock:
+            self.latencies.setdefault(route, []).append(elapsed)
+            codes = self.codes.setdefault(route, {})
+            codes[code] = codes.get(code, 0) + 1
+
+def quantile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(int(len(sorted_values) * q), len(sorted_values) - 1)]
+
+# ----------------- Клиент -----------------
+
+def open_push(base, client, stop, stats):
+    """
+    Push-канал вкладки, как EventSource в userscript: /events держится открытым,
+    пока вкладка жива (то есть до stop), и всё это время занимает соединение на сервере.
+    Вернёт Event «канал жив» или None, если сервер его не отдал (тогда — опрос).
+    """
+    url = urllib.parse.urlsplit(base)
+    t0 = time.perf_counter()
+    try:
+        sock = socket.create_connection((url.hostname, url.port), timeout=10)
+        sock.sendall(f"GET /events?client={client} HTTP/1.1\r\nHost: {url.netloc}\r\n"
+                     f"Accept: text/event-stream\r\nConnection: close\r\n\r\n".encode())
+        head = b''
+        while b'\r\n' not in head:
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            head += chunk
+        code = int(head.split(b' ', 2)[1]) if head.startswith(b'HTTP/') else 0
+    except (OSError, ValueError, IndexError):
+        sock, code = None, 0
+    stats.add('/events', code, time.perf_counter() - t0)
+    if code != 200:
+        if sock:
+            sock.close()
+        return None
+    alive = threading.Event()
+    alive.set()
+
+    def drain():
+        sock.settimeout(0.5)
+        try:
+            while not stop.is_set():
+                try:
+                    if not sock.recv(4096):
+                        break   # Сервер закрыл канал — вкладка вернётся к опросу
+                except socket.timeout:
+                    continue
+        except OSError:
+            pass
+        finally:
+            alive.clear()
+            sock.close()
+
+    threading.Thread(target=drain, daemon=True).start()
+    return alive
+
+def run_client(base, idx, site, stop, stats, interval, seed):
+    """Одна вкладка: push-канал (или опрос) + снимок страницы раз в interval секунд."""
+    rng = random.Random(seed)
+    client = f"{SITE_HOSTS[site]}-load{idx}"
+    page, shown, ticks = [], 0, 0
+    time.sleep(rng.random() * interval)   # Вкладки открывались не одновременно
+    push = open_push(base, client, stop, stats)
+    while not stop.is_set():
+        t0 = time.perf_counter()
+        if ticks % TICKS_PER_PAGE == 0:
+            page = CORPORA[site](rng, PAGE_WORDS[site])
+            shown = 0
+        ticks += 1
+        shown = min(shown + WORDS_PER_TICK, len(page)) if site == 'fastfingers' else len(page)
+
+        # Состояние приходит по push-каналу; без него — опрос, как в userscript
+        if not (push and push.is_set()):
+            code, el = call(base, 'GET', f'/parsing_status?client={client}')
+            stats.add('/parsing_status', code, el)
+        code, el = call(base, 'POST', '/words', {
+            'words': page[:shown], 'client': client, 'snapshot': True, 'site': SITE_HOSTS[site],
+        })
+        stats.add('/words', code, el)
+        if rng.random() < TYPED_CHANCE:
+            code, el = call(base, 'GET', '/typed?limit=50')
+            stats.add('/typed', code, el)
+        if rng.random() < TOGGLE_CHANCE:
+            for _ in range(2):
+                code, el = call(base, 'POST', '/toggle_memory')
+                stats.add('/toggle_memory', code, el)
+        stop.wait(max(interval - (time.perf_counter() - t0), 0))
+
+# ----------------- Метрики движка -----------------
+
+METRIC_RE = re.compile(r'^(typingbot_\w+?)(?:\{le="([^"]+)"\})? (\S+)$')
+
+def scrape(base):
+    """/metrics -> (время, {имя: значение}, {гистограмма: [(le, count)]})."""
+    with urllib.request.urlopen(base + '/metrics', timeout=10) as resp:
+        text = resp.read().decode()
+    values, buckets = {}, {}
+    for line in text.splitlines():
+        m = METRIC_RE.match(line)
+        if not m:
+            continue
+        name, le, value = m.groups()
+        if le is not None:
+            buckets.setdefault(name[:-len('_bucket')], []).append((float(le), float(value)))
+        else:
+            values[name] = float(value)
+    return time.perf_counter(), values, buckets
+
+def bucket_quantile(before, after, q):
+    """Квантиль по приросту счётчиков корзин между двумя снимками (верхняя граница корзины)."""
+    deltas = [(le, a - b) for (le, a), (_, b) in zip(after, before)]
+    total = deltas[-1][1] if deltas else 0
+    if total <= 0:
+        return 0.0
+    for le, cum in deltas:
+        if cum >= total * q:
+            return le
+    return deltas[-1][0]
+
+def engine_phase(first, second):
+    (t0, v0, b0), (t1, v1, b1) = first, second
+    chars = v1['typingbot_chars_typed_total'] - v0['typingbot_chars_typed_total']
+    cpm = chars * 60.0 / (t1 - t0)
+    over0 = b0['typingbot_sleep_overshoot_seconds']
+    over1 = b1['typingbot_sleep_overshoot_seconds']
+    return {
+        'cpm': round(cpm, 1),
+        'overshoot_p50_ms': round(bucket_quantile(over0, over1, 0.5) * 1e3, 3),
+        'overshoot_p99_ms': round(bucket_quantile(over0, over1, 0.99) * 1e3, 3),
+    }
+
+# ----------------- Прогон одного сервера -----------------
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def start_server(server, port):
+    proc = subprocess.Popen(
+        [sys.executable, BOT_PATH, '--log-level', 'ERROR', '--journal', '',
+         'server', '--http', server, '--port', str(port), '--backend', 'recording'],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base = f'http://127.0.0.1:{port}'
+    deadline = time.time() + 15
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise SystemExit(f"[LOAD] Сервер {server} не запустился (код {proc.returncode})")
+        if call(base, 'GET', '/parsing_status', timeout=1)[0] == 200:
+            return proc, base
+        time.sleep(0.1)
+    proc.kill()
+    raise SystemExit(f"[LOAD] Сервер {server} не ответил за 15 с")
+
+def run_server_load(server, args):
+    proc, base = start_server(server, free_port())
+    try:
+        # Запас слов и печать на всё время теста
+        rng = random.Random(args.seed)
+        call(base, 'POST', '/set_speed', {'value': args.speed})
+        call(base, 'POST', '/words', {'words': CORPORA['blindtyping'](rng, FEED_WORDS), 'client': 'loadtest-feed'})
+        call(base, 'POST', '/start')
+
+        time.sleep(1.0)   # Разгон печати
+        quiet_start = scrape(base)
+        time.sleep(args.duration)
+        quiet_end = scrape(base)
+
+        stats, stop = Stats(), threading.Event()
+        sites = list(CORPORA)
+        clients = [threading.Thread(target=run_client, daemon=True,
+                                    args=(base, i, sites[i % len(sites)], stop, stats,
+                                          args.interval, args.seed * 1000 + i))
+                   for i in range(args.clients)]
+        t0 = time.perf_counter()
+        for th in clients:
+            th.start()
+        time.sleep(args.interval)   # Пока все вкладки «откроются»
+        load_start = scrape(base)
+        time.sleep(args.duration)
+        load_end = scrape(base)
+        stop.set()
+        for th in clients:
+            th.join()
+        elapsed = time.perf_counter() - t0
+        call(base, 'POST', '/stop')
+    finally:
+        proc.terminate()
+        proc.wait()
+
+    routes = {}
+    for route, lat in stats.latencies.items():
+        lat.sort()
+        codes = stats.codes[route]
+        # 404 на /events — сервер не держит push-каналы, вкладка честно на опросе
+        errors = sum(n for code, n in codes.items()
+                     if not 200 <= code < 300 and not (route == '/events' and code == 404))
+        routes[route] = {
+            'requests': len(lat),
+            'rps': round(len(lat) / elapsed, 1),
+            'error_rate': round(errors / len(lat), 4),
+            'codes': {str(k): v for k, v in sorted(codes.items())},
+            'p50_ms': round(quantile(lat, 0.5) * 1e3, 2),
+            'p95_ms': round(quantile(lat, 0.95) * 1e3, 2),
+            'p99_ms': round(quantile(lat, 0.99) * 1e3, 2),
+        }
+    return {
+        'routes': routes,
+        'engine_quiet': engine_phase(quiet_start, quiet_end),
+        'engine_load': engine_phase(load_start, load_end),
+    }
+
+def print_report(server, r):
+    print(f"[LOAD] Сервер: {server}")
+    for route, s in sorted(r['routes'].items()):
+        print(f"  {route:16} {s['requests']:6d} запр. {s['rps']:7.1f}/с  ошибок {s['error_rate'] * 100:5.2f}%  "
+              f"p50/p95/p99 {s['p50_ms']:.1f}/{s['p95_ms']:.1f}/{s['p99_ms']:.1f} мс  коды {s['codes']}")
+    quiet = r['engine_quiet']['cpm']
+    for name, label in (('engine_quiet', 'без нагрузки'), ('engine_load', 'под нагрузкой')):
+        e = r[name]
+        print(f"  печать {label:14} {e['cpm']:7.1f} CPM ({e['cpm'] / quiet if quiet else 0:.3f} от тихой фазы), "
+              f"пересып p50/p99 {e['overshoot_p50_ms']}/{e['overshoot_p99_ms']} мс")
+
+def main(argv=None):
+    available = ['single', 'threaded']
+    if importlib.util.find_spec('waitress'):
+        available.append('waitress')
+    ap = argparse.ArgumentParser(description="Нагрузочный тест HTTP-сервера бота")
+    ap.add_argument('--clients', type=int, default=10, help="сколько вкладок с userscript'ом")
+    ap.add_argument('--interval', type=float, default=2.0, help="период опроса одной вкладки, с")
+    ap.add_argument('--duration', type=float, default=10.0, help="длительность каждой фазы, с")
+    ap.add_argument('--server', nargs='+', choices=('single', 'threaded', 'waitress'), default=available)
+    ap.add_argument('--speed', choices=('slow', 'medium', 'fast', '0.01'), default='fast',
+                    help="пресет скорости печати во время теста")
+    ap.add_argument('--seed', type=int, default=1)
+    ap.add_argument('--json', help="записать результат в файл")
+    args = ap.parse_args(argv)
+
+    result = {}
+    for server in args.server:
+        result[server] = run_server_load(server, args)
+        print_report(server, result[server])
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
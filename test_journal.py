@@ -0,0 +1,148 @@
+"""
+Журнал сессии (SessionJournal) на временном файле: восстановление после падения,
+оборванная запись, арифметика T/B, сжатие на ходу и дедупликация снимков после рестарта.
+
+    python -m pytest -q test_journal.py
+"""
+import os
+import subprocess
+import sys
+import textwrap
+import time
+
+import pytest
+
+from bench_typing import load_bot
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PAGE = 'one two three four five'.split()
+
+@pytest.fixture(scope='module')
+def bot():
+    return load_bot()
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'journal.log')
+
+def reopen(bot, path, **kw):
+    """Новый процесс бота в миниатюре: свой журнал, открыть, сразу закрыть."""
+    journal = bot.SessionJournal(path, **kw)
+    try:
+        return journal.open()
+    finally:
+        journal.close()
+
+def test_missing_file_is_empty_session(bot, path):
+    assert reopen(bot, path) == ([], {})
+    with open(path, encoding='utf-8') as f:
+        assert f.read() == 'B0\n'
+
+def test_killed_process_resumes_untyped_words(bot, path):
+    # Процесс падает без close(): всё, что писатель успел сбросить, должно пережить падение
+    script = textwrap.dedent(f"""
+        import os, sys, time
+        sys.path.insert(0, {HERE!r})
+        from bench_typing import load_bot
+        bot = load_bot()
+        journal = bot.SessionJournal({path!r}, flush_interval=0.01)
+        journal.open()
+        ingestor = bot.WordIngestor(bot.WordBuffer(100), 50, journal)
+        ingestor.ingest('site-a', {PAGE!r}, snapshot=True)
+        journal.typed()
+        journal.typed()
+        time.sleep(0.5)
+        os._exit(0)
+    """)
+    subprocess.run([sys.executable, '-c', script], cwd=HERE, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    words, streams = reopen(bot, path)
+    assert words == ['three', 'four', 'five']
+    assert streams == {'site-a': PAGE}
+
+def test_truncated_last_record_is_ignored(bot, path):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('B0\nS"a"\nW"x"\nW"y"\nT1\nW"z')   # Последняя запись оборвана
+    words, streams = reopen(bot, path)
+    assert words == ['y']
+    assert streams == {'a': ['x', 'y']}
+
+def test_base_and_typed_arithmetic(bot, path):
+    # После сжатия номера идут от базы: B5 — следующая W это слово №5
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('B5\nS"a"\nW"p"\nW"q"\nW"r"\nT6\n')
+    journal = bot.SessionJournal(path, flush_interval=0.01)
+    assert journal.open()[0] == ['q', 'r']
+    journal.typed()
+    journal.close()
+    with open(path, encoding='utf-8') as f:
+        assert f.read().splitlines()[-1] == 'T7'
+    assert reopen(bot, path)[0] == ['r']
+
+def test_reset_drops_words_and_history(bot, path):
+    journal = bot.SessionJournal(path, flush_interval=0.01)
+    journal.open()
+    journal.ingested(['a', 'b'], 'site')
+    journal.reset()
+    journal.ingested(['c'], 'site')
+    journal.close()
+    assert reopen(bot, path) == (['c'], {'site': ['c']})
+
+def test_old_format_without_sources(bot, path):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('B0\nW"a"\nW"b"\nT1\n')
+    assert reopen(bot, path) == (['b'], {})
+    assert reopen(bot, path) == (['b'], {})   # И после перезаписи в новом формате
+
+def test_compaction_while_writing(bot, path):
+    journal = bot.SessionJournal(path, flush_interval=0.001, compact_bytes=512, window=20)
+    journal.open()
+    expected = []
+    for i in range(200):
+        batch = [f"w{i}-{k}" for k in range(3)]
+        journal.ingested(batch, 'site')
+        expected += batch
+        for _ in range(2):
+            journal.typed()
+        if i % 10 == 0:
+            time.sleep(0.005)   # Писатель успевает сбросить пачку и сжать журнал посреди записи
+    journal.close()
+    with open(path, encoding='utf-8') as f:
+        lines = f.read().splitlines()
+    # Сжатие срабатывало: база сдвинута, напечатанное осталось только историей (не больше window)
+    assert lines[0].startswith('B') and int(lines[0][1:]) > 0
+    assert sum(line.startswith('H') for line in lines) <= 20
+    words, streams = reopen(bot, path, window=20)
+    assert words == expected[400:]
+    assert streams['site'] == expected[380:]
+
+def test_history_is_bounded_by_window(bot, path):
+    journal = bot.SessionJournal(path, flush_interval=0.01, window=3)
+    journal.open()
+    journal.ingested(PAGE, 'site')
+    for _ in PAGE:
+        journal.typed()
+    journal.close()
+    assert reopen(bot, path, window=3) == ([], {'site': ['three', 'four', 'five']})
+
+def test_restart_seeds_snapshot_dedup(bot, path):
+    # Первый «процесс»: снимок страницы принят, два слова напечатаны
+    journal = bot.SessionJournal(path, flush_interval=0.01)
+    journal.open()
+    bot.WordIngestor(bot.WordBuffer(100), 50, journal).ingest('site', PAGE, snapshot=True)
+    journal.typed()
+    journal.typed()
+    journal.close()
+
+    # Второй: восстановились и получили тот же снимок, дописанный на одно слово
+    journal = bot.SessionJournal(path, flush_interval=0.01)
+    words, streams = journal.open()
+    buffer = bot.WordBuffer(100)
+    buffer.put_many(words)
+    ingestor = bot.WordIngestor(buffer, 50, journal)
+    ingestor.seed(streams)
+    assert ingestor.ingest('site', PAGE + ['six'], snapshot=True) == (5, 1, 1)
+    # Другой клиент со своей историей не делит дедупликацию с этим
+    assert ingestor.ingest('other', PAGE[:2], snapshot=True) == (0, 2, 2)
+    journal.close()
+    assert buffer.get_batch(100, 0)[0] == ['three', 'four', 'five', 'six', 'one', 'two']
@@ -0,0 +1,74 @@
+"""
+Таблицы раскладок против настоящей клавиатуры (Windows-коды клавиш).
+Ожидания вписаны руками, а не выводятся из KEYBOARD_LAYOUTS: ошибку
+в таблице не спрячет то, что и нажатие, и обратный разбор идут по ней же.
+
+    python -m pytest -q test_keymap.py
+"""
+import pytest
+
+from bench_typing import load_bot, run_words
+
+RU, EN = '0419', '0409'
+
+@pytest.fixture(scope='module')
+def bot():
+    return load_bot()
+
+@pytest.mark.parametrize('ch, layout, vk, shift', [
+    # Русская раскладка: точка и запятая — одна клавиша справа от Ю
+    ('.', RU, 0xBF, False),
+    (',', RU, 0xBF, True),
+    ('№', RU, 0x33, True),
+    (';', RU, 0x34, True),
+    ('"', RU, 0x32, True),
+    ('Ё', RU, 0xC0, True),
+    ('ж', RU, 0xBA, False),
+    ('э', RU, 0xDE, False),
+    ('б', RU, 0xBC, False),
+    ('ю', RU, 0xBE, False),
+    # Английская
+    ('"', EN, 0xDE, True),
+    ("'", EN, 0xDE, False),
+    ('.', EN, 0xBE, False),
+    (',', EN, 0xBC, False),
+    (';', EN, 0xBA, False),
+    ('@', EN, 0x32, True),
+    # Одинаковые во всех раскладках
+    (' ', EN, 0x20, False),
+    ('\t', RU, 0x09, False),
+    ('\n', RU, 0x0D, False),
+])
+def test_keystroke(bot, ch, layout, vk, shift):
+    assert bot.keystroke(ch, layout) == bot.KeyStroke(ch, vk, shift, layout)
+
+def test_missing_char_has_no_key(bot):
+    assert bot.keystroke('€', EN) == bot.KeyStroke('€', None, False, EN)
+
+def test_mixed_words_key_events(bot):
+    """Смешанные слова через движок: каждое нажатие — нужная клавиша в активной раскладке."""
+    rec = bot.RecordingBackend(EN)
+    run_words(bot, ['Ёж,ok.', '№5;"x"'], rec, min_delay=0.0, max_delay=0.0)
+    events = [arg if kind == 'layout' else (arg.char, arg.vk, arg.shift, arg.layout)
+              for _, kind, arg in rec.events]
+    assert events == [
+        RU,
+        ('Ё', 0xC0, True, RU),
+        ('ж', 0xBA, False, RU),
+        (',', 0xBF, True, RU),
+        EN,
+        ('o', 0x4F, False, EN),
+        ('k', 0x4B, False, EN),
+        ('.', 0xBE, False, EN),
+        (' ', 0x20, False, EN),
+        RU,
+        ('№', 0x33, True, RU),
+        ('5', 0x35, False, RU),
+        (';', 0x34, True, RU),
+        ('"', 0x32, True, RU),
+        EN,
+        ('x', 0x58, False, EN),
+        ('"', 0xDE, True, EN),
+        (' ', 0x20, False, EN),
+    ]
+    assert rec.typed_text() == 'Ёж,ok. №5;"x" '
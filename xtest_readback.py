@@ -0,0 +1,99 @@
+"""
+Проверка XTestUnicodeBackend «на чтение»: текст вводится в собственное окно X,
+а затем собирается обратно из пришедших в окно KeyPress.
+
+Каждый KeyPress расшифровывается по раскладке X-сервера в момент прихода
+(бэкенд перекарчивает свободные keycode'ы на каждое слово, поэтому события
+слова читаются до того, как будет введено следующее). Совпадение прочитанного
+текста с исходным значит, что нажатия дошли до окна в фокусе и символы верные —
+без сайта и браузера.
+
+Нужен X-сервер с расширением XTEST и python-xlib; без экрана — через Xvfb:
+    xvfb-run -a python xtest_readback.py
+    xvfb-run -a python xtest_readback.py --text "Привет, world!"
+Код возврата: 0 — текст совпал, 1 — нет.
+"""
+import argparse
+import re
+import sys
+import time
+
+from bench_typing import load_bot
+
+DEFAULT_TEXT = "Привет, world! Ёж; №5 \"quotes\" ß→€ 😀\tTab\nEnter"
+EVENT_TIMEOUT = 2.0   # Сколько ждать KeyPress одного слова, с
+
+def open_window(d, X):
+    """Окно в фокусе ввода, в которое приходят KeyPress."""
+    screen = d.screen()
+    win = screen.root.create_window(
+        0, 0, 300, 50, 0, screen.root_depth,
+        event_mask=X.KeyPressMask | X.StructureNotifyMask)
+    win.map()
+    d.sync()
+    deadline = time.time() + EVENT_TIMEOUT
+    while time.time() < deadline:
+        if d.pending_events() and d.next_event().type == X.MapNotify:
+            break
+        time.sleep(0.01)
+    win.set_input_focus(X.RevertToParent, X.CurrentTime)
+    d.sync()
+    return win
+
+def decode(d, XK, keycode):
+    """Символ по текущей раскладке: keysym первой колонки keycode'а."""
+    keysym = d.get_keyboard_mapping(keycode, 1)[0][0]
+    if keysym == XK.string_to_keysym('Return'):
+        return '\n'
+    if keysym == XK.string_to_keysym('Tab'):
+        return '\t'
+    if 0x20 <= keysym <= 0xFF:
+        return chr(keysym)   # Latin-1 keysym == код символа
+    if keysym & 0xFF000000 == 0x01000000:
+        return chr(keysym & 0xFFFFFF)
+    return '�'
+
+def read_presses(d, X, XK, count):
+    """Дождаться count нажатий и расшифровать их."""
+    out = []
+    deadline = time.time() + EVENT_TIMEOUT
+    while len(out) < count and time.time() < deadline:
+        if not d.pending_events():
+            time.sleep(0.005)
+            continue
+        ev = d.next_event()
+        if ev.type == X.KeyPress:
+            out.append(decode(d, XK, ev.detail))
+    return ''.join(out)
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Ввод через XTestUnicodeBackend и чтение обратно")
+    ap.add_argument('--text', default=DEFAULT_TEXT, help="что вводить")
+    args = ap.parse_args(argv)
+
+    from Xlib import X, XK, display
+    bot = load_bot()
+    try:
+        backend = bot.XTestUnicodeBackend()
+    except Exception as e:
+        print(f"[XTEST] Бэкенд недоступен: {e}")
+        return 1
+    d = display.Display()
+    open_window(d, X)
+
+    typed = []
+    for chunk in re.findall(r'\S+|\s', args.text):   # Как движок: слово за словом
+        backend.type(chunk)
+        got = read_presses(d, X, XK, len(chunk))
+        typed.append(got)
+        if got != chunk:
+            print(f"[XTEST] Расхождение: {chunk!r} -> {got!r}")
+    result = ''.join(typed)
+    ok = result == args.text
+    print(f"[XTEST] Введено:   {args.text!r}")
+    print(f"[XTEST] Прочитано: {result!r}")
+    print("[XTEST] OK" if ok else "[XTEST] НЕ СОВПАЛО")
+    return 0 if ok else 1
+
+if __name__ == '__main__':
+    sys.exit(main())